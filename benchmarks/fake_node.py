@@ -0,0 +1,289 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from eth_abi import decode_abi, encode_abi
+from web3 import Web3
+from web3._utils.events import event_abi_to_log_topic
+
+from src.risk_engine import Q96
+
+# subset of PerpdexExchange. event fields other than trader and market are synthetic,
+# the indexer keeps only trader and market
+EXCHANGE_ABI = [
+    {
+        'name': name,
+        'type': 'event',
+        'anonymous': False,
+        'inputs': [
+            {'name': 'trader', 'type': 'address', 'indexed': True},
+            {'name': 'market', 'type': 'address', 'indexed': True},
+            {'name': 'base', 'type': 'int256', 'indexed': False},
+            {'name': 'quote', 'type': 'int256', 'indexed': False},
+        ],
+    }
+    for name in ['PositionChanged', 'AddLiquidity', 'RemoveLiquidity', 'PositionLiquidated']
+] + [
+    {
+        'name': name,
+        'type': 'event',
+        'anonymous': False,
+        'inputs': [
+            {'name': 'trader', 'type': 'address', 'indexed': True},
+            {'name': 'amount', 'type': 'uint256', 'indexed': False},
+        ],
+    }
+    for name in ['Deposited', 'Withdrawn']
+] + [
+    {
+        'name': name,
+        'type': 'function',
+        'stateMutability': 'view',
+        'inputs': [{'name': 'trader', 'type': 'address'}] + (
+            [{'name': 'market', 'type': 'address'}] if market else []),
+        'outputs': [{'name': '', 'type': t} for t in outputs],
+    }
+    for name, market, outputs in [
+        ('hasEnoughMaintenanceMargin', False, ['bool']),
+        ('getTotalAccountValue', False, ['int256']),
+        ('getPositionShare', True, ['int256']),
+        ('getOpenPositionShare', True, ['int256']),
+        ('getMakerInfo', True, ['uint256', 'uint256', 'uint256']),
+    ]
+] + [
+    {
+        'name': 'mmRatio',
+        'type': 'function',
+        'stateMutability': 'view',
+        'inputs': [],
+        'outputs': [{'name': '', 'type': 'uint24'}],
+    },
+]
+
+EXCHANGE_ADDRESS = Web3.toChecksumAddress('0x' + 'e0' * 20)
+MULTICALL_ADDRESS = Web3.toChecksumAddress('0x' + 'ca' * 20)
+CHAIN_ID = 31337
+
+
+def _address(prefix: int, i: int) -> str:
+    return Web3.toChecksumAddress('0x{:02x}{:038x}'.format(prefix, i + 1))
+
+
+class FakeChain:
+    # Synthetic exchange state: every trader has a position in every market.
+    # - event_count PositionChanged logs are spread evenly over block_count blocks
+    # - unhealthy_ratio of the traders don't have enough maintenance margin
+    def __init__(self, trader_count: int, market_count: int, block_count: int, event_count: int = None,
+                 unhealthy_ratio: float = 0.01) -> None:
+        self.traders = [_address(0x10, i) for i in range(trader_count)]
+        self.markets = [_address(0x20, i) for i in range(market_count)]
+        self.block_count = block_count
+        self.mm_ratio = 30000  # 3%
+        unhealthy_count = int(trader_count * unhealthy_ratio)
+        self.unhealthy_traders = set(self.traders[:unhealthy_count])
+
+        self._market_indexes = {market: i for i, market in enumerate(self.markets)}
+        # - key: function selector
+        # - value: (name, input types)
+        self._selectors = {}
+        for abi in EXCHANGE_ABI:
+            if abi['type'] == 'function':
+                input_types = [i['type'] for i in abi['inputs']]
+                signature = '{}({})'.format(abi['name'], ','.join(input_types))
+                self._selectors[Web3.keccak(text=signature)[:4]] = (abi['name'], input_types)
+        self._call_cache = {}
+
+        position_changed = [abi for abi in EXCHANGE_ABI if abi.get('name') == 'PositionChanged'][0]
+        topic0 = '0x' + event_abi_to_log_topic(position_changed).hex()
+        pairs = [(trader, market) for trader in self.traders for market in self.markets]
+        event_count = len(pairs) if event_count is None else event_count
+        self._log_blocks = []
+        self._logs = []
+        for i in range(event_count):
+            trader, market = pairs[i % len(pairs)]
+            block_number = i * block_count // max(event_count, 1)
+            self._log_blocks.append(block_number)
+            self._logs.append({
+                'address': EXCHANGE_ADDRESS,
+                'topics': [topic0, _pad_address(trader), _pad_address(market)],
+                'data': '0x' + encode_abi(['int256', 'int256'], [10 ** 18, -10 ** 18]).hex(),
+                'blockNumber': hex(block_number),
+                'blockHash': '0x' + '%064x' % (block_number + 1),
+                'transactionHash': '0x' + '%064x' % (i + 1),
+                'transactionIndex': '0x0',
+                'logIndex': hex(i),
+                'removed': False,
+            })
+
+    @property
+    def block_number(self) -> int:
+        # head. logs are in the blocks below it
+        return self.block_count
+
+    def get_block(self, block_identifier: str) -> dict:
+        # header fields used by the indexer. hashes match blockHash of the logs
+        block_number = self.block_number if block_identifier == 'latest' else int(block_identifier, 16)
+        return {
+            'number': hex(block_number),
+            'hash': '0x' + '%064x' % (block_number + 1),
+            'parentHash': '0x' + '%064x' % block_number,
+            'timestamp': hex(block_number),
+            'transactions': [],
+        }
+
+    def get_logs(self, params: dict, max_results: int):
+        from_block = int(params.get('fromBlock', '0x0'), 16)
+        to_block = int(params.get('toBlock', hex(self.block_count)), 16)
+        start = bisect.bisect_left(self._log_blocks, from_block)
+        end = bisect.bisect_right(self._log_blocks, to_block)
+        if end - start > max_results:
+            raise _RPCError(-32005, f'query returned more than {max_results} results')
+        topics = params.get('topics') or []
+        topic0s = topics[0] if len(topics) > 0 else None
+        if isinstance(topic0s, str):
+            topic0s = [topic0s]
+        return [
+            log for log in self._logs[start:end]
+            if topic0s is None or log['topics'][0] in topic0s
+        ]
+
+    def call(self, to: str, data: str) -> bytes:
+        # responses are cached so that the fake node costs little cpu next to the measured client
+        key = (to.lower(), data)
+        ret = self._call_cache.get(key)
+        if ret is None:
+            ret = self._call(Web3.toChecksumAddress(to), bytes.fromhex(data[2:]))
+            self._call_cache[key] = ret
+        if isinstance(ret, _RPCError):
+            raise ret
+        return ret
+
+    def _call(self, to: str, data: bytes):
+        selector, args = data[:4], data[4:]
+        if to == MULTICALL_ADDRESS:
+            return self._call_multicall(args)
+
+        if to in self._market_indexes:
+            return encode_abi(['uint256'], [Q96 * (1000 + self._market_indexes[to])])
+
+        if to != EXCHANGE_ADDRESS or selector not in self._selectors:
+            return _RPCError(3, 'execution reverted')
+        return self._call_exchange(selector, args)
+
+    def _call_multicall(self, args: bytes):
+        _, calls = decode_abi(['bool', '(address,bytes)[]'], args)
+        results = []
+        for target, call_data in calls:
+            try:
+                results.append((True, self.call(target, '0x' + call_data.hex())))
+            except _RPCError:
+                results.append((False, b''))
+        return encode_abi(['(bool,bytes)[]'], [results])
+
+    def _call_exchange(self, selector: bytes, args: bytes):
+        name, input_types = self._selectors[selector]
+        trader = Web3.toChecksumAddress(decode_abi(input_types, args)[0]) if len(input_types) > 0 else None
+        if name == 'hasEnoughMaintenanceMargin':
+            return encode_abi(['bool'], [trader not in self.unhealthy_traders])
+        if name == 'getTotalAccountValue':
+            # unhealthy traders are below mmRatio, others far above
+            notional = sum(1000 + i for i in range(len(self.markets))) * 10 ** 18
+            ratio = 0.01 if trader in self.unhealthy_traders else 0.5
+            return encode_abi(['int256'], [int(notional * ratio)])
+        if name in ['getPositionShare', 'getOpenPositionShare']:
+            return encode_abi(['int256'], [10 ** 18])
+        if name == 'getMakerInfo':
+            return encode_abi(['uint256', 'uint256', 'uint256'], [0, 0, 0])
+        if name == 'mmRatio':
+            return encode_abi(['uint24'], [self.mm_ratio])
+        return _RPCError(3, 'execution reverted')
+
+
+class FakeNode:
+    # In-process JSON-RPC node over http serving a FakeChain.
+    # - latency: seconds added to every http request (a batch counts once)
+    # - max_get_logs_results: eth_getLogs fails like public nodes above this number of logs
+    def __init__(self, chain: FakeChain, latency: float = 0, max_get_logs_results: int = 10000) -> None:
+        self.chain = chain
+        self.latency = latency
+        self.max_get_logs_results = max_get_logs_results
+        # - key: method
+        # - value: number of requests
+        self.request_counts = {}
+        self.http_request_count = 0
+        self._lock = threading.Lock()
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if node.latency > 0:
+                    time.sleep(node.latency)
+                with node._lock:
+                    node.http_request_count += 1
+                if isinstance(payload, list):
+                    response = [node.handle(request) for request in payload]
+                else:
+                    response = node.handle(payload)
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.uri = f'http://127.0.0.1:{self._server.server_address[1]}'
+        threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+
+    def reset_counts(self):
+        with self._lock:
+            self.request_counts = {}
+            self.http_request_count = 0
+
+    def handle(self, request: dict) -> dict:
+        method = request['method']
+        params = request.get('params') or []
+        with self._lock:
+            self.request_counts[method] = self.request_counts.get(method, 0) + 1
+        try:
+            if method == 'eth_chainId':
+                result = hex(CHAIN_ID)
+            elif method == 'net_version':
+                result = str(CHAIN_ID)
+            elif method == 'eth_blockNumber':
+                result = hex(self.chain.block_number)
+            elif method == 'eth_getBlockByNumber':
+                result = self.chain.get_block(params[0])
+            elif method == 'eth_getLogs':
+                result = self.chain.get_logs(params[0], self.max_get_logs_results)
+            elif method == 'eth_call':
+                result = '0x' + self.chain.call(params[0]['to'], params[0]['data']).hex()
+            else:
+                raise _RPCError(-32601, f'method {method} is not supported by the fake node')
+        except _RPCError as e:
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': e.code, 'message': e.message}}
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _RPCError(Exception):
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _pad_address(address: str) -> str:
+    return '0x' + '0' * 24 + address[2:].lower()
@@ -0,0 +1,106 @@
+import time
+
+
+class FakeRedis:
+    # in-memory subset of the redis client used by the indexer and the sharded mode
+    def __init__(self):
+        self.store = {}
+        # - key: key
+        # - value: time.time() when the key expires
+        self.expires = {}
+
+    def _expire(self, key):
+        if key in self.expires and self.expires[key] <= time.time():
+            self.store.pop(key, None)
+            del self.expires[key]
+
+    def get(self, key):
+        self._expire(key)
+        return self.store.get(key)
+
+    def set(self, key, value, nx=False, px=None, **kwargs):
+        self._expire(key)
+        if nx and key in self.store:
+            return None
+        self.store[key] = str(value).encode() if isinstance(value, (str, int)) else value
+        self.expires.pop(key, None)
+        if px is not None:
+            self.pexpire(key, px)
+        return True
+
+    def pexpire(self, key, px):
+        if key in self.store:
+            self.expires[key] = time.time() + px / 1000
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def eval(self, script, numkeys, *args):
+        # only the compare-and-set scripts of the claims: pexpire or del KEYS[1] if its value is ARGV[1]
+        key, value = args[0], args[1]
+        if self.get(key) != str(value).encode():
+            return 0
+        if "'pexpire'" in script:
+            self.pexpire(key, int(args[2]))
+        else:
+            self.delete(key)
+        return 1
+
+    def delete(self, *keys):
+        for key in keys:
+            self.store.pop(key, None)
+            self.expires.pop(key, None)
+
+    def zadd(self, key, mapping):
+        self.store.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, *members):
+        for member in members:
+            self.store.get(key, {}).pop(member, None)
+
+    def zremrangebyscore(self, key, min, max):
+        zset = self.store.get(key, {})
+        for member, score in list(zset.items()):
+            if float(min) <= score <= float(max):
+                del zset[member]
+
+    def zrangebyscore(self, key, min, max):
+        zset = self.store.get(key, {})
+        return [
+            member.encode() for member, score in sorted(zset.items(), key=lambda item: item[1])
+            if float(min) <= score <= float(max)
+        ]
+
+    def rpush(self, key, *values):
+        self.store.setdefault(key, []).extend(value.encode() for value in values)
+
+    def ltrim(self, key, start, end):
+        values = self.store.get(key, [])
+        end = len(values) + end if end < 0 else end
+        start = max(0, len(values) + start if start < 0 else start)
+        self.store[key] = values[start:end + 1]
+
+    def lrange(self, key, start, end):
+        values = self.store.get(key, [])
+        end = len(values) + end if end < 0 else end
+        return values[start:end + 1]
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+
+class FakeRedisPipeline:
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    def __getattr__(self, name):
+        def _command(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return _command
+
+    def execute(self):
+        ret = [getattr(self._redis, name)(*args, **kwargs) for name, args, kwargs in self._commands]
+        self._commands = []
+        return ret
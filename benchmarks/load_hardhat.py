@@ -0,0 +1,427 @@
+import asyncio
+import json
+import os
+import platform
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fire
+from web3 import Web3
+
+from src import metrics
+from src.contracts.utils import MAX_UINT, get_contract_from_abi_json, get_w3
+from src.liquidator import (Liquidator, get_liquidation_executor, get_multicall, get_perpdex_exchange_contract,
+                            get_perpdex_market_addresses)
+
+# End-to-end load test against the hardhat node of docker-compose (test contracts deployed by hardhat/deploy).
+# Synthetic traders are funded and impersonated on the node, collateral and prices are set with the
+# setters of TestPerpdexExchange / TestPerpdexMarket / TestPerpdexPriceFeed.
+
+DECIMALS: int = 18
+Q96: int = 0x1000000000000000000000000  # same as 1 << 96
+
+# hardhat default account #0 (the deployer) sets the test state, accounts #2-#5 send liquidations
+# so that their nonces don't race with the setup transactions
+LIQUIDATOR_PRIVATE_KEYS = [
+    '0x5de4111afa1a4b94908f83103eb1f1706367c2e68ca870fc3fb9a804cdab365a',
+    '0x7c852118294e51e653712a81e05800f419141751be58f605c371e15141b007a6',
+    '0x47e179ec197488593b187f80a00eb0da91f1b9d0b13f8733639f19c30a34926a',
+    '0x8b3a350cf5c34c9194ca85829a2df0ec3153be0318b5e2d3348e872092edffba',
+]
+
+SETUP_GAS = 1_000_000
+BASE_FEE = 10 ** 9
+GAS_PRICE = 2 * BASE_FEE
+TRADER_BALANCE = 10 ** 18
+
+
+def plan_collaterals(size: float, price: float, im_ratio: float, mm_ratio: float) -> dict:
+    # Collateral of underwater and healthy traders, and the price after the move (all in quote).
+    # A long of size base opened at price:
+    # - underwater: just above the initial margin at price, half the maintenance margin at moved_price
+    # - healthy: keeps three times the maintenance margin at moved_price
+    underwater = 1.2 * im_ratio * size * price
+    moved_price = (size * price - underwater) / (size * (1 - 0.5 * mm_ratio))
+    healthy = size * (price - moved_price) + 3 * mm_ratio * size * price
+    return dict(underwater=underwater, healthy=healthy, moved_price=moved_price)
+
+
+def _rpc(w3, method: str, params: list = None):
+    response = w3.provider.make_request(method, params or [])
+    if 'error' in response:
+        raise RuntimeError(f'{method} failed: {response["error"]}')
+    return response['result']
+
+
+def _send(w3, func, sender: str, chain_id: int):
+    # the node fills the nonce (unlocked or impersonated sender), gas and gasPrice are fixed to skip estimation
+    tx = func.buildTransaction({'from': sender, 'gas': SETUP_GAS, 'gasPrice': GAS_PRICE, 'chainId': chain_id})
+    return w3.eth.send_transaction(tx)
+
+
+def _mine_pending(w3, max_blocks: int) -> int:
+    # mine with automine off until the mempool is empty, keeping the base fee flat
+    blocks = 0
+    while blocks < max_blocks and int(_rpc(w3, 'eth_getBlockTransactionCountByNumber', ['pending']), 16) > 0:
+        _rpc(w3, 'hardhat_setNextBlockBaseFeePerGas', [hex(BASE_FEE)])
+        _rpc(w3, 'evm_mine')
+        blocks += 1
+    return blocks
+
+
+def _send_and_mine(w3, pool, calls: list, chain_id: int) -> dict:
+    # calls: [(func, sender)]
+    tx_hashes = list(pool.map(lambda call: _send(w3, call[0], call[1], chain_id), calls))
+    blocks = _mine_pending(w3, max_blocks=len(calls) + 10)
+    receipts = list(pool.map(w3.eth.get_transaction_receipt, tx_hashes))
+    return dict(
+        transaction_count=len(calls),
+        failed_count=sum(1 for receipt in receipts if receipt['status'] != 1),
+        block_count=blocks,
+    )
+
+
+def _price_calls(w3, market, price_feed, price: float, pool_depth: float, owner: str) -> list:
+    # mark price = quote / base * baseBalancePerShare, same as _set_mark_price of tests/test_scenario.py
+    calls = [(market.functions.setPoolInfo(dict(
+        base=int(pool_depth * 10 ** DECIMALS),
+        quote=int(pool_depth * price * 10 ** DECIMALS),
+        totalLiquidity=100000,
+        cumBasePerLiquidityX96=0,
+        cumQuotePerLiquidityX96=0,
+        baseBalancePerShareX96=1 * Q96,
+    )), owner)]
+    # keep the index price of TestPerpdexPriceFeed next to the mark price
+    if price_feed is not None and any(abi.get('name') == 'setPrice' for abi in price_feed.abi):
+        decimals = price_feed.functions.decimals().call() if any(
+            abi.get('name') == 'decimals' for abi in price_feed.abi) else DECIMALS
+        calls.append((price_feed.functions.setPrice(int(price * 10 ** decimals)), owner))
+    return calls
+
+
+def _set_operator(w3, liquidation_executor, private_key: str):
+    # setOperator is not in the subset ABI the liquidator uses
+    abi = [{
+        'name': 'setOperator',
+        'type': 'function',
+        'stateMutability': 'nonpayable',
+        'inputs': [{'name': 'operator', 'type': 'address'}, {'name': 'value', 'type': 'bool'}],
+        'outputs': [],
+    }]
+    contract = w3.eth.contract(address=liquidation_executor.address, abi=abi)
+    return contract.functions.setOperator(w3.eth.account.from_key(private_key).address, True)
+
+
+def _load_markets(w3, market_count: int = None) -> list:
+    # [(market contract, base price feed contract or None)] sorted by symbol
+    dirpath = os.environ['PERPDEX_CONTRACT_ABI_JSON_DIRPATH']
+    _, filepaths = get_perpdex_market_addresses(w3)
+    markets = []
+    for filepath in sorted(filepaths):
+        symbol = re.match(r'PerpdexMarket(.*)\.json', os.path.basename(filepath)).group(1)
+        price_feed_filepath = os.path.join(dirpath, f'PerpdexPriceFeedBase{symbol}.json')
+        price_feed = get_contract_from_abi_json(w3, price_feed_filepath) \
+            if os.path.exists(price_feed_filepath) else None
+        markets.append((get_contract_from_abi_json(w3, filepath), price_feed))
+    return markets if market_count is None else markets[:market_count]
+
+
+def _ratio(exchange, name: str, default: float) -> float:
+    # imRatio / mmRatio are in 1e6
+    if not any(abi.get('name') == name for abi in exchange.abi):
+        return default
+    return getattr(exchange.functions, name)().call() / 1e6
+
+
+def _trader_addresses(seed: str, count: int) -> list:
+    return [
+        Web3.toChecksumAddress('0x' + Web3.keccak(text=f'perpdex-load-{seed}-{i}')[-20:].hex())
+        for i in range(count)
+    ]
+
+
+def _positions_state(exchange, multicall, positions: list) -> list:
+    # [(has enough mm, position share)] per (trader, market)
+    funcs = []
+    for trader, market in positions:
+        funcs.append(exchange.functions.hasEnoughMaintenanceMargin(trader))
+        funcs.append(exchange.functions.getPositionShare(trader, market))
+    if multicall is None:
+        rets = [func.call() for func in funcs]
+    else:
+        rets = [ret for batch in multicall.split(funcs) for ret in multicall.try_aggregate(batch)]
+    return list(zip(rets[0::2], rets[1::2]))
+
+
+def _is_cleared(state) -> bool:
+    has_enough_mm, position_share = state
+    return has_enough_mm is True or position_share == 0
+
+
+def _percentile(values: list, q: float):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def _wait_for_setup_indexed(liq, w3, setup_block_number: int, poll_interval: float, timeout: float) -> float:
+    # let the liquidator index every setup block before moving prices
+    started_at = time.monotonic()
+    while liq._perpdex_exchange_event_indexer.last_block_number < setup_block_number:
+        if not liq.health_check():
+            await liq._task
+        if time.monotonic() - started_at > timeout:
+            raise TimeoutError('liquidator did not index the setup blocks in time')
+        await asyncio.sleep(poll_interval)
+        _rpc(w3, 'evm_mine')
+    return time.monotonic() - started_at
+
+
+async def _move_prices_pending(liq, w3, price_calls: list, chain_id: int, poll_interval: float, timeout: float) -> float:
+    # the price moves stay in the mempool until the liquidator has signed liquidations for them
+    loop = asyncio.get_running_loop()
+    sent_at = time.monotonic()
+    for func, sender in price_calls:
+        await loop.run_in_executor(None, _send, w3, func, sender, chain_id)
+    while len(liq._prepared_liquidations) == 0 and time.monotonic() - sent_at < timeout:
+        if not liq.health_check():
+            await liq._task
+        await asyncio.sleep(poll_interval / 10)
+    prepared_seconds = time.monotonic() - sent_at
+    await loop.run_in_executor(None, _mine_pending, w3, len(price_calls) + 10)
+    return prepared_seconds
+
+
+async def _wait_until_cleared(liq, exchange, multicall, remaining: set, moved_at: float, poll_interval: float,
+                              timeout: float) -> dict:
+    # returns seconds from the price move by (trader, market). cleared positions are removed from remaining
+    loop = asyncio.get_running_loop()
+    cleared = {}
+    while len(remaining) > 0 and time.monotonic() - moved_at < timeout:
+        if not liq.health_check():
+            await liq._task
+        await asyncio.sleep(poll_interval)
+        positions = list(remaining)
+        states = await loop.run_in_executor(None, _positions_state, exchange, multicall, positions)
+        now = time.monotonic() - moved_at
+        for position, state in zip(positions, states):
+            if _is_cleared(state):
+                cleared[position] = now
+                remaining.discard(position)
+    return cleared
+
+
+async def _run_liquidator_until_cleared(w3, exchange, multicall, underwater: list, setup_block_number: int,
+                                        price_calls: list, chain_id: int, block_time: float, poll_interval: float,
+                                        timeout: float, pending: bool = False) -> dict:
+    loop = asyncio.get_running_loop()
+    liq = Liquidator()
+    liq.start()
+    try:
+        indexed_seconds = await _wait_for_setup_indexed(liq, w3, setup_block_number, poll_interval, timeout)
+
+        prepared_seconds = None
+        if pending:
+            prepared_seconds = await _move_prices_pending(liq, w3, price_calls, chain_id, poll_interval, timeout)
+        else:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                await loop.run_in_executor(None, _send_and_mine, w3, pool, price_calls, chain_id)
+        moved_at = time.monotonic()
+        moved_block_number = w3.eth.block_number
+        _rpc(w3, 'evm_setIntervalMining', [int(block_time * 1000)])
+
+        states = await loop.run_in_executor(None, _positions_state, exchange, multicall, underwater)
+        remaining = {position for position, state in zip(underwater, states) if not _is_cleared(state)}
+        underwater_count = len(remaining)
+        cleared = await _wait_until_cleared(liq, exchange, multicall, remaining, moved_at, poll_interval, timeout)
+        block_count = w3.eth.block_number - moved_block_number
+    finally:
+        liq._task.cancel()
+        try:
+            await liq._task
+        except asyncio.CancelledError:
+            pass
+        _rpc(w3, 'evm_setIntervalMining', [0])
+        _rpc(w3, 'evm_setAutomine', [True])
+
+    seconds = list(cleared.values())
+    clear_all_seconds = max(seconds) if len(remaining) == 0 and len(seconds) > 0 else None
+    return dict(
+        indexed_seconds=indexed_seconds,
+        underwater_count=underwater_count,
+        cleared_count=len(cleared),
+        remaining_count=len(remaining),
+        first_clear_seconds=_percentile(seconds, 0),
+        p50_clear_seconds=_percentile(seconds, 0.5),
+        p90_clear_seconds=_percentile(seconds, 0.9),
+        p99_clear_seconds=_percentile(seconds, 0.99),
+        clear_all_seconds=clear_all_seconds,
+        positions_per_second=len(cleared) / clear_all_seconds if clear_all_seconds else None,
+        block_count=block_count,
+        liquidation_outcomes={
+            outcome: metrics.LIQUIDATIONS.get(outcome=outcome) or 0
+            for outcome in ['liquidated', 'failed', 'enough_mm', 'read_failed']
+        },
+        prepared_seconds=prepared_seconds,
+        prepared_outcomes={
+            outcome: metrics.PREPARED_LIQUIDATIONS.get(outcome=outcome) or 0
+            for outcome in ['sent', 'healthy', 'expired', 'failed']
+        },
+    )
+
+
+def run_load_test(traders: int = 2000, markets: int = None, underwater_ratio: float = 0.2, size: float = 0.01,
+                  price: float = 100, pool_depth: float = 10000, block_time: float = 1.0, senders: int = 4,
+                  poll_interval: float = 0.5, timeout: float = 600, workers: int = 32, seed: str = None,
+                  pending: bool = False, output: str = None) -> dict:
+    params = dict(locals())
+    params.pop('output')
+    seed = str(int(time.time())) if seed is None else seed
+
+    # the liquidator sends from its own accounts, the harness from the deployer
+    os.environ['USER_PRIVATE_KEY'] = LIQUIDATOR_PRIVATE_KEYS[0]
+    os.environ['USER_PRIVATE_KEYS'] = ','.join(LIQUIDATOR_PRIVATE_KEYS[1:senders])
+    if pending:
+        # liquidations are signed while the price moves are pending (WEB3_PROVIDER_URI must be ws://)
+        os.environ['LIQUIDATOR_PENDING_WATCHER'] = '1'
+        os.environ['LIQUIDATOR_EXECUTOR_CONTRACT'] = '1'
+
+    w3, _ = get_w3(
+        network_name=os.environ['WEB3_NETWORK_NAME'],
+        web3_provider_uri=os.environ['WEB3_PROVIDER_URI'],
+        http_pool_size=workers,
+    )
+    chain_id = w3.eth.chain_id
+    owner = w3.eth.accounts[0]
+    exchange = get_perpdex_exchange_contract(w3)
+    multicall = get_multicall(w3)
+    market_contracts = _load_markets(w3, markets)
+    if len(market_contracts) == 0:
+        raise ValueError('no PerpdexMarket*.json in PERPDEX_CONTRACT_ABI_JSON_DIRPATH')
+
+    im_ratio = _ratio(exchange, 'imRatio', 0.1)
+    mm_ratio = _ratio(exchange, 'mmRatio', 0.05)
+    plan = plan_collaterals(size, price, im_ratio, mm_ratio)
+
+    trader_addresses = _trader_addresses(seed, traders)
+    underwater_count = int(traders * underwater_ratio)
+    # trader i trades in market i % len(markets), the first underwater_count traders end up underwater
+    positions = [
+        (trader, market_contracts[i % len(market_contracts)][0].address)
+        for i, trader in enumerate(trader_addresses)
+    ]
+
+    _rpc(w3, 'evm_setAutomine', [False])
+    setup_started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda trader: _rpc(w3, 'hardhat_setBalance', [trader, hex(TRADER_BALANCE)]), trader_addresses))
+        list(pool.map(lambda trader: _rpc(w3, 'hardhat_impersonateAccount', [trader]), trader_addresses))
+
+        setup = dict(prices=_send_and_mine(w3, pool, [
+            call for market, price_feed in market_contracts
+            for call in _price_calls(w3, market, price_feed, price, pool_depth, owner)
+        ], chain_id))
+
+        if pending:
+            # LiquidationExecutor of the deployer liquidates with its own collateral, sent by the liquidator accounts
+            liquidation_executor = get_liquidation_executor(w3)
+            if liquidation_executor is None:
+                raise ValueError('no LiquidationExecutor.json in PERPDEX_CONTRACT_ABI_JSON_DIRPATH')
+            setup['executor'] = _send_and_mine(w3, pool, [
+                (exchange.functions.setAccountInfo(
+                    liquidation_executor.address,
+                    dict(collateralBalance=int(traders * size * price * 10 ** DECIMALS)),
+                    [],
+                ), owner),
+            ] + [
+                (_set_operator(w3, liquidation_executor, key), owner)
+                for key in LIQUIDATOR_PRIVATE_KEYS[:senders]
+            ], chain_id)
+
+        setup['collaterals'] = _send_and_mine(w3, pool, [
+            (exchange.functions.setAccountInfo(
+                trader,
+                dict(collateralBalance=int(
+                    (plan['underwater'] if i < underwater_count else plan['healthy']) * 10 ** DECIMALS)),
+                [],
+            ), owner)
+            for i, trader in enumerate(trader_addresses)
+        ], chain_id)
+
+        # longs of size base
+        setup['trades'] = _send_and_mine(w3, pool, [
+            (exchange.functions.trade(dict(
+                trader=trader,
+                market=market,
+                isBaseToQuote=False,
+                isExactInput=False,
+                amount=int(size * 10 ** DECIMALS),
+                oppositeAmountBound=MAX_UINT,
+                deadline=MAX_UINT,
+            )), trader)
+            for trader, market in positions
+        ], chain_id)
+    setup['seconds'] = time.monotonic() - setup_started_at
+    setup_block_number = w3.eth.block_number
+
+    price_calls = [
+        call for market, price_feed in market_contracts
+        for call in _price_calls(w3, market, price_feed, plan['moved_price'], pool_depth, owner)
+    ]
+    results = asyncio.run(_run_liquidator_until_cleared(
+        w3, exchange, multicall, positions[:underwater_count], setup_block_number, price_calls, chain_id,
+        block_time=block_time, poll_interval=poll_interval, timeout=timeout, pending=pending,
+    ))
+
+    report = dict(
+        timestamp=int(time.time()),
+        python=platform.python_version(),
+        params=params,
+        seed=seed,
+        market_count=len(market_contracts),
+        im_ratio=im_ratio,
+        mm_ratio=mm_ratio,
+        moved_price=plan['moved_price'],
+        setup=setup,
+        results=results,
+    )
+    text = json.dumps(report, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    return report
+
+
+class Cli:
+    """end-to-end load test of Liquidator against the hardhat node with synthetic traders"""
+
+    def run(self, traders: int = 2000, markets: int = None, underwater_ratio: float = 0.2, size: float = 0.01,
+            price: float = 100, pool_depth: float = 10000, block_time: float = 1.0, senders: int = 4,
+            poll_interval: float = 0.5, timeout: float = 600, workers: int = 32, seed: str = None,
+            pending: bool = False, output: str = None):
+        """create traders, push underwater_ratio of them below maintenance margin and time the liquidator.
+        pending: keep the price moves in the mempool until the liquidator has prepared liquidations for them"""
+        run_load_test(
+            traders=traders,
+            markets=markets,
+            underwater_ratio=underwater_ratio,
+            size=size,
+            price=price,
+            pool_depth=pool_depth,
+            block_time=block_time,
+            senders=senders,
+            poll_interval=poll_interval,
+            timeout=timeout,
+            workers=workers,
+            seed=seed,
+            pending=pending,
+            output=output,
+        )
+
+
+if __name__ == '__main__':
+    fire.Fire(Cli)
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import os
+import platform
+import tempfile
+import time
+from unittest import mock
+
+import fire
+from eth_account import Account
+
+from benchmarks.fake_node import EXCHANGE_ABI, EXCHANGE_ADDRESS, MULTICALL_ADDRESS, FakeChain, FakeNode
+from src.contracts.multicall import Multicall
+from src.contracts.utils import get_w3
+from src.event_indexer import PerpdexEventIndexer, get_events, get_topic_to_event_abi
+from src.liquidator import Liquidator
+from benchmarks.fake_redis import FakeRedis
+
+
+def bench_get_events(w3, node: FakeNode, repeat: int = 3) -> dict:
+    # decode throughput of one get_logs response covering all logs
+    contract = w3.eth.contract(address=EXCHANGE_ADDRESS, abi=EXCHANGE_ABI)
+    topic_to_event_abi = get_topic_to_event_abi(contract, PerpdexEventIndexer.event_names)
+    max_get_logs_results = node.max_get_logs_results
+    node.max_get_logs_results = float('inf')
+    try:
+        durations = []
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            events = get_events(contract, 0, node.chain.block_number - 1, topic_to_event_abi=topic_to_event_abi)
+            durations.append(time.perf_counter() - started_at)
+    finally:
+        node.max_get_logs_results = max_get_logs_results
+
+    best = min(durations)
+    return dict(
+        event_count=len(events),
+        seconds=best,
+        events_per_second=len(events) / best if best > 0 else None,
+    )
+
+
+def bench_backfill(w3, node: FakeNode, multicall, backfill_workers: int, get_logs_limit: int) -> dict:
+    # full backfill from block 0 with an empty cache, then again with the cache filled
+    contract = w3.eth.contract(address=EXCHANGE_ADDRESS, abi=EXCHANGE_ABI)
+    redis_client = FakeRedis()
+    results = {}
+    for name in ['cold', 'warm']:
+        indexer = PerpdexEventIndexer(
+            contract=contract,
+            redis_client=redis_client,
+            start_block_number=0,
+            get_logs_limit=get_logs_limit,
+            backfill_workers=backfill_workers,
+            checkpoint_interval=-1,
+            multicall=multicall,
+        )
+        node.reset_counts()
+        started_at = time.perf_counter()
+        indexer.fetch_market_to_traders(node.chain.block_number)
+        results[name] = dict(
+            seconds=time.perf_counter() - started_at,
+            position_count=sum(len(traders) for traders in indexer.market_to_traders.values()),
+            http_request_count=node.http_request_count,
+            rpc_request_count=dict(node.request_counts),
+        )
+    return results
+
+
+def _create_liquidator(node: FakeNode, dirpath: str, risk_engine: bool, batch_window: float) -> Liquidator:
+    # Liquidator connected to the fake node. its indexer uses an in-memory redis
+    with open(os.path.join(dirpath, 'PerpdexExchange.json'), 'w') as f:
+        json.dump(dict(address=EXCHANGE_ADDRESS, abi=EXCHANGE_ABI), f)
+    env = dict(
+        WEB3_PROVIDER_URI=node.uri,
+        USER_PRIVATE_KEY=Account.create().key.hex(),
+        PERPDEX_CONTRACT_ABI_JSON_DIRPATH=dirpath,
+        MULTICALL_ADDRESS=MULTICALL_ADDRESS,
+        LIQUIDATOR_RISK_ENGINE='1' if risk_engine else '0',
+        WEB3_BATCH_WINDOW=str(batch_window),
+        REDIS_URL='redis://localhost:6379/0',
+        INITIAL_EVENT_BLOCK_NUMBER='0',
+        EVENT_INDEXER_CHECKPOINT_INTERVAL='-1',
+    )
+    with mock.patch.dict(os.environ, env):
+        liq = Liquidator()
+    liq._perpdex_exchange_event_indexer = PerpdexEventIndexer(
+        contract=liq._perpdex_exchange,
+        redis_client=FakeRedis(),
+        start_block_number=0,
+        checkpoint_interval=-1,
+        multicall=liq._multicall,
+    )
+    return liq
+
+
+def bench_scan_cycle(node: FakeNode, risk_engine: bool, cycles: int, batch_window: float) -> dict:
+    # Liquidator._process_block per block: index, screen locally, check maintenance margin on-chain.
+    # the scheduler is not started, so unhealthy positions are queued but not liquidated
+    with tempfile.TemporaryDirectory() as dirpath:
+        liq = _create_liquidator(node, dirpath, risk_engine, batch_window)
+    indexer = liq._perpdex_exchange_event_indexer
+    indexer.fetch_market_to_traders(node.chain.block_number)
+    indexer.pop_updated_traders()
+    # sender balances are not part of the scan
+    liq._sender_stats_block_number = node.chain.block_number
+
+    # - key: block number
+    # - value: (checked traders, unhealthy traders)
+    screened = {}
+    screen_traders = liq._screen_traders
+
+    async def _screen_traders(traders, block_number):
+        unhealthy_traders = await screen_traders(traders, block_number)
+        screened[block_number] = (traders, unhealthy_traders)
+        return unhealthy_traders
+    liq._screen_traders = _screen_traders
+
+    async def _run():
+        durations = []
+        for _ in range(cycles):
+            node.chain.block_count += 1
+            node.reset_counts()
+            block_number = node.chain.block_number
+            started_at = time.perf_counter()
+            await liq._process_block(block_number)
+            checked, unhealthy = screened[block_number]
+            durations.append(dict(
+                seconds=time.perf_counter() - started_at,
+                checked_trader_count=len(checked),
+                unhealthy_trader_count=len(unhealthy),
+                http_request_count=node.http_request_count,
+            ))
+        liq._scheduler.stop()
+        return durations
+
+    try:
+        durations = asyncio.run(_run())
+    finally:
+        liq._executor.shutdown()
+
+    steady = durations[1:] if len(durations) > 1 else durations
+    return dict(
+        first=durations[0],
+        steady_seconds=sum(d['seconds'] for d in steady) / len(steady),
+        cycles=durations,
+    )
+
+
+def run_benchmarks(traders: int = 1000, markets: int = 4, blocks: int = 20000, events: int = None,
+                   latency: float = 0.005, max_get_logs_results: int = 10000, backfill_workers: int = 4,
+                   get_logs_limit: int = 1000, batch_window: float = 0.002, scan_cycles: int = 5,
+                   output: str = None) -> dict:
+    os.environ.setdefault('WEB3_NETWORK_NAME', 'benchmark')
+    params = dict(locals())
+    params.pop('output')
+
+    chain = FakeChain(traders, markets, blocks, event_count=events)
+    node = FakeNode(chain, latency=latency, max_get_logs_results=max_get_logs_results)
+    try:
+        w3, _ = get_w3('benchmark', node.uri, http_pool_size=64, batch_window=batch_window)
+        multicall = Multicall(w3, address=MULTICALL_ADDRESS)
+
+        results = dict(
+            get_events=bench_get_events(w3, node),
+            backfill=bench_backfill(w3, node, multicall, backfill_workers, get_logs_limit),
+            scan_cycle=bench_scan_cycle(node, risk_engine=False, cycles=scan_cycles, batch_window=batch_window),
+            scan_cycle_risk_engine=bench_scan_cycle(
+                node, risk_engine=True, cycles=scan_cycles, batch_window=batch_window),
+        )
+    finally:
+        node.close()
+
+    report = dict(
+        timestamp=int(time.time()),
+        python=platform.python_version(),
+        params=params,
+        results=results,
+    )
+    text = json.dumps(report, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    return report
+
+
+class Cli:
+    """offline benchmarks of the indexer and the scan loop against a fake JSON-RPC node"""
+
+    def run(self, traders: int = 1000, markets: int = 4, blocks: int = 20000, events: int = None,
+            latency: float = 0.005, max_get_logs_results: int = 10000, backfill_workers: int = 4,
+            get_logs_limit: int = 1000, batch_window: float = 0.002, scan_cycles: int = 5, output: str = None):
+        """run all benchmarks and print the results as json (or write them to output)"""
+        run_benchmarks(
+            traders=traders,
+            markets=markets,
+            blocks=blocks,
+            events=events,
+            latency=latency,
+            max_get_logs_results=max_get_logs_results,
+            backfill_workers=backfill_workers,
+            get_logs_limit=get_logs_limit,
+            batch_window=batch_window,
+            scan_cycles=scan_cycles,
+            output=output,
+        )
+
+
+if __name__ == '__main__':
+    fire.Fire(Cli)
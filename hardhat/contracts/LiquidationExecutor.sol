@@ -0,0 +1,204 @@
+// SPDX-License-Identifier: GPL-3.0-or-later
+pragma solidity 0.7.6;
+pragma abicoder v2;
+
+// subset of IPerpdexExchange
+interface IPerpdexExchangeForLiquidation {
+    struct RemoveLiquidityParams {
+        address trader;
+        address market;
+        uint256 liquidity;
+        uint256 minBase;
+        uint256 minQuote;
+        uint256 deadline;
+    }
+
+    struct TradeParams {
+        address trader;
+        address market;
+        bool isBaseToQuote;
+        bool isExactInput;
+        uint256 amount;
+        uint256 oppositeAmountBound;
+        uint256 deadline;
+    }
+
+    struct MaxTradeParams {
+        address trader;
+        address market;
+        address caller;
+        bool isBaseToQuote;
+        bool isExactInput;
+    }
+
+    function removeLiquidity(RemoveLiquidityParams calldata params) external returns (uint256 base, uint256 quote);
+
+    function trade(TradeParams calldata params) external returns (uint256 oppositeAmount);
+
+    function hasEnoughMaintenanceMargin(address trader) external view returns (bool);
+
+    function getMakerInfo(address trader, address market)
+        external
+        view
+        returns (
+            uint256 liquidity,
+            uint256 cumBaseSharePerLiquidityX96,
+            uint256 cumQuotePerLiquidityX96
+        );
+
+    function getOpenPositionShare(address trader, address market) external view returns (int256);
+
+    function maxTrade(MaxTradeParams calldata params) external view returns (uint256);
+}
+
+// Liquidates maker and taker positions of many accounts in one transaction.
+// Positions are read on-chain, so the taker liquidation sees the position converted from the removed liquidity.
+// A failing account doesn't revert the others. Each account which is not liquidated emits
+// LiquidationFailed or LiquidationSkipped (enough maintenance margin or nothing to liquidate).
+// Liquidation rewards are credited to this contract's account in the exchange, so the owner deposits
+// collateral and withdraws rewards through execute.
+contract LiquidationExecutor {
+    struct Position {
+        address trader;
+        address market;
+    }
+
+    // position is liquidated with maxTrade * reductionRate / 1e6 at most
+    uint24 public constant REDUCTION_RATE = 8e5;
+
+    IPerpdexExchangeForLiquidation public immutable exchange;
+    address public owner;
+    mapping(address => bool) public isOperator;
+
+    event LiquidationFailed(address indexed trader, address indexed market, bytes reason);
+    event LiquidationSkipped(address indexed trader, address indexed market);
+    event OwnershipTransferred(address indexed previousOwner, address indexed newOwner);
+    event OperatorChanged(address indexed operator, bool value);
+
+    modifier onlyOwner() {
+        require(msg.sender == owner, "LE_OO: caller is not the owner");
+        _;
+    }
+
+    // senders of the liquidator other than the owner
+    modifier onlyOperator() {
+        require(msg.sender == owner || isOperator[msg.sender], "LE_OOP: caller is not an operator");
+        _;
+    }
+
+    constructor(address exchangeArg) {
+        exchange = IPerpdexExchangeForLiquidation(exchangeArg);
+        owner = msg.sender;
+        emit OwnershipTransferred(address(0), msg.sender);
+    }
+
+    receive() external payable {}
+
+    // returns the number of positions liquidated (maker or taker)
+    function liquidate(Position[] calldata positions) external onlyOperator returns (uint256 liquidatedCount) {
+        for (uint256 i = 0; i < positions.length; i++) {
+            if (_liquidate(positions[i].trader, positions[i].market)) {
+                liquidatedCount++;
+            }
+        }
+    }
+
+    function execute(address target, bytes calldata data) external payable onlyOwner returns (bytes memory) {
+        (bool success, bytes memory ret) = target.call{ value: msg.value }(data);
+        require(success, "LE_E: call failed");
+        return ret;
+    }
+
+    function withdrawETH(uint256 amount) external onlyOwner {
+        (bool success, ) = owner.call{ value: amount }("");
+        require(success, "LE_WE: transfer failed");
+    }
+
+    function setOperator(address operator, bool value) external onlyOwner {
+        isOperator[operator] = value;
+        emit OperatorChanged(operator, value);
+    }
+
+    function transferOwnership(address newOwner) external onlyOwner {
+        require(newOwner != address(0), "LE_TO: zero address");
+        emit OwnershipTransferred(owner, newOwner);
+        owner = newOwner;
+    }
+
+    function _liquidate(address trader, address market) private returns (bool liquidated) {
+        if (exchange.hasEnoughMaintenanceMargin(trader)) {
+            emit LiquidationSkipped(trader, market);
+            return false;
+        }
+
+        (uint256 liquidity, , ) = exchange.getMakerInfo(trader, market);
+        if (liquidity > 0) {
+            try
+                exchange.removeLiquidity(
+                    IPerpdexExchangeForLiquidation.RemoveLiquidityParams({
+                        trader: trader,
+                        market: market,
+                        liquidity: liquidity,
+                        minBase: 0,
+                        minQuote: 0,
+                        deadline: uint256(-1)
+                    })
+                )
+            {
+                liquidated = true;
+            } catch (bytes memory reason) {
+                emit LiquidationFailed(trader, market, reason);
+                return false;
+            }
+            if (exchange.hasEnoughMaintenanceMargin(trader)) return true;
+        }
+
+        int256 share = exchange.getOpenPositionShare(trader, market);
+        if (share == 0) return _skipUnlessLiquidated(trader, market, liquidated);
+        bool isShort = share > 0;
+
+        uint256 maxAmount =
+            exchange.maxTrade(
+                IPerpdexExchangeForLiquidation.MaxTradeParams({
+                    trader: trader,
+                    market: market,
+                    caller: address(this),
+                    isBaseToQuote: isShort,
+                    isExactInput: isShort
+                })
+            );
+        uint256 amount = isShort ? uint256(share) : uint256(-share);
+        if (maxAmount <= uint256(-1) / REDUCTION_RATE) {
+            maxAmount = (maxAmount * REDUCTION_RATE) / 1e6;
+        }
+        if (amount > maxAmount) amount = maxAmount;
+        if (amount == 0) return _skipUnlessLiquidated(trader, market, liquidated);
+
+        try
+            exchange.trade(
+                IPerpdexExchangeForLiquidation.TradeParams({
+                    trader: trader,
+                    market: market,
+                    isBaseToQuote: isShort,
+                    isExactInput: isShort,
+                    amount: amount,
+                    oppositeAmountBound: isShort ? 0 : uint256(-1),
+                    deadline: uint256(-1)
+                })
+            )
+        {
+            liquidated = true;
+        } catch (bytes memory reason) {
+            emit LiquidationFailed(trader, market, reason);
+        }
+    }
+
+    function _skipUnlessLiquidated(
+        address trader,
+        address market,
+        bool liquidated
+    ) private returns (bool) {
+        if (!liquidated) emit LiquidationSkipped(trader, market);
+        return liquidated;
+    }
+}
@@ -62,19 +62,21 @@ const func: DeployFunction = async function (hre: HardhatRuntimeEnvironment) {
         log: true,
         autoMine: true,
     })
-    // market
-    const marketBTC = await _deployMarket(deploy, deployer, "BTC", exchange.address)
-    await execute(
-        "PerpdexExchange",
-        {
-            from: deployer,
-            log: true,
-            autoMine: true,
-        },
-        "setIsMarketAllowed",
-        marketBTC.address,
-        true,
-    )
+    // markets (several so that load tests spread traders across markets)
+    for (const symbol of ["BTC", "ETH", "LINK"]) {
+        const market = await _deployMarket(deploy, deployer, symbol, exchange.address)
+        await execute(
+            "PerpdexExchange",
+            {
+                from: deployer,
+                log: true,
+                autoMine: true,
+            },
+            "setIsMarketAllowed",
+            market.address,
+            true,
+        )
+    }
 };
 
 export default func;
@@ -0,0 +1,18 @@
+import { DeployFunction } from 'hardhat-deploy/types';
+import { HardhatRuntimeEnvironment } from "hardhat/types";
+
+const func: DeployFunction = async function (hre: HardhatRuntimeEnvironment) {
+    const {deployments, getNamedAccounts} = hre;
+    const {deploy} = deployments;
+    const {deployer} = await getNamedAccounts();
+
+    await deploy('Multicall', {
+        from: deployer,
+        contract: 'Multicall',
+        args: [],
+        log: true,
+        autoMine: true,
+    })
+};
+
+export default func;
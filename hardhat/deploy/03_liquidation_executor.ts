@@ -0,0 +1,19 @@
+import { DeployFunction } from 'hardhat-deploy/types';
+import { HardhatRuntimeEnvironment } from "hardhat/types";
+
+const func: DeployFunction = async function (hre: HardhatRuntimeEnvironment) {
+    const {deployments, getNamedAccounts} = hre;
+    const {deploy, get} = deployments;
+    const {deployer} = await getNamedAccounts();
+
+    const exchange = await get('PerpdexExchange')
+    await deploy('LiquidationExecutor', {
+        from: deployer,
+        contract: 'LiquidationExecutor',
+        args: [exchange.address],
+        log: true,
+        autoMine: true,
+    })
+};
+
+export default func;
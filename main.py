@@ -1,23 +1,37 @@
 # %%
 import asyncio
+import multiprocessing
+import os
 from logging import config, getLogger
 
 import fire
 import yaml
 
 from src.liquidator import Liquidator
+from src.metrics import start_http_server
+from src.shard_indexer import ShardIndexer
 
 with open("main_logger_config.yml", encoding='UTF-8') as f:
     y = yaml.safe_load(f.read())
     config.dictConfig(y)
 
 
-async def main(restart):
+async def main(restart, role='all', metrics_port=None):
+    # role: all (single process), indexer or worker (sharded mode)
     logger = getLogger(__name__)
-    logger.info('start')
+    logger.info(f'start {role=}')
+
+    # metrics survive restarts of the liquidator
+    metrics_port = os.environ.get('METRICS_PORT') if metrics_port is None else metrics_port
+    if metrics_port is not None:
+        start_http_server(int(metrics_port))
+        logger.info(f'metrics are served on port {metrics_port}')
 
     while True:
-        liq = Liquidator()
+        if role == 'indexer':
+            liq = ShardIndexer()
+        else:
+            liq = Liquidator(sharded=(role == 'worker'))
 
         liq.start()
         while liq.health_check():
@@ -31,12 +45,36 @@ async def main(restart):
     logger.warning('exit')
 
 
+def _run_process(restart, role, metrics_port):
+    asyncio.run(main(restart, role, metrics_port))
+
+
+def run_local_shards(restart, workers):
+    # one indexer and workers as local processes. metrics ports are METRICS_PORT, METRICS_PORT + 1, ...
+    metrics_port = os.environ.get('METRICS_PORT')
+    roles = ['indexer'] + ['worker'] * workers
+    processes = []
+    for i, role in enumerate(roles):
+        port = None if metrics_port is None else int(metrics_port) + i
+        process = multiprocessing.get_context('spawn').Process(
+            target=_run_process, args=(restart, role, port), name=f'{role}-{i}')
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+
+
 class Cli:
     """arbitrage bot for perpdex"""
 
-    def run(self, restart: bool = False):
-        """run arbitrage bot"""
-        asyncio.run(main(restart))
+    def run(self, restart: bool = False, role: str = 'all', workers: int = 0):
+        """run arbitrage bot. role: all, indexer or worker. workers > 0 runs one indexer and workers locally"""
+        if role not in ['all', 'indexer', 'worker']:
+            raise ValueError(f'unknown role {role}')
+        if workers > 0:
+            run_local_shards(restart, workers)
+        else:
+            asyncio.run(main(restart, role))
 
 
 if __name__ == '__main__':
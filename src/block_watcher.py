@@ -0,0 +1,130 @@
+import asyncio
+import json
+import time
+from logging import getLogger
+
+import websockets
+
+
+class BlockWatcher:
+    # Notifies new heads.
+    # - wss:// endpoint: eth_subscribe newHeads, falls back to polling when the subscription fails
+    # - otherwise: polls eth_blockNumber, adapting the interval to the observed block time
+    def __init__(
+        self,
+        w3,
+        executor,
+        web3_provider_uri: str = None,
+        min_poll_interval: float = 0.2,
+        max_poll_interval: float = 5.0,
+        logger=None,
+    ) -> None:
+        self._w3 = w3
+        self._executor = executor
+        self._web3_provider_uri = web3_provider_uri
+        self._min_poll_interval = min_poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+
+        self._head = None
+        self._last_block_number = None
+        self._last_block_time = None
+        self._block_interval = None  # exponential moving average
+
+        self._new_head: asyncio.Event = None
+        self._subscription_task: asyncio.Task = None
+        self._subscribed = False
+
+    @property
+    def block_interval(self) -> float:
+        return self._block_interval
+
+    @property
+    def head_observed_at(self) -> float:
+        # time.monotonic() when the latest head was observed
+        return self._last_block_time
+
+    def start(self):
+        self._new_head = asyncio.Event()
+        if self._web3_provider_uri is not None and self._web3_provider_uri.startswith(('wss://', 'ws://')):
+            self._subscription_task = asyncio.create_task(self._subscribe_new_heads())
+
+    def stop(self):
+        if self._subscription_task is not None:
+            self._subscription_task.cancel()
+            self._subscription_task = None
+
+    async def wait_for_new_block(self) -> int:
+        # returns a block number greater than the previously returned one
+        while True:
+            if self._head is not None and (self._last_block_number is None or self._head > self._last_block_number):
+                self._last_block_number = self._head
+                return self._head
+
+            if self._subscribed:
+                self._new_head.clear()
+                try:
+                    await asyncio.wait_for(self._new_head.wait(), timeout=self._max_poll_interval)
+                    continue
+                except asyncio.TimeoutError:
+                    # subscription may be stalled silently, double check by polling
+                    pass
+            else:
+                await asyncio.sleep(self._next_poll_interval())
+
+            block_number = await self._executor.run(lambda: self._w3.eth.block_number)
+            self._on_new_head(block_number)
+
+    def _on_new_head(self, block_number: int):
+        if self._head is not None and block_number <= self._head:
+            return
+
+        now = time.monotonic()
+        if self._head is not None and self._last_block_time is not None:
+            interval = (now - self._last_block_time) / (block_number - self._head)
+            if self._block_interval is None:
+                self._block_interval = interval
+            else:
+                self._block_interval = 0.8 * self._block_interval + 0.2 * interval
+        self._last_block_time = now
+        self._head = block_number
+        if self._new_head is not None:
+            self._new_head.set()
+
+    def _next_poll_interval(self) -> float:
+        if self._head is None or self._block_interval is None or self._last_block_time is None:
+            return self._min_poll_interval if self._head is not None else 0
+
+        # sleep until the next block is expected, then poll with the minimum interval
+        wait = self._last_block_time + self._block_interval - time.monotonic()
+        return min(max(wait, self._min_poll_interval), self._max_poll_interval)
+
+    async def _subscribe_new_heads(self):
+        while True:
+            try:
+                async with websockets.connect(self._web3_provider_uri) as ws:
+                    await ws.send(json.dumps({
+                        'jsonrpc': '2.0',
+                        'id': 1,
+                        'method': 'eth_subscribe',
+                        'params': ['newHeads'],
+                    }))
+                    response = json.loads(await ws.recv())
+                    if 'error' in response:
+                        self._logger.warning(f'newHeads subscription is not supported. fallback to polling {response=}')
+                        return
+
+                    self._subscribed = True
+                    self._logger.info('Subscribed newHeads')
+                    async for message in ws:
+                        head = json.loads(message)['params']['result']
+                        self._on_new_head(int(head['number'], 16))
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._logger.warning(f'newHeads subscription failed. fallback to polling {e=}')
+            finally:
+                self._subscribed = False
+
+            await asyncio.sleep(self._max_poll_interval)
@@ -0,0 +1,38 @@
+# subset of hardhat/contracts/LiquidationExecutor.sol
+LIQUIDATION_EXECUTOR_ABI = [
+    {
+        'name': 'liquidate',
+        'type': 'function',
+        'stateMutability': 'nonpayable',
+        'inputs': [
+            {
+                'name': 'positions',
+                'type': 'tuple[]',
+                'components': [
+                    {'name': 'trader', 'type': 'address'},
+                    {'name': 'market', 'type': 'address'},
+                ],
+            },
+        ],
+        'outputs': [{'name': 'liquidatedCount', 'type': 'uint256'}],
+    },
+    {
+        'name': 'LiquidationFailed',
+        'type': 'event',
+        'anonymous': False,
+        'inputs': [
+            {'name': 'trader', 'type': 'address', 'indexed': True},
+            {'name': 'market', 'type': 'address', 'indexed': True},
+            {'name': 'reason', 'type': 'bytes', 'indexed': False},
+        ],
+    },
+    {
+        'name': 'LiquidationSkipped',
+        'type': 'event',
+        'anonymous': False,
+        'inputs': [
+            {'name': 'trader', 'type': 'address', 'indexed': True},
+            {'name': 'market', 'type': 'address', 'indexed': True},
+        ],
+    },
+]
@@ -0,0 +1,70 @@
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+
+# subset of Multicall2 / Multicall3 (and hardhat/contracts/Multicall.sol)
+MULTICALL_ABI = [
+    {
+        'name': 'tryAggregate',
+        'type': 'function',
+        'stateMutability': 'nonpayable',
+        'inputs': [
+            {'name': 'requireSuccess', 'type': 'bool'},
+            {
+                'name': 'calls',
+                'type': 'tuple[]',
+                'components': [
+                    {'name': 'target', 'type': 'address'},
+                    {'name': 'callData', 'type': 'bytes'},
+                ],
+            },
+        ],
+        'outputs': [
+            {
+                'name': 'returnData',
+                'type': 'tuple[]',
+                'components': [
+                    {'name': 'success', 'type': 'bool'},
+                    {'name': 'returnData', 'type': 'bytes'},
+                ],
+            },
+        ],
+    },
+]
+
+
+class Multicall:
+    def __init__(self, w3, address: str, batch_size: int = 200) -> None:
+        self._w3 = w3
+        self._contract = w3.eth.contract(address=address, abi=MULTICALL_ABI)
+        self.batch_size = batch_size
+
+    @property
+    def address(self):
+        return self._contract.address
+
+    def split(self, funcs: list) -> list:
+        return [funcs[i:i + self.batch_size] for i in range(0, len(funcs), self.batch_size)]
+
+    def try_aggregate(self, funcs: list, block_identifier='latest') -> list:
+        # calls all contract functions in one eth_call.
+        # returns the decoded values in the order of funcs, None for calls that reverted
+        if len(funcs) == 0:
+            return []
+
+        calls = [(func.address, func._encode_transaction_data()) for func in funcs]
+        results = self._contract.functions.tryAggregate(False, calls).call(block_identifier=block_identifier)
+        return [
+            self._decode(func, return_data) if success else None
+            for func, (success, return_data) in zip(funcs, results)
+        ]
+
+    def _decode(self, func, return_data: bytes):
+        output_types = get_abi_output_types(func.abi)
+        output_data = self._w3.codec.decode_abi(output_types, return_data)
+        normalized_data = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, output_data)
+
+        # same as ContractFunction.call
+        if len(normalized_data) == 1:
+            return normalized_data[0]
+        else:
+            return normalized_data
@@ -1,19 +1,362 @@
+import itertools
 import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from logging import getLogger
 
+import requests
 import web3
 from eth_account import Account
 from web3 import Web3
+from web3._utils.encoding import FriendlyJsonSerde
+from web3.providers.base import JSONBaseProvider
 from web3.middleware import (construct_sign_and_send_raw_middleware,
                              geth_poa_middleware)
 
 MAX_UINT: int = int(web3.constants.MAX_INT, base=16)
 
 
-def get_w3(network_name: str, web3_provider_uri: str, user_private_key: str = None):
-    if web3_provider_uri.startswith('wss://'):
-        provider = Web3.WebsocketProvider(web3_provider_uri)
+class WebsocketProviderPool(JSONBaseProvider):
+    # NOTE: a WebsocketProvider shares one connection and can not multiplex concurrent requests,
+    # so each connection is guarded by a lock and requests from executor threads are spread over the pool
+    def __init__(self, endpoint_uri: str, pool_size: int = 1) -> None:
+        self.endpoint_uri = endpoint_uri
+        self._providers = [Web3.WebsocketProvider(endpoint_uri) for _ in range(pool_size)]
+        self._locks = [threading.Lock() for _ in range(pool_size)]
+        self._round_robin = itertools.cycle(range(pool_size))
+        super().__init__()
+
+    def __str__(self) -> str:
+        return 'WS connection pool {0} size {1}'.format(self.endpoint_uri, len(self._providers))
+
+    def make_request(self, method, params):
+        # prefer an idle connection, otherwise wait for one in round robin order
+        for provider, lock in zip(self._providers, self._locks):
+            if lock.acquire(blocking=False):
+                try:
+                    return provider.make_request(method, params)
+                finally:
+                    lock.release()
+
+        i = next(self._round_robin)
+        with self._locks[i]:
+            return self._providers[i].make_request(method, params)
+
+
+class PooledHTTPProvider(Web3.HTTPProvider):
+    # HTTPProvider with its own keep-alive session.
+    # NOTE: the default session keeps only 10 connections, connections of more concurrent requests are discarded
+    def __init__(self, endpoint_uri: str, pool_size: int = 10, timeout: float = 10) -> None:
+        super().__init__(endpoint_uri, request_kwargs={'timeout': timeout})
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def __str__(self) -> str:
+        return 'Pooled RPC connection {0}'.format(self.endpoint_uri)
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        return self.decode_rpc_response(self._post(request_data))
+
+    def _post(self, data: bytes) -> bytes:
+        response = self._session.post(self.endpoint_uri, data=data, **self.get_request_kwargs())
+        response.raise_for_status()
+        return response.content
+
+
+class _BatchedRequest:
+    def __init__(self, request_id: int, method, params) -> None:
+        self.request = {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': request_id}
+        self.done = threading.Event()
+        self.response = None
+        self.exception = None
+
+
+class BatchingHTTPProvider(PooledHTTPProvider):
+    # Merges concurrent requests from executor threads into JSON-RPC batch payloads.
+    # The first request of a batch waits batch_window seconds for others, then sends the batch.
+    # A batch reaching max_batch_size is sent immediately by the thread which filled it.
+    batch_methods = frozenset([
+        'eth_call',
+        'eth_getLogs',
+        'eth_getBalance',
+        'eth_getCode',
+        'eth_getStorageAt',
+        'eth_getTransactionReceipt',
+        'eth_getBlockByNumber',
+    ])
+
+    def __init__(self, endpoint_uri: str, pool_size: int = 10, timeout: float = 10, batch_window: float = 0.002,
+                 max_batch_size: int = 50) -> None:
+        super().__init__(endpoint_uri, pool_size=pool_size, timeout=timeout)
+        self._batch_window = batch_window
+        self._max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._queue = []
+        self._batch_request_ids = itertools.count()
+        self._batch_supported = True
+
+    def __str__(self) -> str:
+        return 'Batching RPC connection {0}'.format(self.endpoint_uri)
+
+    def make_request(self, method, params):
+        if method not in self.batch_methods or not self._batch_supported:
+            return super().make_request(method, params)
+
+        with self._lock:
+            request = _BatchedRequest(next(self._batch_request_ids), method, params)
+            self._queue.append(request)
+            is_leader = len(self._queue) == 1
+            batch = None
+            if len(self._queue) >= self._max_batch_size:
+                batch, self._queue = self._queue, []
+
+        if batch is not None:
+            self._send_batch(batch)
+        elif is_leader:
+            # wakes up early when the thread which filled the batch has sent it
+            request.done.wait(self._batch_window)
+            with self._lock:
+                # the batch may be sent already by the thread which filled it
+                if len(self._queue) > 0 and self._queue[0] is request:
+                    batch, self._queue = self._queue, []
+            if batch is not None:
+                self._send_batch(batch)
+
+        request.done.wait()
+        if request.exception is not None:
+            raise request.exception
+        return request.response
+
+    def _send_batch(self, batch: list):
+        try:
+            if len(batch) == 1:
+                responses = [self._send_single(batch[0])]
+            else:
+                raw_response = self._post(FriendlyJsonSerde().json_encode([r.request for r in batch]).encode('utf-8'))
+                decoded = self.decode_rpc_response(raw_response)
+                if not isinstance(decoded, list):
+                    # e.g. {"error": "batch is not supported"}
+                    self.logger.warning(f'JSON-RPC batch is not supported, send requests one by one {decoded=}')
+                    self._batch_supported = False
+                    responses = [self._send_single(r) for r in batch]
+                else:
+                    id_to_response = {response.get('id'): response for response in decoded}
+                    responses = [
+                        id_to_response.get(r.request['id'], {
+                            'jsonrpc': '2.0',
+                            'id': r.request['id'],
+                            'error': {'code': -32603, 'message': 'missing response in JSON-RPC batch'},
+                        })
+                        for r in batch
+                    ]
+            for r, response in zip(batch, responses):
+                r.response = response
+        except Exception as e:
+            for r in batch:
+                r.exception = e
+        finally:
+            for r in batch:
+                r.done.set()
+
+    def _send_single(self, request: _BatchedRequest):
+        return PooledHTTPProvider.make_request(self, request.request['method'], request.request['params'])
+
+
+class _EndpointStats:
+    def __init__(self) -> None:
+        self.latency = None  # exponential moving average of seconds
+        self.error_rate = 0.0  # exponential moving average, decays with time
+        self.updated_at = time.monotonic()
+        self.request_count = 0
+        self.error_count = 0
+
+
+class MultiEndpointProvider(JSONBaseProvider):
+    # Routes requests over several endpoints.
+    # - each request goes to the endpoint with the best score (latency and recent errors), failing over to the others
+    # - hedged_methods are sent to the second best endpoint too when the first one doesn't answer within hedge_delay
+    # - broadcast_methods (signed transactions) are sent to all endpoints
+    hedged_methods = frozenset(['eth_call', 'eth_estimateGas'])
+    broadcast_methods = frozenset(['eth_sendRawTransaction'])
+
+    def __init__(self, providers: list, hedge_delay: float = 0.3, ewma_alpha: float = 0.2,
+                 error_half_life: float = 30, error_penalty: float = 10, max_workers: int = 64, logger=None) -> None:
+        self._providers = providers
+        self._hedge_delay = hedge_delay
+        self._ewma_alpha = ewma_alpha
+        self._error_half_life = error_half_life
+        self._error_penalty = error_penalty
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+
+        self._stats = [_EndpointStats() for _ in providers]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=self.__class__.__name__)
+        super().__init__()
+
+    def __str__(self) -> str:
+        return 'Multi endpoint connection {0}'.format(', '.join(str(provider) for provider in self._providers))
+
+    def endpoint_stats(self) -> list:
+        with self._lock:
+            return [
+                dict(
+                    endpoint=str(provider),
+                    latency=stats.latency,
+                    error_rate=self._decayed_error_rate(stats),
+                    request_count=stats.request_count,
+                    error_count=stats.error_count,
+                )
+                for provider, stats in zip(self._providers, self._stats)
+            ]
+
+    def make_request(self, method, params):
+        if method in self.broadcast_methods:
+            return self._broadcast(method, params)
+
+        order = self._ranked()
+        if method in self.hedged_methods and len(order) > 1:
+            return self._hedged(order, method, params)
+
+        last = None
+        for i in order:
+            last = self._try_request(i, method, params)
+            if last[0]:
+                break
+        return self._unwrap(last)
+
+    def _ranked(self) -> list:
+        with self._lock:
+            scores = []
+            for stats in self._stats:
+                # not measured endpoints are tried first. an error costs like a timeout
+                latency = 0 if stats.latency is None else stats.latency
+                scores.append(latency + self._decayed_error_rate(stats) * self._error_penalty)
+        return sorted(range(len(self._providers)), key=lambda i: scores[i])
+
+    def _decayed_error_rate(self, stats: _EndpointStats) -> float:
+        return stats.error_rate * 0.5 ** ((time.monotonic() - stats.updated_at) / self._error_half_life)
+
+    def _try_request(self, i: int, method, params):
+        # returns (ok, response or exception)
+        started_at = time.monotonic()
+        try:
+            response = self._providers[i].make_request(method, params)
+            ok = not _is_endpoint_error(response)
+            ret = (ok, response)
+        except Exception as e:
+            ok = False
+            ret = (False, e)
+        self._record(i, time.monotonic() - started_at, ok)
+        if not ok:
+            self._logger.debug(f'request failed {method=} endpoint={self._providers[i]} {ret[1]=}')
+        return ret
+
+    def _record(self, i: int, latency: float, ok: bool):
+        with self._lock:
+            stats = self._stats[i]
+            stats.request_count += 1
+            if ok:
+                if stats.latency is None:
+                    stats.latency = latency
+                else:
+                    stats.latency += self._ewma_alpha * (latency - stats.latency)
+            else:
+                stats.error_count += 1
+            error_rate = self._decayed_error_rate(stats)
+            stats.error_rate = error_rate + self._ewma_alpha * ((0 if ok else 1) - error_rate)
+            stats.updated_at = time.monotonic()
+
+    def _hedged(self, order: list, method, params):
+        futures = {self._executor.submit(self._try_request, order[0], method, params)}
+        started = 1
+        last = None
+        while len(futures) > 0:
+            timeout = self._hedge_delay if started < len(order) else None
+            done, futures = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                last = future.result()
+                if last[0]:
+                    return self._unwrap(last)
+            # slow or failed, ask the next endpoint too
+            if started < len(order):
+                futures.add(self._executor.submit(self._try_request, order[started], method, params))
+                started += 1
+        return self._unwrap(last)
+
+    def _broadcast(self, method, params):
+        futures = [self._executor.submit(self._try_request, i, method, params) for i in range(len(self._providers))]
+        rets = []
+        for future in as_completed(futures):
+            rets.append(future.result())
+            if rets[-1][0] and 'error' not in rets[-1][1]:
+                # the first accepting endpoint answers, the others may answer "already known"
+                return self._unwrap(rets[-1])
+        # all failed. prefer a JSON-RPC error (e.g. nonce too low) over a connection error
+        responses = [ret for ret in rets if not isinstance(ret[1], Exception)]
+        return self._unwrap(responses[0] if len(responses) > 0 else rets[-1])
+
+    def _unwrap(self, ret):
+        ok, value = ret
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+def _is_endpoint_error(response) -> bool:
+    # errors of the endpoint rather than of the request, another endpoint may answer
+    error = response.get('error') if isinstance(response, dict) else None
+    if error is None:
+        return False
+    message = str(error.get('message', '') if isinstance(error, dict) else error).lower()
+    code = error.get('code') if isinstance(error, dict) else None
+    return code in [429, -32005] or any(s in message for s in [
+        'rate limit',
+        'too many requests',
+        'header not found',
+        'unknown block',
+        'missing trie node',
+    ])
+
+
+def _create_provider(web3_provider_uri: str, websocket_pool_size: int, http_pool_size: int, http_timeout: float,
+                     batch_window: float, max_batch_size: int):
+    if web3_provider_uri.startswith(('wss://', 'ws://')):
+        return WebsocketProviderPool(web3_provider_uri, pool_size=websocket_pool_size)
+    elif batch_window > 0:
+        return BatchingHTTPProvider(
+            web3_provider_uri,
+            pool_size=http_pool_size,
+            timeout=http_timeout,
+            batch_window=batch_window,
+            max_batch_size=max_batch_size,
+        )
+    else:
+        return PooledHTTPProvider(web3_provider_uri, pool_size=http_pool_size, timeout=http_timeout)
+
+
+def get_w3(network_name: str, web3_provider_uri: str, user_private_key: str = None, websocket_pool_size: int = 1,
+           http_pool_size: int = 10, http_timeout: float = 10, batch_window: float = 0, max_batch_size: int = 50,
+           hedge_delay: float = 0.3):
+    # web3_provider_uri: comma separated for multiple endpoints
+    providers = [
+        _create_provider(
+            uri.strip(),
+            websocket_pool_size=websocket_pool_size,
+            http_pool_size=http_pool_size,
+            http_timeout=http_timeout,
+            batch_window=batch_window,
+            max_batch_size=max_batch_size,
+        )
+        for uri in web3_provider_uri.split(',') if uri.strip() != ''
+    ]
+    if len(providers) == 1:
+        provider = providers[0]
     else:
-        provider = Web3.HTTPProvider(web3_provider_uri)
+        provider = MultiEndpointProvider(providers, hedge_delay=hedge_delay, max_workers=2 * http_pool_size)
     w3 = Web3(provider)
 
     if network_name in ['mumbai']:
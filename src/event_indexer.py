@@ -1,22 +1,39 @@
+import hashlib
+import json
 import os
-import pickle
-from collections import defaultdict
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 from types import SimpleNamespace
 
 import web3
 from redis_namespace import StrictRedis
-from web3._utils.events import get_event_data
-from web3.exceptions import MismatchedABI
+from web3._utils.events import event_abi_to_log_topic, get_event_data
+
+from src import metrics
 
 
 class EventIndexer:
+    # names of the events to fetch. None means all events of the contract
+    event_names = None
+    # names of the event args kept in the cache. None means all args
+    event_arg_names = None
+
     def __init__(
         self,
         contract: web3.contract.Contract,
         redis_client=None,
         start_block_number: int = None,
         get_logs_limit: int = None,
+        max_get_logs_range: int = None,
+        backfill_workers: int = None,
+        max_retries: int = 3,
+        cache_compression: bool = None,
+        checkpoint_interval: float = None,
+        checkpoint_path: str = None,
+        confirmations: int = None,
         logger=None,
     ) -> None:
         self._contract = contract
@@ -29,103 +46,691 @@ class EventIndexer:
 
         start_block_number = int(
             os.environ['INITIAL_EVENT_BLOCK_NUMBER']) if start_block_number is None else start_block_number
+        self._start_block_number = start_block_number
         self._last_block_number = start_block_number - 1
+
+        # blocks up to head - confirmations are final: they are cached, checkpointed and never rolled back.
+        # the newer blocks (the tip) are indexed on top of a snapshot of the confirmed state
+        # and rolled back when a reorg replaces them
+        if confirmations is None:
+            confirmations = int(os.environ.get('EVENT_INDEXER_CONFIRMATIONS', 10))
+        self._confirmations = confirmations
+        self._confirmed_block_number = self._last_block_number
+        # state at _base_block_number (the confirmed block or a few blocks below it).
+        # None while no tip event is applied, the live state is the confirmed state then
+        self._base_state = None
+        self._base_block_number = None
+        self._base_block_hash = None
+        # events applied on top of the base state
+        self._tip_events = []
+        # - key: block number (the confirmed and the last indexed one)
+        # - value: block hash seen when indexing
+        self._block_hashes = {}
+        # hashes of past confirmed blocks to find the fork point of a reorg deeper than confirmations
+        # - key: block number
+        # - value: block hash
+        self._confirmed_block_hashes = OrderedDict()
+        self._max_confirmed_block_hashes = 256
         if get_logs_limit is None:
             self._get_logs_limit = 100 if web3_network_name in ['zksync2_testnet'] else 1000
         else:
             self._get_logs_limit = get_logs_limit
 
+        # block range of one get_logs call, starting at get_logs_limit (one cached chunk).
+        # it shrinks when the provider reports result size errors and grows over sparse ranges
+        # up to max_get_logs_range, merging consecutive chunks into one call
+        if max_get_logs_range is None:
+            max_get_logs_range = int(os.environ.get('EVENT_INDEXER_MAX_GET_LOGS_RANGE', 10 * self._get_logs_limit))
+        self._max_get_logs_range = max_get_logs_range
+        self._get_logs_range = min(self._get_logs_limit, self._max_get_logs_range)
+        self._sparse_event_count = 100
+        self._sparse_streak = 0
+
+        if backfill_workers is None:
+            backfill_workers = int(os.environ.get('EVENT_INDEXER_BACKFILL_WORKERS', 4))
+        self._backfill_workers = backfill_workers
+        self._max_retries = max_retries
+        self._retry_interval = 1.0
+
         self._logger = getLogger(self.__class__.__name__) if logger is None else logger
 
-    def _fetch_events(self):
-        # NOTE: use one previous block number to avoid Bad parameter error in get_events call
-        current_block = self._contract.web3.eth.block_number - 1
-        events = []
+        self._topic_to_event_abi = get_topic_to_event_abi(contract, self.event_names, logger=self._logger)
+        # cached chunks depend on the fetched topics and the kept args
+        self._cache_digest = hashlib.sha256(
+            b''.join(sorted(self._topic_to_event_abi.keys()))
+            + repr(self.event_arg_names).encode()
+        ).hexdigest()[:8]
+        if cache_compression is None:
+            cache_compression = os.environ.get('EVENT_INDEXER_CACHE_COMPRESSION', '1') == '1'
+        self._cache_compression = cache_compression
+
+        # checkpoint of the indexed state, stored in redis or in a local file when the path is given.
+        # a negative interval disables it
+        if checkpoint_interval is None:
+            checkpoint_interval = float(os.environ.get('EVENT_INDEXER_CHECKPOINT_INTERVAL', 10))
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_path = os.environ.get(
+            'EVENT_INDEXER_CHECKPOINT_PATH') if checkpoint_path is None else checkpoint_path
+        self._checkpoint_block_number = None
+        self._checkpoint_time = None
+        self._initial_state = self._snapshot_state()
+        if self._checkpoint_interval >= 0:
+            self._load_checkpoint()
 
+    @property
+    def last_block_number(self) -> int:
+        # the last block whose events are processed
+        return self._last_block_number
+
+    def _fetch_events(self, block_number: int = None):
+        if block_number is None:
+            block_number = self._contract.web3.eth.block_number
+
+        confirmed_block = block_number - self._confirmations
+        try:
+            self._handle_reorg()
+            if confirmed_block > self._confirmed_block_number:
+                self._advance_confirmed(confirmed_block)
+        except Exception as e:
+            # block hashes are not available, retry next time
+            self._logger.warning(f'failed to read block hashes {e=}')
+            return
+
+        if self._confirmed_block_number >= confirmed_block and self._last_block_number < block_number:
+            self._index_tip(block_number)
+
+        self._save_checkpoint_if_needed()
+
+    def _index_chunks(self, current_block: int):
+        # index blocks up to current_block through the chunk cache
+        chunks = []
         to_block = self._last_block_number
         while to_block < current_block:
             from_block = _floor_int(to_block + 1, self._get_logs_limit, 1)
             to_block = min(from_block + self._get_logs_limit - 1, current_block)
-            try:
-                es = self._cached_fetch_events(
-                    from_block=from_block,
-                    to_block=to_block,
-                )
-                events += es
-            except KeyboardInterrupt as e:
-                self._logger.warning('KeyboardInterrupt')
-                raise e
+            chunks.append((from_block, to_block))
 
-            except BaseException as exception:
+        chunk_to_events = self._fetch_chunks(chunks)
+
+        # deliver events in block order. stop at the first failed chunk and retry it next time
+        for from_block, to_block in chunks:
+            events = chunk_to_events.get((from_block, to_block))
+            if events is None:
                 self._logger.warning(
-                    f'error occured while fetching events: {from_block=} {to_block=}, {current_block=}')
-                self._logger.warning(f'{exception=}')
+                    f'stop indexing at failed chunk: {from_block=} {to_block=}, {current_block=}')
+                break
+
+            for event in events:
+                if self._last_block_number < event['blockNumber']:
+                    self._process_event(event)
+            self._last_block_number = to_block
+
+    def _advance_confirmed(self, confirmed_block: int):
+        # moves the confirmed block forward to confirmed_block, keeping the tip blocks above it
+        block_hash = self._get_block_hash(confirmed_block)
+        last_block_number = self._last_block_number
+        last_block_hash = self._last_block_hash
+        if last_block_number >= confirmed_block:
+            # already indexed (and verified) as tip blocks, their events stay applied
+            self._confirmed_block_number = confirmed_block
+        else:
+            self._index_chunks(confirmed_block)
+            self._on_events_processed()
+            if self._last_block_number != confirmed_block:
+                block_hash = self._try_get_block_hash(self._last_block_number)
+            self._confirmed_block_number = self._last_block_number
+
+        self._block_hashes = {self._confirmed_block_number: block_hash}
+        if block_hash is not None:
+            self._confirmed_block_hashes[self._confirmed_block_number] = block_hash
+            while len(self._confirmed_block_hashes) > self._max_confirmed_block_hashes:
+                self._confirmed_block_hashes.popitem(last=False)
+        if last_block_number > self._confirmed_block_number:
+            self._block_hashes[last_block_number] = last_block_hash
+        self._advance_base()
+
+    def _advance_base(self):
+        # moves the base state up to the confirmed block.
+        # the confirmed tip events are replayed on the base state at most once per confirmations blocks
+        if self._base_state is None:
+            return
+        confirmed_events = [
+            event for event in self._tip_events if event['blockNumber'] <= self._confirmed_block_number]
+        if len(confirmed_events) == len(self._tip_events):
+            # no tip event above the confirmed block, the live state is the confirmed state
+            self._base_state = None
+            self._tip_events = []
+            return
+        if self._confirmed_block_number - self._base_block_number < max(self._confirmations, 1):
+            return
+
+        live_state = self._snapshot_state()
+        self._restore_state(self._base_state)
+        self._replay_events(confirmed_events)
+        self._base_state = self._snapshot_state()
+        self._restore_state(live_state)
+        self._base_block_number = self._confirmed_block_number
+        self._base_block_hash = self._block_hashes.get(self._confirmed_block_number)
+        self._tip_events = self._tip_events[len(confirmed_events):]
 
+    def _index_tip(self, block_number: int):
+        # NOTE: the hash is read before the logs. when a reorg happens in between,
+        # the hash check of the next call rolls back these events
+        from_block = self._last_block_number + 1
+        try:
+            block_hash = self._get_block_hash(block_number)
+            events = self._get_events_adaptive(from_block, block_number)
+        except Exception as e:
+            self._logger.warning(f'failed to index tip blocks, retry next time {from_block=} {block_number=} {e=}')
+            return
+
+        self._last_block_number = block_number
+        self._apply_tip_events(events)
+        self._block_hashes = {
+            self._confirmed_block_number: self._block_hashes.get(self._confirmed_block_number),
+            block_number: block_hash,
+        }
+
+    def _apply_tip_events(self, events: list):
+        if len(events) == 0:
+            return
+        # the base state is kept only while tip events are applied on top of it
+        if self._base_state is None:
+            self._base_state = self._snapshot_state()
+            self._base_block_number = self._confirmed_block_number
+            self._base_block_hash = self._block_hashes.get(self._confirmed_block_number)
         for event in events:
-            if self._last_block_number < event['blockNumber']:
-                self._process_event(event)
-
-        self._last_block_number = to_block
-
-    def _cached_fetch_events(self, from_block: int, to_block: int):
-        cache_enabled = to_block - from_block + 1 == self._get_logs_limit
-        if not cache_enabled:
-            self._logger.debug(
-                'EventIndexer._cached_fetch_events from_block {} to_block {} cache disabled'.format(from_block,
-                                                                                                    to_block))
-            return get_events(
-                self._contract,
-                from_block=from_block,
-                to_block=to_block,
-                logger=self._logger,
-            )
-
-        key = 'event_indexer:{}:{}'.format(from_block, to_block)
-        value = self._redis_client.get(key)
-        if value is None:
-            self._logger.debug(
-                'EventIndexer._cached_fetch_events from_block {} to_block {} cache miss'.format(from_block, to_block))
-            value = get_events(
-                self._contract,
-                from_block=from_block,
-                to_block=to_block,
-                logger=self._logger,
-            )
-            self._redis_client.set(key, pickle.dumps(value))
+            self._process_event(event)
+        self._tip_events += events
+        self._on_events_processed()
+
+    @property
+    def _last_block_hash(self):
+        return self._block_hashes.get(self._last_block_number)
+
+    def _handle_reorg(self):
+        # the last indexed block is still canonical when its hash is unchanged, and so are its ancestors
+        last_block_hash = self._last_block_hash
+        if last_block_hash is None or self._get_block_hash(self._last_block_number) == last_block_hash:
+            return
+
+        confirmed_block_hash = self._block_hashes.get(self._confirmed_block_number)
+        if (self._last_block_number > self._confirmed_block_number
+                and (confirmed_block_hash is None
+                     or self._get_block_hash(self._confirmed_block_number) == confirmed_block_hash)):
+            self._logger.warning(
+                f'reorg in the tip, roll back to {self._confirmed_block_number=} from {self._last_block_number=}')
+            metrics.INDEXER_REORGS.inc(depth='tip')
+            self._rollback_tip()
+            return
+
+        # deeper than the confirmations. the confirmed state can't be rolled back, index again from the start
+        fork_block_number = self._find_fork_block_number()
+        self._logger.error(
+            f'reorg deeper than {self._confirmations=}, {fork_block_number=}, {self._confirmed_block_number=}. '
+            'index again from the start block')
+        metrics.INDEXER_REORGS.inc(depth='deep')
+        rolled_back_events = self._tip_events
+        self._invalidate_cached_chunks(fork_block_number + 1, self._last_block_number)
+        self._restore_state(self._initial_state)
+        self._on_rollback(rolled_back_events)
+        self._last_block_number = self._start_block_number - 1
+        self._confirmed_block_number = self._last_block_number
+        self._base_state = None
+        self._tip_events = []
+        self._block_hashes = {}
+        self._confirmed_block_hashes = OrderedDict()
+        self._checkpoint_block_number = None
+
+    def _rollback_tip(self):
+        rolled_back_events = [
+            event for event in self._tip_events if event['blockNumber'] > self._confirmed_block_number]
+        self._last_block_number = self._confirmed_block_number
+        if self._base_state is not None:
+            self._restore_state(self._base_state)
+            self._replay_events(self._tip_events[:len(self._tip_events) - len(rolled_back_events)])
+            self._on_events_processed()
+        self._on_rollback(rolled_back_events)
+        self._base_state = None
+        self._tip_events = []
+        self._block_hashes = {self._confirmed_block_number: self._block_hashes.get(self._confirmed_block_number)}
+
+    def _find_fork_block_number(self) -> int:
+        # the newest recorded confirmed block which is still canonical
+        for block_number, block_hash in reversed(self._confirmed_block_hashes.items()):
+            if self._get_block_hash(block_number) == block_hash:
+                return block_number
+        return self._start_block_number - 1
+
+    def _get_block_hash(self, block_number: int) -> str:
+        return self._contract.web3.eth.get_block(block_number)['hash'].hex()
+
+    def _try_get_block_hash(self, block_number: int) -> str:
+        # None (not verified) on error
+        try:
+            return self._get_block_hash(block_number)
+        except Exception as e:
+            self._logger.warning(f'failed to read block hash {block_number=} {e=}')
+            return
+
+    def _fetch_chunks(self, chunks: list) -> dict:
+        # - key: (from_block, to_block)
+        # - value: events
+        chunk_to_events = self._load_cached_chunks(chunks)
+        pending = [chunk for chunk in chunks if chunk not in chunk_to_events]
+
+        if len(pending) == 0:
+            return chunk_to_events
+
+        attempts = defaultdict(int)
+        with ThreadPoolExecutor(max_workers=self._backfill_workers) as executor:
+            while len(pending) > 0:
+                groups = self._group_chunks(pending)
+                pending = []
+                futures = [executor.submit(self._fetch_chunk_group, group) for group in groups]
+                for group, future in zip(groups, futures):
+                    try:
+                        chunk_to_events.update(future.result())
+                    except KeyboardInterrupt as e:
+                        self._logger.warning('KeyboardInterrupt')
+                        raise e
+
+                    except BaseException as exception:
+                        self._logger.warning(
+                            f'error occured while fetching events: from_block={group[0][0]} to_block={group[-1][1]}')
+                        self._logger.warning(f'{exception=}')
+                        for chunk in group:
+                            attempts[chunk] += 1
+                            if attempts[chunk] < self._max_retries:
+                                pending.append(chunk)
+                pending.sort()
+                if len(pending) > 0:
+                    time.sleep(self._retry_interval)
+
+        return chunk_to_events
+
+    def _group_chunks(self, chunks: list) -> list:
+        # merge consecutive chunks into one get_logs range while the range is wide enough
+        groups = []
+        for chunk in chunks:
+            if (len(groups) > 0
+                    and groups[-1][-1][1] + 1 == chunk[0]
+                    and chunk[1] - groups[-1][0][0] + 1 <= self._get_logs_range):
+                groups[-1].append(chunk)
+            else:
+                groups.append([chunk])
+        return groups
+
+    def _fetch_chunk_group(self, group: list) -> dict:
+        events = self._get_events_adaptive(group[0][0], group[-1][1])
+
+        chunk_to_events = {}
+        for from_block, to_block in group:
+            chunk_to_events[(from_block, to_block)] = [
+                e for e in events if from_block <= e['blockNumber'] <= to_block]
+        self._store_cached_chunks(chunk_to_events)
+        return chunk_to_events
+
+    def _get_events_adaptive(self, from_block: int, to_block: int) -> list:
+        events = []
+        block = from_block
+        while block <= to_block:
+            end = min(block + self._get_logs_range - 1, to_block)
+            try:
+                es = get_events(
+                    self._contract,
+                    from_block=block,
+                    to_block=end,
+                    logger=self._logger,
+                    topic_to_event_abi=self._topic_to_event_abi,
+                )
+            except Exception as e:
+                if end == block or not _is_result_size_error(e):
+                    raise
+                self._get_logs_range = max(1, (end - block + 1) // 2)
+                self._sparse_streak = 0
+                self._logger.debug(f'shrink get_logs range to {self._get_logs_range} {e=}')
+                continue
+
+            # grow after several sparse ranges in a row to avoid oscillation
+            self._sparse_streak = self._sparse_streak + 1 if len(es) < self._sparse_event_count else 0
+            if self._sparse_streak >= 4 and self._get_logs_range < self._max_get_logs_range:
+                self._get_logs_range = min(self._get_logs_range * 2, self._max_get_logs_range)
+                self._sparse_streak = 0
+                self._logger.debug(f'grow get_logs range to {self._get_logs_range}')
+            events += [self._compact_event(e) for e in es]
+            block = end + 1
+        return events
+
+    def _cache_enabled(self, from_block: int, to_block: int) -> bool:
+        return to_block - from_block + 1 == self._get_logs_limit
+
+    def _cache_key(self, from_block: int, to_block: int) -> str:
+        return 'event_indexer:v{}:{}:{}:{}'.format(_CACHE_FORMAT_VERSION, self._cache_digest, from_block, to_block)
+
+    def _load_cached_chunks(self, chunks: list) -> dict:
+        # returns events of the cache hit chunks
+        chunks = [chunk for chunk in chunks if self._cache_enabled(*chunk)]
+        chunk_to_events = {}
+        for i in range(0, len(chunks), _CACHE_MGET_SIZE):
+            batch = chunks[i:i + _CACHE_MGET_SIZE]
+            values = self._redis_client.mget([self._cache_key(*chunk) for chunk in batch])
+            for chunk, value in zip(batch, values):
+                if value is None:
+                    continue
+                try:
+                    chunk_to_events[chunk] = _decode_events(value)
+                except Exception as e:
+                    self._logger.warning(f'ignore broken cache {chunk=} {e=}')
+
+        metrics.EVENT_CACHE_REQUESTS.inc(len(chunk_to_events), result='hit')
+        metrics.EVENT_CACHE_REQUESTS.inc(len(chunks) - len(chunk_to_events), result='miss')
+        self._logger.debug(
+            'EventIndexer._load_cached_chunks {} hit / {} chunks'.format(len(chunk_to_events), len(chunks)))
+        return chunk_to_events
+
+    def _store_cached_chunks(self, chunk_to_events: dict):
+        pipeline = self._redis_client.pipeline(transaction=False)
+        for chunk, events in chunk_to_events.items():
+            if self._cache_enabled(*chunk):
+                pipeline.set(self._cache_key(*chunk), _encode_events(events, self._cache_compression))
+        pipeline.execute()
+
+    def _invalidate_cached_chunks(self, from_block: int, to_block: int):
+        # deletes cached chunks overlapping the blocks
+        keys = []
+        block = _floor_int(max(from_block, self._start_block_number), self._get_logs_limit, 1)
+        while block <= to_block:
+            keys.append(self._cache_key(block, block + self._get_logs_limit - 1))
+            block += self._get_logs_limit
+        for i in range(0, len(keys), _CACHE_MGET_SIZE):
+            self._redis_client.delete(*keys[i:i + _CACHE_MGET_SIZE])
+        self._logger.info(f'invalidated {len(keys)} cached chunks {from_block=} {to_block=}')
+
+    def _compact_event(self, event) -> dict:
+        # keep the fields used by the indexer only
+        args = event['args']
+        if self.event_arg_names is not None:
+            args = {name: args[name] for name in self.event_arg_names if name in args}
+        return dict(
+            event=event['event'],
+            blockNumber=event['blockNumber'],
+            logIndex=event['logIndex'],
+            args={name: _to_json_value(value) for name, value in args.items()},
+        )
+
+    def _checkpoint_key(self) -> str:
+        return 'checkpoint:{}:{}'.format(self._contract.address, self._cache_digest)
+
+    def _save_checkpoint_if_needed(self):
+        if self._checkpoint_interval < 0 or self._checkpoint_block_number == self._final_block_number:
+            return
+        if self._checkpoint_time is not None and time.monotonic() - self._checkpoint_time < self._checkpoint_interval:
+            return
+
+        try:
+            self._save_checkpoint()
+        except Exception as e:
+            self._logger.warning(f'failed to save checkpoint {e=}')
+
+    @property
+    def _final_block_number(self) -> int:
+        # the block of the checkpointed state
+        return self._confirmed_block_number if self._base_state is None else self._base_block_number
+
+    def _save_checkpoint(self):
+        # only the confirmed state, the tip may be rolled back
+        if self._base_state is None:
+            block_hash = self._block_hashes.get(self._confirmed_block_number)
+            state = self._snapshot_state()
         else:
-            self._logger.debug(
-                'EventIndexer._cached_fetch_events from_block {} to_block {} cache hit'.format(from_block, to_block))
-            value = pickle.loads(value)
+            block_hash = self._base_block_hash
+            state = self._base_state
+        block_number = self._final_block_number
+        value = json.dumps(dict(
+            version=_CHECKPOINT_VERSION,
+            start_block_number=self._start_block_number,
+            last_block_number=block_number,
+            last_block_hash=block_hash,
+            state=state,
+        ), separators=(',', ':'))
+
+        if self._checkpoint_path is None:
+            self._redis_client.set(self._checkpoint_key(), value)
+        else:
+            tmp_path = self._checkpoint_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(value)
+            os.replace(tmp_path, self._checkpoint_path)
+
+        self._checkpoint_block_number = block_number
+        self._checkpoint_time = time.monotonic()
+        self._logger.debug(f'checkpoint saved {block_number=}')
 
-        return value
+    def _load_checkpoint(self):
+        try:
+            if self._checkpoint_path is None:
+                value = self._redis_client.get(self._checkpoint_key())
+            elif os.path.exists(self._checkpoint_path):
+                with open(self._checkpoint_path) as f:
+                    value = f.read()
+            else:
+                value = None
+            if value is None:
+                return
+            checkpoint = json.loads(value)
+        except Exception as e:
+            self._logger.warning(f'failed to load checkpoint {e=}')
+            return
+
+        if (checkpoint.get('version') != _CHECKPOINT_VERSION
+                or checkpoint['start_block_number'] != self._start_block_number):
+            self._logger.info('ignore checkpoint of another version or start block')
+            return
+
+        self._restore_state(checkpoint['state'])
+        self._last_block_number = checkpoint['last_block_number']
+        self._confirmed_block_number = self._last_block_number
+        self._checkpoint_block_number = self._last_block_number
+        # a reorg while stopped is found by the hash check of the next fetch
+        if checkpoint.get('last_block_hash') is not None:
+            self._block_hashes = {self._last_block_number: checkpoint['last_block_hash']}
+        self._logger.info(f'resume from checkpoint {self._last_block_number=}')
+
+    def _on_events_processed(self):
+        pass
+
+    def _on_rollback(self, events: list):
+        # called with the events of the rolled back blocks
+        pass
+
+    def _replay_events(self, events: list):
+        # applies events which were already processed once to a restored state
+        for event in events:
+            self._process_event(event)
+
+    def _snapshot_state(self) -> dict:
+        # json serializable state of the indexer
+        return {}
+
+    def _restore_state(self, state: dict):
+        pass
 
     def _process_event(self, event: web3.datastructures.AttributeDict):
         raise NotImplementedError
 
 
 class PerpdexEventIndexer(EventIndexer):
-    # - key: market address
-    # - value: set of trader address
-    market_to_traders = defaultdict(set)
+    # events and args consumed by _process_event
+    event_names = ('PositionChanged', 'AddLiquidity', 'RemoveLiquidity', 'PositionLiquidated', 'Deposited', 'Withdrawn')
+    event_arg_names = ('trader', 'market')
 
-    def fetch_market_to_traders(self):
-        self._fetch_events()
+    def __init__(self, *args, multicall=None, **kwargs) -> None:
+        # open exposure
+        # - key: market address
+        # - value: set of trader address
+        self.market_to_traders = defaultdict(set)
+        # (trader, market) which may have been closed by the processed events
+        self._closing_candidates = set()
+        # traders whose account changed since the last pop_updated_traders
+        self._updated_traders = set()
+        self._multicall = multicall
+
+        super().__init__(*args, **kwargs)
+
+    def fetch_market_to_traders(self, block_number: int = None):
+        self._fetch_events(block_number)
         return self.market_to_traders
 
+    def pop_updated_traders(self) -> set:
+        updated_traders = self._updated_traders
+        self._updated_traders = set()
+        return updated_traders
+
+    def _on_events_processed(self):
+        if len(self._closing_candidates) == 0:
+            return
+        try:
+            self._remove_closed_positions()
+        except Exception as e:
+            self._logger.warning(f'failed to check closed positions, retry next time {e=}')
+
+    def _remove_closed_positions(self):
+        candidates = sorted(
+            (trader, market) for trader, market in self._closing_candidates
+            if trader in self.market_to_traders.get(market, ())
+        )
+        funcs = []
+        for trader, market in candidates:
+            funcs.append(self._contract.functions.getPositionShare(trader, market))
+            funcs.append(self._contract.functions.getMakerInfo(trader, market))
+
+        # read at the block being applied, so that a close in a later (unconfirmed) block
+        # doesn't remove the position from the confirmed state
+        block_number = self._last_block_number
+        if self._multicall is None:
+            rets = [func.call(block_identifier=block_number) for func in funcs]
+        else:
+            rets = [
+                ret for batch in self._multicall.split(funcs)
+                for ret in self._multicall.try_aggregate(batch, block_identifier=block_number)
+            ]
+
+        for i, (trader, market) in enumerate(candidates):
+            position_share, maker_info = rets[2 * i], rets[2 * i + 1]
+            if position_share is None or maker_info is None:
+                continue
+            if position_share == 0 and maker_info[0] == 0:
+                self._logger.debug(f'position closed {trader=} {market=}')
+                self.market_to_traders[market].discard(trader)
+                if len(self.market_to_traders[market]) == 0:
+                    del self.market_to_traders[market]
+
+        self._closing_candidates.clear()
+
+    def _replay_events(self, events: list):
+        # the accounts were reported when the events were processed first
+        updated_traders = set(self._updated_traders)
+        super()._replay_events(events)
+        self._updated_traders = updated_traders
+
+    def _on_rollback(self, events: list):
+        # accounts of the rolled back blocks are checked again
+        for event in events:
+            if 'trader' in event['args']:
+                self._updated_traders.add(event['args']['trader'])
+
+    def _snapshot_state(self) -> dict:
+        return dict(
+            market_to_traders={market: sorted(traders) for market, traders in self.market_to_traders.items()},
+            closing_candidates=sorted(self._closing_candidates),
+        )
+
+    def _restore_state(self, state: dict):
+        self.market_to_traders = defaultdict(set, {
+            market: set(traders) for market, traders in state['market_to_traders'].items()
+        })
+        self._closing_candidates = set(tuple(c) for c in state.get('closing_candidates', []))
+
     def _process_event(self, event: web3.datastructures.AttributeDict):
         event_name = event['event']
         args = event['args']
         self._logger.debug(f'{event_name=} {args=}')
+        if 'trader' in args:
+            self._updated_traders.add(args['trader'])
+
         if event_name == 'PositionChanged':
+            # the position may be opened, reduced or closed
             self.market_to_traders[args['market']].add(args['trader'])
+            self._closing_candidates.add((args['trader'], args['market']))
         elif event_name == 'AddLiquidity':
             self.market_to_traders[args['market']].add(args['trader'])
+        elif event_name in ['RemoveLiquidity', 'PositionLiquidated']:
+            self._closing_candidates.add((args['trader'], args['market']))
+
+
+_CHECKPOINT_VERSION = 2
+_CACHE_FORMAT_VERSION = 3
+_CACHE_MGET_SIZE = 1000
+
+
+def _to_json_value(value):
+    if isinstance(value, bytes):
+        return '0x' + value.hex()
+    if isinstance(value, (list, tuple)):
+        return [_to_json_value(v) for v in value]
+    return value
+
+
+def _encode_events(events: list, compression: bool) -> bytes:
+    # 1 byte codec (j: json, z: zlib compressed json) + versioned json body
+    body = json.dumps(dict(
+        v=_CACHE_FORMAT_VERSION,
+        events=[[e['event'], e['blockNumber'], e['logIndex'], e['args']] for e in events],
+    ), separators=(',', ':')).encode()
+    if compression:
+        return b'z' + zlib.compress(body)
+    return b'j' + body
+
+
+def _decode_events(value: bytes) -> list:
+    codec, body = value[:1], value[1:]
+    if codec == b'z':
+        body = zlib.decompress(body)
+    elif codec != b'j':
+        raise ValueError(f'unknown cache codec {codec}')
+
+    data = json.loads(body)
+    if data['v'] != _CACHE_FORMAT_VERSION:
+        raise ValueError(f'unknown cache version {data["v"]}')
+    return [
+        dict(event=event, blockNumber=block_number, logIndex=log_index, args=args)
+        for event, block_number, log_index, args in data['events']
+    ]
 
 
 def _floor_int(a, b, remainder):
     return ((a - remainder) // b) * b + remainder
 
 
+def _is_result_size_error(exception) -> bool:
+    # providers report too large get_logs results differently
+    # e.g. {'code': -32005, 'message': 'query returned more than 10000 results'}
+    # -32005 is also the code of rate limit errors, which must not shrink the range
+    message = str(exception).lower()
+    if 'rate limit' in message or 'too many requests' in message or 'request rate' in message:
+        return False
+    return any(keyword in message for keyword in [
+        'query returned more than',
+        'response size',
+        'block range',
+        'too many results',
+        'too many logs',
+        'result set too large',
+        'range is too large',
+    ])
+
+
 def create_null_logger():
     def _null_logger_func(x):
         pass
@@ -133,34 +738,58 @@ def create_null_logger():
         debug=_null_logger_func,
         error=_null_logger_func,
         warn=_null_logger_func,
+        warning=_null_logger_func,
         info=_null_logger_func,
     )
 
 
-def get_events(contract, from_block, to_block, logger=None):
+def get_topic_to_event_abi(contract, event_names=None, logger=None) -> dict:
+    # - key: topic0 (keccak of the event signature)
+    # - value: event abi
+    logger = create_null_logger() if logger is None else logger
+
+    abis = {abi['name']: abi for abi in contract.abi if abi['type'] == 'event' and not abi.get('anonymous', False)}
+    if event_names is None:
+        event_names = abis.keys()
+
+    topic_to_event_abi = {}
+    for event_name in event_names:
+        if event_name not in abis:
+            logger.warning(f'event {event_name} is not found in abi of {contract.address=}')
+            continue
+        topic_to_event_abi[event_abi_to_log_topic(abis[event_name])] = abis[event_name]
+    return topic_to_event_abi
+
+
+def get_events(contract, from_block, to_block, logger=None, topic_to_event_abi=None):
     logger = create_null_logger() if logger is None else logger
     logger.debug(f'get_events of {contract.address=} {from_block}~{to_block}')
 
+    if topic_to_event_abi is None:
+        topic_to_event_abi = get_topic_to_event_abi(contract, logger=logger)
+
+    if len(topic_to_event_abi) == 0:
+        return []
+
     w3 = contract.web3
     logs = w3.eth.get_logs({
         "fromBlock": from_block,
         "toBlock": to_block,
         "address": contract.address,
-        "topics": []
+        # match any of topic0
+        "topics": [[w3.toHex(topic) for topic in topic_to_event_abi.keys()]],
     })
 
     events = []
 
     for log in logs:
-        for contract_event in contract.events:
-            abi = contract_event._get_event_abi()
-
-            try:
-                ev = get_event_data(w3.codec, abi, log)
-                events.append(ev)
-            except MismatchedABI:
-                ...
+        if len(log['topics']) == 0:
+            continue
+        abi = topic_to_event_abi.get(bytes(log['topics'][0]))
+        if abi is None:
+            continue
+        events.append(get_event_data(w3.codec, abi, log))
 
-    events.sort(key=lambda x: x['blockNumber'])
+    events.sort(key=lambda x: (x['blockNumber'], x['logIndex']))
 
     return events
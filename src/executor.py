@@ -0,0 +1,26 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncExecutor:
+    # web3 (v5) contract calls are blocking, so they are run in a bounded thread pool
+    # and awaited from the event loop. The pool size caps the number of in-flight RPCs.
+    def __init__(self, max_workers: int = None, thread_name_prefix: str = 'AsyncExecutor') -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix=thread_name_prefix,
+        )
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            functools.partial(func, *args, **kwargs),
+        )
+
+    async def call(self, contract_func, **kwargs):
+        return await self.run(contract_func.call, **kwargs)
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait)
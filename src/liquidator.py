@@ -1,32 +1,171 @@
 import asyncio
+import contextvars
 import glob
 import json
 import os
+import time
 from logging import getLogger
 
 import web3
+from eth_account import Account
+from web3.logs import DISCARD
 
+from src import metrics
+from src.block_watcher import BlockWatcher
+from src.contracts.liquidation_executor import LIQUIDATION_EXECUTOR_ABI
+from src.contracts.multicall import Multicall
 from src.contracts.utils import MAX_UINT, get_contract_from_abi_json, get_w3
 from src.event_indexer import PerpdexEventIndexer
+from src.executor import AsyncExecutor
+from src.pending_watcher import PendingTransactionWatcher, PriceImpactSimulator
+from src.read_cache import BlockReadCache, contract_call_key
+from src.risk_engine import RiskEngine
+from src.scheduler import LiquidationScheduler
+from src.sender_pool import SenderPool
+from src.sharding import ShardCoordinator, SharedTraderSet, get_shard_redis_client
+
+
+# time.monotonic() when the position of the running liquidation job was found unhealthy
+_detected_at = contextvars.ContextVar('detected_at', default=None)
 
 
 class Liquidator:
-    def __init__(self, logger=None) -> None:
+    # sharded: worker of the sharded mode. traders come from the indexer process (ShardIndexer) through redis
+    # and the worker scans only the ones it owns on the hash ring of the live workers
+    def __init__(self, logger=None, sharded: bool = False) -> None:
         self._logger = getLogger(self.__class__.__name__) if logger is None else logger
 
+        max_workers = int(os.environ.get('LIQUIDATOR_MAX_WORKERS', 64))
         self._w3, self._tx_options = get_w3(
             network_name=os.environ['WEB3_NETWORK_NAME'],
             web3_provider_uri=os.environ['WEB3_PROVIDER_URI'],
             user_private_key=os.environ['USER_PRIVATE_KEY'],
+            websocket_pool_size=int(os.environ.get('WEB3_WEBSOCKET_POOL_SIZE', 8)),
+            # one connection per executor thread
+            http_pool_size=max_workers,
+            http_timeout=float(os.environ.get('WEB3_HTTP_TIMEOUT', 10)),
+            batch_window=float(os.environ.get('WEB3_BATCH_WINDOW', 0.002)),
+            max_batch_size=int(os.environ.get('WEB3_MAX_BATCH_SIZE', 50)),
+            hedge_delay=float(os.environ.get('WEB3_HEDGE_DELAY', 0.3)),
         )
 
         self._perpdex_exchange = get_perpdex_exchange_contract(self._w3)
-        self._perpdex_exchange_event_indexer = PerpdexEventIndexer(
-            contract=self._perpdex_exchange
+        self._multicall = get_multicall(self._w3)
+        if self._multicall is None:
+            self._logger.warning('Multicall is not available. Maintenance margin is checked per trader')
+        self._shard = None
+        if sharded:
+            redis_client = get_shard_redis_client()
+            self._shard = ShardCoordinator(
+                redis_client,
+                worker_id=os.environ.get('SHARD_WORKER_ID'),
+                heartbeat_ttl=float(os.environ.get('SHARD_HEARTBEAT_TTL', 10)),
+                claim_ttl=float(os.environ.get('SHARD_CLAIM_TTL', 60)),
+            )
+            self._perpdex_exchange_event_indexer = SharedTraderSet(redis_client)
+        else:
+            self._perpdex_exchange_event_indexer = PerpdexEventIndexer(
+                contract=self._perpdex_exchange,
+                multicall=self._multicall,
+            )
+
+        # local margin model which sends only near-threshold accounts to the on-chain check
+        self._risk_engine = None
+        if self._multicall is not None and os.environ.get('LIQUIDATOR_RISK_ENGINE', '1') == '1':
+            self._risk_engine = RiskEngine(
+                exchange_contract=self._perpdex_exchange,
+                multicall=self._multicall,
+                safety_band=float(os.environ.get('RISK_ENGINE_SAFETY_BAND', 0.2)),
+                max_age_blocks=int(os.environ.get('RISK_ENGINE_MAX_AGE_BLOCKS', 300)),
+                price_threshold=float(os.environ.get('RISK_ENGINE_PRICE_THRESHOLD', 0.001)),
+            )
+
+        # contract reads at the scanned block, shared by the liquidation jobs until the next block
+        self._read_cache = BlockReadCache()
+        # traders whose maintenance margin check failed in the last block
+        self._unscreened_traders = set()
+
+        # bounded thread pool for blocking web3 calls
+        self._executor = AsyncExecutor(
+            max_workers=max_workers,
+            thread_name_prefix=self.__class__.__name__,
+        )
+
+        # senders with local nonce allocation so that several liquidations can be outstanding at once
+        self._sender_pool = SenderPool(
+            w3=self._w3,
+            accounts=[Account().from_key(key) for key in get_user_private_keys()],
+            executor=self._executor,
+            receipt_timeout=float(os.environ.get('LIQUIDATOR_RECEIPT_TIMEOUT', 30)),
+            poll_interval=float(os.environ.get('LIQUIDATOR_RECEIPT_POLL_INTERVAL', 0.5)),
+            max_replacements=int(os.environ.get('LIQUIDATOR_MAX_REPLACEMENTS', 3)),
         )
+        self._sender_stats_interval = int(os.environ.get('LIQUIDATOR_SENDER_STATS_INTERVAL', 100))
+        self._sender_stats_block_number = None
+
+        # margin on top of the estimated gas, state may change until the transaction is mined
+        self._gas_buffer = float(os.environ.get('LIQUIDATOR_GAS_BUFFER', 1.2))
+
+        # optional contract which liquidates maker and taker positions of many accounts in one transaction
+        self._liquidation_executor = None
+        if os.environ.get('LIQUIDATOR_EXECUTOR_CONTRACT', '0') == '1':
+            self._liquidation_executor = get_liquidation_executor(self._w3)
+            if self._liquidation_executor is None:
+                self._logger.warning('LiquidationExecutor is not available. Liquidate positions one by one')
+        self._liquidation_batch_size = int(os.environ.get('LIQUIDATION_EXECUTOR_BATCH_SIZE', 20))
+        self._liquidation_batch_window = float(os.environ.get('LIQUIDATION_EXECUTOR_BATCH_WINDOW', 0.05))
+        self._liquidation_batch = []  # list of ((trader, market), future)
+        self._liquidation_batch_handle: asyncio.TimerHandle = None
+
+        # optional watcher of pending transactions which move prices. liquidations of the accounts they push below
+        # the maintenance margin are signed before the transactions are mined, and sent in the block including them
+        self._pending_watcher = None
+        self._price_impact = None
+        # - key: hash of the pending transaction
+        # - value: dict(block_number, positions, sender, nonce, tx, raw_transaction)
+        self._prepared_liquidations = {}
+        self._prepared_max_wait_blocks = int(os.environ.get('PENDING_WATCHER_MAX_WAIT_BLOCKS', 3))
+        self._prepared_gas_per_position = int(os.environ.get('PENDING_WATCHER_GAS_PER_POSITION', 1000000))
+        if os.environ.get('LIQUIDATOR_PENDING_WATCHER', '0') == '1':
+            subscription_uri = get_subscription_uri(os.environ['WEB3_PROVIDER_URI'])
+            if self._risk_engine is None or self._liquidation_executor is None \
+                    or not subscription_uri.startswith(('wss://', 'ws://')):
+                self._logger.warning(
+                    'Pending transaction watcher needs the risk engine, LiquidationExecutor and a websocket endpoint')
+            else:
+                market_addresses, market_filepaths = get_perpdex_market_addresses(self._w3)
+                self._price_impact = PriceImpactSimulator(
+                    exchange_contract=self._perpdex_exchange,
+                    market_contracts=[get_contract_from_abi_json(self._w3, path) for path in market_filepaths],
+                )
+                self._pending_watcher = PendingTransactionWatcher(
+                    w3=self._w3,
+                    executor=self._executor,
+                    web3_provider_uri=subscription_uri,
+                    addresses=self._price_impact.addresses,
+                )
+
+        self._block_watcher = BlockWatcher(
+            w3=self._w3,
+            executor=self._executor,
+            web3_provider_uri=get_subscription_uri(os.environ['WEB3_PROVIDER_URI']),
+            min_poll_interval=float(os.environ.get('LIQUIDATOR_MIN_POLL_INTERVAL', 0.2)),
+            max_poll_interval=float(os.environ.get('LIQUIDATOR_MAX_POLL_INTERVAL', 5.0)),
+        )
+
+        # in-flight (trader, market) registry with bounded concurrency
+        block_budget = int(os.environ.get('LIQUIDATOR_BLOCK_BUDGET', 0))
+        self._scheduler = LiquidationScheduler(
+            max_concurrency=int(os.environ.get('LIQUIDATOR_MAX_CONCURRENCY', 32)),
+            max_queue_size=int(os.environ.get('LIQUIDATOR_MAX_QUEUE_SIZE', 10000)),
+            fairness_interval=int(os.environ.get('LIQUIDATOR_FAIRNESS_INTERVAL', 10)),
+            block_budget=block_budget if block_budget > 0 else None,
+        )
+
+        self._w3.middleware_onion.add(metrics.rpc_metrics_middleware, name='metrics')
 
         self._task: asyncio.Task = None
-        
+
     def health_check(self) -> bool:
         return not self._task.done()
 
@@ -35,34 +174,480 @@ class Liquidator:
 
     async def _main(self):
         self._logger.info('Start liquidator')
+        self._scheduler.start()
+        self._block_watcher.start()
+        shard_task = None
+        if self._shard is not None:
+            await self._executor.run(self._shard.heartbeat)
+            shard_task = asyncio.create_task(self._heartbeat_shard())
+        pending_task = None
+        if self._pending_watcher is not None:
+            await self._executor.run(self._price_impact.load)
+            self._pending_watcher.watch(self._price_impact.addresses)
+            self._pending_watcher.start()
+            pending_task = asyncio.create_task(self._prepare_liquidations())
+        try:
+            while True:
+                # one pass per new block
+                try:
+                    block_number = await self._block_watcher.wait_for_new_block()
+                    await self._process_block(block_number)
+                except Exception as e:
+                    # e.g. a transient RPC error. the next block is processed from scratch
+                    self._logger.warning(f'processing block failed {e=}')
+        finally:
+            if pending_task is not None:
+                pending_task.cancel()
+                self._pending_watcher.stop()
+                for tx_hash in list(self._prepared_liquidations.keys()):
+                    self._discard_prepared_liquidation(tx_hash, 'expired')
+            if shard_task is not None:
+                shard_task.cancel()
+                try:
+                    self._shard.leave()
+                except Exception as e:
+                    self._logger.warning(f'failed to leave the shard ring {e=}')
+            self._block_watcher.stop()
+            self._scheduler.stop()
+            self._executor.shutdown()
+
+    async def _process_block(self, block_number: int):
+        self._read_cache.advance(block_number)
+        if len(self._prepared_liquidations) > 0:
+            await self._send_prepared_liquidations(block_number)
+        market_to_traders = await self._executor.run(
+            self._perpdex_exchange_event_indexer.fetch_market_to_traders, block_number)
+
+        updated_traders = self._perpdex_exchange_event_indexer.pop_updated_traders()
+        if self._shard is not None:
+            market_to_traders = {
+                market: {trader for trader in traders if self._shard.owns(trader)}
+                for market, traders in market_to_traders.items()
+            }
+            updated_traders = {trader for trader in updated_traders if self._shard.owns(trader)}
+
+        if self._risk_engine is None:
+            # dedup traders across markets
+            traders = set().union(*market_to_traders.values())
+        else:
+            traders = await self._executor.run(
+                self._risk_engine.screen, market_to_traders, updated_traders, block_number)
+        unhealthy_traders = await self._screen_traders(traders, block_number)
+        unscreened_traders, self._unscreened_traders = self._unscreened_traders, set()
+        if self._risk_engine is not None:
+            # unscreened traders are estimated (and screened if still near the margin) again in the next block
+            self._risk_engine.set_unhealthy_traders(unhealthy_traders | unscreened_traders)
+
+        detected_at = time.monotonic()
+        if self._block_watcher.head_observed_at is not None:
+            metrics.BLOCK_TO_DETECTION_SECONDS.observe(detected_at - self._block_watcher.head_observed_at)
+        metrics.INDEXER_LAG_BLOCKS.set(block_number - self._perpdex_exchange_event_indexer.last_block_number)
+
+        # most underwater and largest positions first
+        self._scheduler.begin_block(block_number)
+        for market, traders in market_to_traders.items():
+            for trader in traders & unhealthy_traders:
+                self._scheduler.submit(
+                    (trader, market), self._liquidate, trader, market, detected_at,
+                    priority=self._liquidation_priority(trader),
+                )
+        metrics.QUEUED_JOBS.set(self._scheduler.queue_depth)
+        metrics.IN_FLIGHT_JOBS.set(self._scheduler.in_flight_count)
+        metrics.PENDING_TRANSACTIONS.set(sum(sender.pending_count for sender in self._sender_pool.senders))
+        self._logger.debug(
+            f'{block_number=}, {len(unhealthy_traders)=}, '
+            f'{self._scheduler.queue_depth=}, {self._scheduler.in_flight_count=}')
+
+        if (self._sender_stats_block_number is None
+                or block_number - self._sender_stats_block_number >= self._sender_stats_interval):
+            self._sender_stats_block_number = block_number
+            asyncio.create_task(self._log_sender_stats())
+
+    async def _heartbeat_shard(self):
+        while True:
+            await asyncio.sleep(self._shard.heartbeat_interval)
+            try:
+                if await self._executor.run(self._shard.heartbeat):
+                    self._logger.info(f'shard members {self._shard.members}')
+            except Exception as e:
+                # the other workers take over the traders of this one after the heartbeat ttl
+                self._logger.warning(f'shard heartbeat failed {e=}')
+
+    async def _prepare_liquidations(self):
         while True:
-            market_to_traders = self._perpdex_exchange_event_indexer.fetch_market_to_traders()
+            tx = await self._pending_watcher.wait_for_transaction()
+            try:
+                await self._prepare_liquidation(tx)
+            except Exception as e:
+                self._logger.warning(f'preparing liquidation failed {e=}, {tx["hash"]=}')
+
+    async def _prepare_liquidation(self, tx):
+        # signs one LiquidationExecutor transaction for the positions the pending transaction would push underwater
+        tx_hash = tx['hash'] if isinstance(tx['hash'], str) else self._w3.toHex(tx['hash'])
+        if tx_hash in self._prepared_liquidations:
+            return
+        # a transaction whose price effect is unknown (trades, price feed updates) is left to the scan of the block
+        # including it. signing for every account near the margin would hold nonces for nothing most of the time
+        market_prices = {
+            market: price for market, price in self._price_impact.simulate(tx).items() if price is not None
+        }
+        if len(market_prices) == 0:
+            return
+
+        prepared_positions = {
+            position for prepared in self._prepared_liquidations.values() for position in prepared['positions']
+        }
+        positions = [
+            position for position in self._risk_engine.simulate(market_prices)
+            if position not in prepared_positions
+            and not self._scheduler.is_scheduled(position)
+            and (self._shard is None or self._shard.owns(position[0]))
+        ]
+        if len(positions) == 0:
+            return
+        positions = sorted(positions, key=lambda position: self._liquidation_priority(position[0]), reverse=True)
+        positions = positions[:self._liquidation_batch_size]
+
+        # the transaction fails the positions before the price moves, so gas can't be estimated yet
+        func = self._liquidation_executor.functions.liquidate(positions)
+        options = dict(self._tx_options, gas=self._prepared_gas_per_position * len(positions))
+        sender = self._sender_pool.acquire()
+        try:
+            options['from'] = sender.address
+            built = await self._executor.run(func.buildTransaction, options)
+            nonce, signed, raw_transaction = await sender.sign(built)
+        except Exception:
+            self._sender_pool.release(sender)
+            raise
+
+        self._prepared_liquidations[tx_hash] = dict(
+            block_number=self._read_cache.block_number,
+            positions=positions,
+            sender=sender,
+            nonce=nonce,
+            tx=signed,
+            raw_transaction=raw_transaction,
+        )
+        self._logger.info(f'Prepared liquidation {tx_hash=}, {len(positions)=}, {market_prices=}')
+
+    async def _send_prepared_liquidations(self, block_number: int):
+        # sends prepared transactions whose pending transaction is mined, for positions which are underwater now
+        mined = await self._mined_prepared_liquidations(block_number)
+        if len(mined) == 0:
+            return
+
+        traders = {trader for tx_hash in mined for trader, _ in self._prepared_liquidations[tx_hash]['positions']}
+        unhealthy_traders = await self._screen_traders(traders, block_number)
+        detected_at = time.monotonic()
+        for tx_hash in mined:
+            prepared = self._prepared_liquidations[tx_hash]
+            positions = [position for position in prepared['positions'] if position[0] in unhealthy_traders]
+            if len(positions) == 0:
+                self._discard_prepared_liquidation(tx_hash, 'healthy')
+            else:
+                del self._prepared_liquidations[tx_hash]
+                await self._send_prepared_liquidation(tx_hash, prepared, positions, detected_at)
+
+    async def _mined_prepared_liquidations(self, block_number: int) -> list:
+        # returns hashes of the mined pending transactions. prepared liquidations waiting too long are discarded
+        tx_hashes = list(self._prepared_liquidations.keys())
+        receipts = await asyncio.gather(*[
+            self._executor.run(self._w3.eth.get_transaction_receipt, tx_hash) for tx_hash in tx_hashes
+        ], return_exceptions=True)
+
+        mined = []
+        for tx_hash, receipt in zip(tx_hashes, receipts):
+            prepared = self._prepared_liquidations[tx_hash]
+            if not isinstance(receipt, Exception):
+                mined.append(tx_hash)
+            elif prepared['block_number'] is None:
+                prepared['block_number'] = block_number
+            elif block_number - prepared['block_number'] >= self._prepared_max_wait_blocks:
+                # dropped, replaced or just slow
+                self._discard_prepared_liquidation(tx_hash, 'expired')
+        return mined
+
+    async def _send_prepared_liquidation(self, tx_hash: str, prepared: dict, positions: list, detected_at: float):
+        try:
+            await prepared['sender'].send_signed(prepared['nonce'], prepared['raw_transaction'])
+        except Exception as e:
+            self._logger.warning(f'sending prepared liquidation failed {e=}, {tx_hash=}')
+            self._sender_pool.release(prepared['sender'])
+            metrics.PREPARED_LIQUIDATIONS.inc(outcome='failed')
+            return
+        metrics.PREPARED_LIQUIDATIONS.inc(outcome='sent')
+        if self._block_watcher.head_observed_at is not None:
+            metrics.BLOCK_TO_DETECTION_SECONDS.observe(detected_at - self._block_watcher.head_observed_at)
+        metrics.DETECTION_TO_SUBMISSION_SECONDS.observe(time.monotonic() - detected_at)
 
-            for market, traders in market_to_traders.items():
-                for trader in traders:
-                    asyncio.create_task(self._liquidate(trader, market))
+        # the positions stay registered in the scheduler until the receipt, so the scan doesn't send them again
+        result = asyncio.ensure_future(self._wait_for_prepared_liquidation(prepared))
+        for trader, market in positions:
+            self._scheduler.submit((trader, market), self._await_liquidation, result, trader, market,
+                                   priority=(MAX_UINT + 1, 0))
 
-            await asyncio.sleep(1)
+    def _discard_prepared_liquidation(self, tx_hash: str, outcome: str):
+        prepared = self._prepared_liquidations.pop(tx_hash)
+        prepared['sender'].discard(prepared['nonce'])
+        self._sender_pool.release(prepared['sender'])
+        metrics.PREPARED_LIQUIDATIONS.inc(outcome=outcome)
+        self._logger.debug(f'Discarded prepared liquidation {tx_hash=}, {outcome=}')
+
+    async def _wait_for_prepared_liquidation(self, prepared: dict) -> dict:
+        # returns the outcomes of the positions of the prepared transaction. empty if it failed
+        submitted_at = time.monotonic()
+        try:
+            receipt = await prepared['sender'].wait_for_receipt(prepared['nonce'], prepared['tx'])
+        finally:
+            self._sender_pool.release(prepared['sender'])
+        if receipt is None or receipt['status'] != 1:
+            return {}
+        metrics.SUBMISSION_TO_RECEIPT_SECONDS.observe(time.monotonic() - submitted_at)
+        self._logger.info(receipt)
+        outcomes = self._executor_outcomes(receipt)
+        return {position: outcomes.get(position, 'liquidated') for position in prepared['positions']}
+
+    async def _await_liquidation(self, result: asyncio.Future, trader, market):
+        try:
+            outcome = (await asyncio.shield(result)).get((trader, market), 'failed')
+        except Exception as e:
+            self._logger.warning(f'prepared liquidation raises {e=}')
+            outcome = 'failed'
+        metrics.LIQUIDATIONS.inc(outcome=outcome)
+
+    async def _log_sender_stats(self):
+        for stats in await self._sender_pool.stats():
+            self._logger.info(f'sender {stats}')
+
+    async def _liquidate(self, trader, market, detected_at: float = None):
+        _detected_at.set(detected_at)
+        # another worker may still hold the position after a rebalance
+        claim_key = f'position:{trader}:{market}'
+        if self._shard is not None and not await self._executor.run(self._shard.claim, claim_key):
+            self._logger.debug(f'Skip liquidation claimed by another worker. {trader=}, {market=}')
+            metrics.LIQUIDATIONS.inc(outcome='claimed')
+            return
+
+        # a liquidation may take longer than the claim ttl while its transaction is replaced
+        renew_task = None if self._shard is None else asyncio.create_task(self._renew_claim(claim_key))
+        try:
+            if self._liquidation_executor is not None:
+                outcome = await self._liquidate_in_batch(trader, market)
+            else:
+                outcome = await self._liquidate_position(trader, market)
+        finally:
+            if renew_task is not None:
+                renew_task.cancel()
+                await self._executor.run(self._shard.release, claim_key)
+        metrics.LIQUIDATIONS.inc(outcome=outcome)
+
+    async def _renew_claim(self, claim_key: str):
+        while True:
+            await asyncio.sleep(self._shard.claim_renew_interval)
+            if not await self._executor.run(self._shard.renew, claim_key):
+                self._logger.warning(f'claim expired during the liquidation {claim_key=}')
+                return
+
+    async def _liquidate_position(self, trader, market) -> str:
+        # returns the outcome
+        position = await self._fetch_position(trader, market)
+        if position is None:
+            self._logger.warning(f'Skip liquidation because reading position failed. {trader=}, {market=}')
+            return 'read_failed'
 
-    async def _liquidate(self, trader, market):
         # check mm
-        ret = self._check_trader_has_enough_mm(trader)
-        if ret:
+        if position['has_enough_mm']:
             self._logger.debug(f"Skip liquidation because trader has enough mm. {trader=}, {market=}")
-            return
+            return 'enough_mm'
 
         # liquidate maker position
-        self._liquidate_maker_position(trader, market)
-        
+        if position['liquidity'] > 0:
+            ret = await self._liquidate_maker_position(trader, market, position)
+            if ret:
+                # removed liquidity is converted to a taker position. the scanned block doesn't include it yet
+                position = await self._fetch_position(trader, market, block_number='latest')
+                if position is None or position['has_enough_mm']:
+                    return 'liquidated'
+
         # liquidate taker position
-        self._liquidate_taker_position(trader, market)
+        ret = await self._liquidate_taker_position(trader, market, position)
+        return 'liquidated' if ret else 'failed'
+
+    async def _liquidate_in_batch(self, trader, market) -> str:
+        # jobs dispatched within the batch window are sent in one transaction. returns the outcome
+        future = asyncio.get_event_loop().create_future()
+        self._liquidation_batch.append(((trader, market), future))
+        if len(self._liquidation_batch) >= self._liquidation_batch_size:
+            self._flush_liquidation_batch()
+        elif self._liquidation_batch_handle is None:
+            self._liquidation_batch_handle = asyncio.get_event_loop().call_later(
+                self._liquidation_batch_window, self._flush_liquidation_batch)
+        return await future
+
+    def _flush_liquidation_batch(self):
+        if self._liquidation_batch_handle is not None:
+            self._liquidation_batch_handle.cancel()
+            self._liquidation_batch_handle = None
+        batch, self._liquidation_batch = self._liquidation_batch, []
+        if len(batch) > 0:
+            asyncio.create_task(self._send_liquidation_batch(batch))
+
+    async def _send_liquidation_batch(self, batch: list):
+        positions = [position for position, _ in batch]
+        try:
+            func = self._liquidation_executor.functions.liquidate(positions)
+            gas = await self._try_estimate_gas(func)
+            if gas is None:
+                # e.g. a view call reverts for one position. don't let it block the others
+                self._logger.debug(f'Batch liquidation failed in estimation stage. {len(positions)=}')
+                rets = await asyncio.gather(
+                    *[self._liquidate_position(trader, market) for trader, market in positions],
+                    return_exceptions=True,
+                )
+                rets = [ret if isinstance(ret, str) else 'failed' for ret in rets]
+            else:
+                receipt = await self._send_transaction(func, self._gas_options(gas))
+                if receipt is None or receipt['status'] != 1:
+                    rets = ['failed'] * len(positions)
+                else:
+                    outcomes = self._executor_outcomes(receipt)
+                    rets = [outcomes.get(position, 'liquidated') for position in positions]
+                    self._logger.debug(f'Batch liquidation succeeded. {len(positions)=}, {len(outcomes)=}')
+        except Exception as e:
+            self._logger.warning(f'Batch liquidation raises {e=}')
+            rets = ['failed'] * len(positions)
+
+        for (_, future), ret in zip(batch, rets):
+            if not future.done():
+                future.set_result(ret)
+
+    def _executor_outcomes(self, receipt) -> dict:
+        # outcomes of the positions which LiquidationExecutor didn't liquidate, the others are liquidated
+        # - key: (trader, market)
+        # - value: outcome
+        outcomes = {}
+        events = self._liquidation_executor.events
+        for event_name, outcome in [('LiquidationSkipped', 'skipped'), ('LiquidationFailed', 'failed')]:
+            for event in getattr(events, event_name)().processReceipt(receipt, errors=DISCARD):
+                outcomes[(event['args']['trader'], event['args']['market'])] = outcome
+        return outcomes
+
+    def _liquidation_priority(self, trader) -> tuple:
+        # (estimated shortfall, notional). unknown accounts are handled first
+        estimated = None if self._risk_engine is None else self._risk_engine.estimate_shortfall(trader)
+        if estimated is None:
+            return (MAX_UINT, 0)
+        return estimated
+
+    async def _screen_traders(self, traders, block_number='latest') -> set:
+        # returns traders who don't have enough mm.
+        # traders whose check failed (e.g. RPC errors) are added to _unscreened_traders to be checked again
+        traders = list(traders)
+        functions = self._perpdex_exchange.functions
+
+        async def _fetch(keys):
+            fetch_traders = [trader for _, _, (trader,) in keys]
+            if self._multicall is None:
+                return await asyncio.gather(*[
+                    self._check_trader_has_enough_mm(trader, block_number) for trader in fetch_traders
+                ])
+            return await self._executor.run(
+                self._multicall.try_aggregate,
+                [functions.hasEnoughMaintenanceMargin(trader) for trader in fetch_traders],
+                block_identifier=block_number,
+            )
+
+        # one chunk per Multicall call (per trader without Multicall), so that a failed chunk doesn't fail the others.
+        # same keys as contract_call_key, so that _fetch_position at this block reuses the results
+        chunks = [[trader] for trader in traders] if self._multicall is None else self._multicall.split(traders)
+        results = await asyncio.gather(*[
+            self._read_cache.get_many(
+                block_number,
+                [(self._perpdex_exchange.address, 'hasEnoughMaintenanceMargin', (trader,)) for trader in chunk],
+                _fetch,
+            )
+            for chunk in chunks
+        ], return_exceptions=True)
+
+        unhealthy_traders = set()
+        for chunk, rets in zip(chunks, results):
+            if isinstance(rets, Exception):
+                self._logger.warning(f'checking maintenance margin failed {rets=}, {len(chunk)=}')
+                self._unscreened_traders.update(chunk)
+                continue
+            # NOTE: reverted check (None) is passed to the liquidation step which checks it again
+            unhealthy_traders.update(trader for trader, ret in zip(chunk, rets) if not ret)
+        return unhealthy_traders
 
-    def _check_trader_has_enough_mm(self, trader):
-        return self._perpdex_exchange.functions.hasEnoughMaintenanceMargin(trader).call()
+    async def _check_trader_has_enough_mm(self, trader, block_number='latest'):
+        return await self._executor.call(
+            self._perpdex_exchange.functions.hasEnoughMaintenanceMargin(trader), block_identifier=block_number)
 
-    def _liquidate_maker_position(self, trader, market) -> bool:
-        # liquidity, cumBaseSharePerLiquidityX96, cumQuotePerLiquidityX96
-        liquidity, _, _ = self._perpdex_exchange.functions.getMakerInfo(trader, market).call()
+    async def _cached_calls(self, funcs: list, block_number='latest') -> list:
+        # a few reads through the block read cache, in one Multicall if available.
+        # reverted calls are None with Multicall, raise without it
+        async def _fetch(keys):
+            fetch_funcs = [key_to_func[key] for key in keys]
+            if self._multicall is None:
+                return await asyncio.gather(*[
+                    self._executor.call(func, block_identifier=block_number) for func in fetch_funcs
+                ])
+            return await self._executor.run(self._multicall.try_aggregate, fetch_funcs, block_identifier=block_number)
+
+        keys = [contract_call_key(func) for func in funcs]
+        key_to_func = dict(zip(keys, funcs))
+        return await self._read_cache.get_many(block_number, keys, _fetch)
+
+    async def _fetch_position(self, trader, market, block_number=None):
+        # reads everything the liquidation steps need in one round trip. None if any read fails
+        # block_number: the scanned block by default (cached), 'latest' to see our own transactions
+        if block_number is None:
+            block_number = self._read_cache.block_number
+            if block_number is None:
+                block_number = 'latest'
+
+        functions = self._perpdex_exchange.functions
+        funcs = [
+            functions.hasEnoughMaintenanceMargin(trader),
+            functions.getMakerInfo(trader, market),
+            functions.getOpenPositionShare(trader, market),
+        ]
+        # direction depends on the share, read both
+        for is_base_to_quote in [True, False]:
+            funcs.append(functions.maxTrade(dict(
+                trader=trader,
+                market=market,
+                caller=self._w3.eth.default_account,
+                isBaseToQuote=is_base_to_quote,
+                isExactInput=is_base_to_quote,  # same as isBaseToQuote
+            )))
+
+        try:
+            rets = await self._cached_calls(funcs, block_number)
+        except Exception as e:
+            self._logger.debug(f'reading position failed {e=}, {trader=}, {market=}')
+            return
+        if any(ret is None for ret in rets):
+            return
+
+        has_enough_mm, maker_info, base_share, max_trade_short, max_trade_long = rets
+        return dict(
+            has_enough_mm=has_enough_mm,
+            # liquidity, cumBaseSharePerLiquidityX96, cumQuotePerLiquidityX96
+            liquidity=maker_info[0],
+            base_share=base_share,
+            # - key: isBaseToQuote
+            # - value: maxTrade
+            max_trade={True: max_trade_short, False: max_trade_long},
+        )
+
+    async def _liquidate_maker_position(self, trader, market, position=None) -> bool:
+        if position is None:
+            position = await self._fetch_position(trader, market)
+            if position is None:
+                return False
+
+        liquidity = position['liquidity']
         if liquidity > 0:
             func = self._perpdex_exchange.functions.removeLiquidity(dict(
                 trader=trader,
@@ -72,35 +657,37 @@ class Liquidator:
                 minQuote=0,
                 deadline=int(web3.constants.MAX_INT, base=16),
             ))
-            gas = self._try_estimate_gas(func)
+            gas = await self._try_estimate_gas(func)
             if gas is None:
                 self._logger.debug(f"RemoveLiquidity failed in estimation stage. {trader=}, {market=}")
                 return False
 
-            ret = self._try_transact(func)
+            ret = await self._try_transact(func, self._gas_options(gas))
             if ret:
                 self._logger.debug("RemoveLiquidity suceeded.")
                 return True
             else:
                 self._logger.debug(f"RemoveLiquidity failed. {trader=}, {market=}")
                 return False
+        return False
+
+    async def _liquidate_taker_position(self, trader, market, position=None):
+        if position is None:
+            position = await self._fetch_position(trader, market)
+            if position is None:
+                return False
 
-    def _liquidate_taker_position(self, trader, market):
-        base_share = self._perpdex_exchange.functions.getOpenPositionShare(trader, market).call()
+        base_share = position['base_share']
+        if base_share == 0:
+            return False
         is_short = base_share > 0
-        max_trade = self._perpdex_exchange.functions.maxTrade(dict(
-            trader=trader,
-            market=market,
-            caller=self._w3.eth.default_account,
-            isBaseToQuote=is_short,
-            isExactInput=is_short,  # same as isBaseToQuote
-        )).call()
+        max_trade = position['max_trade'][is_short]
 
         # try liquidate
         reduction_rate = 0.8
         amount = min(
             abs(base_share),
-            max_trade * reduction_rate,
+            int(max_trade * reduction_rate),
         )
         func = self._perpdex_exchange.functions.trade(dict(
             trader=trader,
@@ -112,52 +699,60 @@ class Liquidator:
             deadline=MAX_UINT,
         ))
 
-        gas = self._try_estimate_gas(func)
+        gas = await self._try_estimate_gas(func)
         if gas is None:
             return False
-        
-        ret = self._try_transact(func)
+
+        ret = await self._try_transact(func, self._gas_options(gas))
         if ret:
             self._logger.debug(f'Liquidation succeeded. {trader=}, {market=}, {base_share=}, {max_trade=}, {amount=}')
             return True
         else:
             self._logger.debug(f'Liquidation failed. {gas=}, {trader=}, {market=}, {base_share=}, {max_trade=}, {amount=}')
             return False
-    
-    def _try_estimate_gas(self, func) -> int:
+
+    def _gas_options(self, gas: int) -> dict:
+        # estimateGas is the simulation. reusing its result skips the estimation in buildTransaction
+        return {'gas': int(gas * self._gas_buffer)}
+
+    async def _try_estimate_gas(self, func) -> int:
         try:
-            return func.estimateGas()
+            return await self._executor.run(func.estimateGas)
         except Exception as e:
             self._logger.debug(f'estimateGas raises {e=}, {func=}')
             return
-   
-    def _try_transact(self, func, options: dict = {}) -> bool:
+
+    async def _try_transact(self, func, options: dict = {}) -> bool:
+        receipt = await self._send_transaction(func, options)
+        if receipt is None:
+            return False
+        # status 0: transaction failed, 1: transaction success
+        return receipt['status'] == 1
+
+    async def _send_transaction(self, func, options: dict = {}):
+        # returns the receipt, None if the transaction is not sent or mined
         options = dict(self._tx_options, **options)  # override options
         try:
-            tx_hash = func.transact(options)
+            async with self._sender_pool.sender() as sender:
+                options['from'] = sender.address
+                tx = await self._executor.run(func.buildTransaction, options)
+                nonce, _, tx = await sender.submit(tx)
+                submitted_at = time.monotonic()
+                if _detected_at.get() is not None:
+                    metrics.DETECTION_TO_SUBMISSION_SECONDS.observe(submitted_at - _detected_at.get())
+                receipt = await sender.wait_for_receipt(nonce, tx)
+                if receipt is not None:
+                    metrics.SUBMISSION_TO_RECEIPT_SECONDS.observe(time.monotonic() - submitted_at)
         except web3.exceptions.ContractLogicError as e:
             self._logger.debug(f'transaction reverted. {e=}, {options=}')
-            return False
-
-        return self._wait_transaction_receipt(tx_hash, times=10)
+            return
+        except Exception as e:
+            self._logger.warning(f'sending transaction failed. {e=}, {options=}')
+            return
 
-    def _wait_transaction_receipt(self, tx_hash, times) -> bool:
-        self._logger.info(f"tx_hash:{self._w3.toHex(tx_hash)}")
-        for i in range(times):
-            try:
-                tx_receipt = self._w3.eth.waitForTransactionReceipt(tx_hash, 10)
-                self._logger.info(tx_receipt)
-                status = tx_receipt['status']
-                if status == 0:
-                    # transaction failed
-                    return False
-                elif status == 1:
-                    # transaction success
-                    return True
-            except BaseException as e:
-                self._logger.warning('waiting tx failed {} time(s): {}'.format(i, e))
-                continue
-        return False
+        if receipt is not None:
+            self._logger.info(receipt)
+        return receipt
 
 
 def get_perpdex_exchange_contract(w3):
@@ -166,6 +761,55 @@ def get_perpdex_exchange_contract(w3):
     return get_contract_from_abi_json(w3, filepath)
 
 
+def get_subscription_uri(web3_provider_uri: str) -> str:
+    # first websocket endpoint of comma separated WEB3_PROVIDER_URI, which BlockWatcher subscribes newHeads with
+    uris = [uri.strip() for uri in web3_provider_uri.split(',') if uri.strip() != '']
+    for uri in uris:
+        if uri.startswith(('wss://', 'ws://')):
+            return uri
+    return uris[0]
+
+
+def get_user_private_keys() -> list:
+    # USER_PRIVATE_KEY first, then comma separated USER_PRIVATE_KEYS
+    keys = [os.environ['USER_PRIVATE_KEY']]
+    for key in os.environ.get('USER_PRIVATE_KEYS', '').split(','):
+        key = key.strip()
+        if key != '' and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def get_multicall(w3):
+    address = os.environ.get('MULTICALL_ADDRESS')
+    if address is None:
+        dirpath = os.environ['PERPDEX_CONTRACT_ABI_JSON_DIRPATH']
+        filepath = os.path.join(dirpath, 'Multicall.json')
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath) as f:
+            address = json.load(f)['address']
+
+    return Multicall(
+        w3,
+        address=address,
+        batch_size=int(os.environ.get('MULTICALL_BATCH_SIZE', 200)),
+    )
+
+
+def get_liquidation_executor(w3):
+    address = os.environ.get('LIQUIDATION_EXECUTOR_ADDRESS')
+    if address is None:
+        dirpath = os.environ['PERPDEX_CONTRACT_ABI_JSON_DIRPATH']
+        filepath = os.path.join(dirpath, 'LiquidationExecutor.json')
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath) as f:
+            address = json.load(f)['address']
+
+    return w3.eth.contract(address=address, abi=LIQUIDATION_EXECUTOR_ABI)
+
+
 def get_perpdex_market_addresses(w3):
     dirpath = os.environ['PERPDEX_CONTRACT_ABI_JSON_DIRPATH']
     searchpath = os.path.join(dirpath, 'PerpdexMarket*.json')
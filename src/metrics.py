@@ -0,0 +1,253 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal metrics in the Prometheus text exposition format, without a client library.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines += metric.samples()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry: Registry = REGISTRY) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._labelnames = tuple(labelnames)
+        # - key: label values
+        # - value: metric value
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels.keys()) != set(self._labelnames):
+            raise ValueError(f'{self.name} expects labels {self._labelnames}, got {tuple(labels.keys())}')
+        return tuple(str(labels[name]) for name in self._labelnames)
+
+    def _format_labels(self, key: tuple, extra: dict = None) -> str:
+        pairs = list(zip(self._labelnames, key)) + list((extra or {}).items())
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        with self._lock:
+            return [f'{self.name}{self._format_labels(key)} {value}' for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self) -> list:
+        with self._lock:
+            return [f'{self.name}{self._format_labels(key)} {value}' for key, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry: Registry = REGISTRY) -> None:
+        super().__init__(name, documentation, labelnames=labelnames, registry=registry)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [bucket counts..., sum, count]
+            values = self._values.setdefault(key, [0] * len(self._buckets) + [0, 0])
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self) -> list:
+        lines = []
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                for bound, count in zip(self._buckets, values):
+                    lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": bound})} {count}')
+                lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": "+Inf"})} {values[-1]}')
+                lines.append(f'{self.name}_sum{self._format_labels(key)} {values[-2]}')
+                lines.append(f'{self.name}_count{self._format_labels(key)} {values[-1]}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict) -> None:
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started_at = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self._histogram.observe(time.monotonic() - self._started_at, **self._labels)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def start_http_server(port: int, addr: str = '0.0.0.0', registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def rpc_metrics_middleware(make_request, w3):
+    # web3 middleware counting JSON-RPC requests and their latency by method
+    def middleware(method, params):
+        started_at = time.monotonic()
+        status = 'error'
+        try:
+            response = make_request(method, params)
+            status = 'error' if 'error' in response else 'ok'
+            return response
+        finally:
+            RPC_REQUESTS.inc(method=method, status=status)
+            RPC_LATENCY_SECONDS.observe(time.monotonic() - started_at, method=method)
+    return middleware
+
+
+BLOCK_TO_DETECTION_SECONDS = Histogram(
+    'liquidator_block_to_detection_seconds',
+    'seconds from observing a new block to finding unhealthy traders in it',
+)
+DETECTION_TO_SUBMISSION_SECONDS = Histogram(
+    'liquidator_detection_to_submission_seconds',
+    'seconds from finding an unhealthy trader to sending the liquidation transaction',
+)
+SUBMISSION_TO_RECEIPT_SECONDS = Histogram(
+    'liquidator_submission_to_receipt_seconds',
+    'seconds from sending a liquidation transaction to getting its receipt',
+)
+RPC_REQUESTS = Counter(
+    'liquidator_rpc_requests_total',
+    'JSON-RPC requests by method and status',
+    labelnames=('method', 'status'),
+)
+RPC_LATENCY_SECONDS = Histogram(
+    'liquidator_rpc_latency_seconds',
+    'JSON-RPC request latency by method',
+    labelnames=('method',),
+)
+INDEXER_LAG_BLOCKS = Gauge(
+    'liquidator_indexer_lag_blocks',
+    'blocks between the head and the last indexed block',
+)
+INDEXER_REORGS = Counter(
+    'liquidator_indexer_reorgs_total',
+    'reorgs found by the event indexer by depth (tip or deep)',
+    labelnames=('depth',),
+)
+EVENT_CACHE_REQUESTS = Counter(
+    'liquidator_event_cache_requests_total',
+    'event chunk cache lookups by result (hit or miss)',
+    labelnames=('result',),
+)
+READ_CACHE_REQUESTS = Counter(
+    'liquidator_read_cache_requests_total',
+    'block scoped contract read cache lookups by result (hit or miss)',
+    labelnames=('result',),
+)
+RECHECKED_TRADERS = Gauge(
+    'liquidator_rechecked_traders',
+    'traders whose margin was estimated again by the risk engine in the last block',
+)
+PENDING_TRANSACTIONS_SEEN = Counter(
+    'liquidator_pending_transactions_seen_total',
+    'pending transactions of the mempool by result (watched, ignored, mined or dropped)',
+    labelnames=('result',),
+)
+PREPARED_LIQUIDATIONS = Counter(
+    'liquidator_prepared_liquidations_total',
+    'liquidation transactions signed before the price moving transaction is mined by outcome '
+    '(sent, healthy, expired or failed)',
+    labelnames=('outcome',),
+)
+QUEUED_JOBS = Gauge(
+    'liquidator_queued_jobs',
+    'liquidation jobs waiting for a worker',
+)
+IN_FLIGHT_JOBS = Gauge(
+    'liquidator_in_flight_jobs',
+    'liquidation jobs running',
+)
+PENDING_TRANSACTIONS = Gauge(
+    'liquidator_pending_transactions',
+    'liquidation transactions sent and not mined yet',
+)
+LIQUIDATIONS = Counter(
+    'liquidator_liquidations_total',
+    'liquidation jobs by outcome',
+    labelnames=('outcome',),
+)
@@ -0,0 +1,239 @@
+import asyncio
+import heapq
+import time
+from logging import getLogger
+
+import web3
+
+
+class NonceManager:
+    # Allocates nonces of one account locally so that several transactions can be outstanding at once.
+    # - receipts are polled asynchronously
+    # - a transaction not mined within receipt_timeout is replaced with a higher gas price
+    # - a nonce whose transaction could not be sent is reused, or filled by a self transfer
+    #   when later nonces are already pending, so that the nonce sequence has no gap
+    def __init__(
+        self,
+        w3,
+        account,
+        executor,
+        receipt_timeout: float = 30,
+        poll_interval: float = 0.5,
+        max_replacements: int = 3,
+        gas_price_multiplier: float = 1.125,
+        logger=None,
+    ) -> None:
+        self._w3 = w3
+        self._account = account
+        self._executor = executor
+        self._receipt_timeout = receipt_timeout
+        self._poll_interval = poll_interval
+        self._max_replacements = max_replacements
+        self._gas_price_multiplier = gas_price_multiplier
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+
+        self._chain_id = None
+        self._next_nonce = None
+        self._released = []  # heap of nonces to reuse
+        self._pending = {}  # nonce -> list of tx hash
+        self._held = set()  # nonces of transactions signed by sign and not sent yet
+        self._sync_lock: asyncio.Lock = None
+
+    @property
+    def address(self):
+        return self._account.address
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def sync(self):
+        # NOTE: pending nonce includes our transactions in the mempool
+        self._chain_id = await self._executor.run(lambda: self._w3.eth.chain_id)
+        chain_nonce = await self._executor.run(self._w3.eth.get_transaction_count, self.address, 'pending')
+        if len(self._pending) == 0 and len(self._held) == 0:
+            # nothing of ours is in flight, the node is the source of truth even when it went back
+            # (e.g. our transactions were dropped from the mempool)
+            self._released = []
+            self._next_nonce = chain_nonce
+        else:
+            self._released = [nonce for nonce in self._released if nonce >= chain_nonce]
+            heapq.heapify(self._released)
+            self._next_nonce = max(chain_nonce, self._next_nonce or 0)
+        self._logger.debug(f'nonce synced {self.address=} {chain_nonce=} {self._next_nonce=}')
+
+    async def send_transaction(self, tx: dict):
+        # returns the receipt, or None if the transaction was not mined
+        nonce, tx_hash, tx = await self.submit(tx)
+        return await self.wait_for_receipt(nonce, tx)
+
+    async def submit(self, tx: dict):
+        # signs and sends without waiting for the receipt. returns (nonce, tx hash, signed tx params)
+        await self._ensure_synced()
+
+        nonce = self._allocate()
+        tx = dict(tx, nonce=nonce, chainId=self._chain_id)
+        tx['from'] = self.address
+        try:
+            tx_hash = await self._sign_and_send(tx)
+        except Exception as e:
+            self._release(nonce)
+            if _is_nonce_error(e):
+                await self.sync()
+            raise
+
+        self._pending[nonce] = [tx_hash]
+        return nonce, tx_hash, tx
+
+    async def sign(self, tx: dict):
+        # allocates a nonce and signs without sending. returns (nonce, signed tx params, raw transaction).
+        # the nonce is held until send_signed or discard, later transactions of this account wait for it
+        await self._ensure_synced()
+
+        nonce = self._allocate()
+        tx = dict(tx, nonce=nonce, chainId=self._chain_id)
+        tx['from'] = self.address
+        try:
+            raw_transaction = self._sign(tx)
+        except Exception:
+            self._release(nonce)
+            raise
+        self._held.add(nonce)
+        return nonce, tx, raw_transaction
+
+    async def send_signed(self, nonce: int, raw_transaction):
+        # sends a transaction of sign. returns the tx hash, wait_for_receipt follows
+        self._held.discard(nonce)
+        try:
+            tx_hash = await self._executor.run(self._w3.eth.send_raw_transaction, raw_transaction)
+        except Exception as e:
+            self._release(nonce)
+            if _is_nonce_error(e):
+                await self.sync()
+            raise
+
+        self._pending[nonce] = [tx_hash]
+        return tx_hash
+
+    def discard(self, nonce: int):
+        # gives back the nonce of a signed transaction which is not sent
+        self._held.discard(nonce)
+        self._release(nonce)
+
+    async def wait_for_receipt(self, nonce: int, tx: dict):
+        try:
+            for i in range(self._max_replacements + 1):
+                receipt = await self._poll_receipts(self._pending[nonce], self._receipt_timeout)
+                if receipt is not None:
+                    return receipt
+
+                chain_nonce = await self._executor.run(self._w3.eth.get_transaction_count, self.address, 'latest')
+                if chain_nonce > nonce:
+                    # mined by a transaction we don't know (e.g. sent by another process)
+                    receipt = await self._poll_receipts(self._pending[nonce], 0)
+                    if receipt is None:
+                        self._logger.warning(f'nonce {nonce} is used by another transaction')
+                    return receipt
+
+                if i == self._max_replacements:
+                    break
+
+                # not mined (underpriced or dropped), replace with a higher gas price
+                tx = self._bump_gas_price(tx)
+                try:
+                    tx_hash = await self._sign_and_send(tx)
+                    self._pending[nonce].append(tx_hash)
+                    self._logger.info(f'replaced transaction {nonce=} {self._w3.toHex(tx_hash)=}')
+                except Exception as e:
+                    self._logger.warning(f'failed to replace transaction {nonce=} {e=}')
+
+            self._logger.warning(f'transaction is not mined {nonce=}')
+            self._pending.pop(nonce, None)
+            self._give_up(nonce, tx)
+            return None
+        finally:
+            self._pending.pop(nonce, None)
+
+    async def _ensure_synced(self):
+        if self._sync_lock is None:
+            self._sync_lock = asyncio.Lock()
+        async with self._sync_lock:
+            if self._next_nonce is None:
+                await self.sync()
+
+    def _allocate(self) -> int:
+        if len(self._released) > 0:
+            return heapq.heappop(self._released)
+        nonce = self._next_nonce
+        self._next_nonce += 1
+        return nonce
+
+    def _release(self, nonce: int):
+        if nonce == self._next_nonce - 1:
+            self._next_nonce -= 1
+        elif any(pending > nonce for pending in self._pending) or any(held > nonce for held in self._held):
+            # later transactions (sent, or signed and sent later) wait for this nonce.
+            # fill it without waiting for the next liquidation
+            asyncio.create_task(self._fill_nonce(nonce))
+        else:
+            heapq.heappush(self._released, nonce)
+
+    def _give_up(self, nonce: int, tx: dict):
+        # the transaction may have left the mempool, later transactions would wait for its nonce forever
+        if len(self._pending) == 0 and len(self._held) == 0:
+            # the next submit syncs with the node
+            self._next_nonce = None
+        else:
+            # replace it, priced above the last attempt
+            asyncio.create_task(self._fill_nonce(nonce, min_gas_price=self._bump_gas_price(tx).get('gasPrice')))
+
+    async def _fill_nonce(self, nonce: int, min_gas_price: int = None):
+        tx = {
+            'from': self.address,
+            'to': self.address,
+            'value': 0,
+            'gas': 21000,
+            'nonce': nonce,
+            'chainId': self._chain_id,
+        }
+        try:
+            tx['gasPrice'] = await self._executor.run(lambda: self._w3.eth.gas_price)
+            if min_gas_price is not None:
+                tx['gasPrice'] = max(tx['gasPrice'], min_gas_price)
+            tx_hash = await self._sign_and_send(tx)
+            self._logger.info(f'filled nonce gap {nonce=} {self._w3.toHex(tx_hash)=}')
+        except Exception as e:
+            self._logger.warning(f'failed to fill nonce gap {nonce=} {e=}')
+            heapq.heappush(self._released, nonce)
+
+    async def _sign_and_send(self, tx: dict):
+        return await self._executor.run(self._w3.eth.send_raw_transaction, self._sign(tx))
+
+    def _sign(self, tx: dict):
+        tx = {k: v for k, v in tx.items() if k != 'from'}
+        return self._account.sign_transaction(tx).rawTransaction
+
+    async def _poll_receipts(self, tx_hashes: list, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            for tx_hash in list(tx_hashes):
+                try:
+                    return await self._executor.run(self._w3.eth.get_transaction_receipt, tx_hash)
+                except web3.exceptions.TransactionNotFound:
+                    pass
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(self._poll_interval)
+
+    def _bump_gas_price(self, tx: dict) -> dict:
+        tx = dict(tx)
+        for key in ['gasPrice', 'maxFeePerGas', 'maxPriorityFeePerGas']:
+            if key in tx:
+                # nodes require at least 10% increase for replacement
+                tx[key] = max(int(tx[key] * self._gas_price_multiplier), tx[key] + 1)
+        return tx
+
+
+def _is_nonce_error(exception) -> bool:
+    message = str(exception).lower()
+    return 'nonce' in message
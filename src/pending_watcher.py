@@ -0,0 +1,198 @@
+import asyncio
+import json
+from logging import getLogger
+
+import websockets
+
+from src import metrics
+
+Q96: int = 0x1000000000000000000000000  # same as 1 << 96
+
+
+class PendingTransactionWatcher:
+    # Notifies pending transactions sent to the watched contracts.
+    # eth_subscribe newPendingTransactions over websocket, then each hash is fetched with eth_getTransactionByHash.
+    # Hashes arriving while max_fetches are outstanding are dropped, so a busy mempool doesn't flood the node.
+    def __init__(
+        self,
+        w3,
+        executor,
+        web3_provider_uri: str,
+        addresses: list = None,
+        max_fetches: int = 32,
+        max_queue_size: int = 1000,
+        retry_interval: float = 5.0,
+        logger=None,
+    ) -> None:
+        self._w3 = w3
+        self._executor = executor
+        self._web3_provider_uri = web3_provider_uri
+        self._addresses = set()
+        self._max_fetches = max_fetches
+        self._max_queue_size = max_queue_size
+        self._retry_interval = retry_interval
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+        self.watch(addresses or [])
+
+        self._fetch_count = 0
+        self._queue: asyncio.Queue = None
+        self._subscription_task: asyncio.Task = None
+
+    def watch(self, addresses: list):
+        self._addresses.update(address.lower() for address in addresses)
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self._max_queue_size)
+        if self._web3_provider_uri is not None and self._web3_provider_uri.startswith(('wss://', 'ws://')):
+            self._subscription_task = asyncio.create_task(self._subscribe_pending_transactions())
+        else:
+            self._logger.warning(f'pending transactions need a websocket endpoint {self._web3_provider_uri=}')
+
+    def stop(self):
+        if self._subscription_task is not None:
+            self._subscription_task.cancel()
+            self._subscription_task = None
+
+    async def wait_for_transaction(self) -> dict:
+        return await self._queue.get()
+
+    async def _subscribe_pending_transactions(self):
+        while True:
+            try:
+                async with websockets.connect(self._web3_provider_uri) as ws:
+                    await ws.send(json.dumps({
+                        'jsonrpc': '2.0',
+                        'id': 1,
+                        'method': 'eth_subscribe',
+                        'params': ['newPendingTransactions'],
+                    }))
+                    response = json.loads(await ws.recv())
+                    if 'error' in response:
+                        self._logger.warning(f'newPendingTransactions subscription is not supported {response=}')
+                        return
+
+                    self._logger.info('Subscribed newPendingTransactions')
+                    async for message in ws:
+                        result = json.loads(message)['params']['result']
+                        if isinstance(result, dict):
+                            # some nodes send full transactions
+                            self._on_transaction(result)
+                        elif self._fetch_count < self._max_fetches:
+                            self._fetch_count += 1
+                            asyncio.create_task(self._fetch_transaction(result))
+                        else:
+                            metrics.PENDING_TRANSACTIONS_SEEN.inc(result='dropped')
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._logger.warning(f'newPendingTransactions subscription failed {e=}')
+
+            await asyncio.sleep(self._retry_interval)
+
+    async def _fetch_transaction(self, tx_hash: str):
+        try:
+            tx = await self._executor.run(self._w3.eth.get_transaction, tx_hash)
+        except Exception as e:
+            # dropped or already replaced
+            self._logger.debug(f'fetching pending transaction failed {e=}, {tx_hash=}')
+            return
+        finally:
+            self._fetch_count -= 1
+        self._on_transaction(tx)
+
+    def _on_transaction(self, tx):
+        to = tx.get('to')
+        if to is None or to.lower() not in self._addresses:
+            metrics.PENDING_TRANSACTIONS_SEEN.inc(result='ignored')
+            return
+        if tx.get('blockNumber') is not None:
+            # mined before it was fetched
+            metrics.PENDING_TRANSACTIONS_SEEN.inc(result='mined')
+            return
+        try:
+            self._queue.put_nowait(tx)
+            metrics.PENDING_TRANSACTIONS_SEEN.inc(result='watched')
+        except asyncio.QueueFull:
+            metrics.PENDING_TRANSACTIONS_SEEN.inc(result='dropped')
+
+
+class PriceImpactSimulator:
+    # Maps a pending transaction to the markets whose share mark price it moves.
+    # - setPoolInfo of the test markets: the price after the transaction (quote / base of the new pool)
+    # - other market calls, price feed updates and exchange calls of a market: the market with an unknown price
+    def __init__(self, exchange_contract, market_contracts: list, logger=None) -> None:
+        self._exchange = exchange_contract
+        self._markets = {market.address.lower(): market for market in market_contracts}
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+
+        # - key: price feed address
+        # - value: market addresses
+        self._price_feed_to_markets = {}
+
+    @property
+    def addresses(self) -> list:
+        # contracts whose pending transactions may move prices
+        return [self._exchange.address] + [market.address for market in self._markets.values()] \
+            + list(self._price_feed_to_markets.keys())
+
+    def load(self):
+        # reads the price feeds of the markets
+        for market in self._markets.values():
+            names = {abi.get('name') for abi in market.abi}
+            for name in ['priceFeedBase', 'priceFeedQuote']:
+                if name not in names:
+                    continue
+                try:
+                    price_feed = getattr(market.functions, name)().call()
+                except Exception as e:
+                    self._logger.warning(f'failed to read {name} {e=}, {market.address=}')
+                    continue
+                if int(price_feed, 16) != 0:
+                    self._price_feed_to_markets.setdefault(price_feed.lower(), []).append(market.address)
+
+    def simulate(self, tx) -> dict:
+        # - key: market address
+        # - value: share mark price X96 after the transaction, None if unknown
+        to = tx['to'].lower()
+        if to in self._price_feed_to_markets:
+            return {market: None for market in self._price_feed_to_markets[to]}
+
+        if to in self._markets:
+            market = self._markets[to]
+            func, args = self._decode(market, tx)
+            if func is not None and func.fn_name == 'setPoolInfo':
+                pool_info = _struct(func, args)
+                if pool_info.get('base', 0) > 0:
+                    return {market.address: pool_info['quote'] * Q96 // pool_info['base']}
+            return {market.address: None}
+
+        if to == self._exchange.address.lower():
+            func, args = self._decode(self._exchange, tx)
+            if func is None:
+                return {}
+            params = _struct(func, args)
+            market = params.get('market')
+            if isinstance(market, str) and market.lower() in self._markets:
+                return {self._markets[market.lower()].address: None}
+        return {}
+
+    def _decode(self, contract, tx):
+        try:
+            return contract.decode_function_input(tx['input'])
+        except Exception as e:
+            self._logger.debug(f'unknown function {e=}, {tx["hash"]=}')
+            return None, None
+
+
+def _struct(func, args: dict) -> dict:
+    # first argument of func as a dict (web3 decodes a struct as a tuple)
+    if len(args) == 0:
+        return {}
+    value = list(args.values())[0]
+    if isinstance(value, dict):
+        return value
+    components = func.abi['inputs'][0].get('components')
+    if components is None or not isinstance(value, (tuple, list)):
+        return {}
+    return dict(zip([component['name'] for component in components], value))
@@ -0,0 +1,103 @@
+import asyncio
+from logging import getLogger
+
+from src import metrics
+
+
+class BlockReadCache:
+    # Results of contract view calls pinned to a block number, shared by the liquidation jobs.
+    # - a read at a fixed block never changes, so entries are valid until the head advances past them
+    # - concurrent reads of the same key wait for the first one (single flight)
+    # - failed reads are not cached
+    # Reads at 'latest' or at a block older than the head bypass the cache.
+    def __init__(self, logger=None) -> None:
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+        self._block_number = None
+        # - key: (block number, read key)
+        # - value: asyncio.Future of the result
+        self._entries = {}
+
+    @property
+    def block_number(self) -> int:
+        return self._block_number
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def advance(self, block_number: int):
+        # evicts the reads of older blocks
+        if self._block_number is not None and block_number <= self._block_number:
+            return
+        self._block_number = block_number
+        self._entries = {key: future for key, future in self._entries.items() if key[0] >= block_number}
+
+    async def get_many(self, block_number, keys: list, fetch) -> list:
+        # fetch: async function of the missing keys returning their values in the same order
+        if not self._cacheable(block_number):
+            return await fetch(keys)
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        missing = []
+        for key in keys:
+            entry_key = (block_number, key)
+            future = self._entries.get(entry_key)
+            if future is None:
+                future = loop.create_future()
+                self._entries[entry_key] = future
+                missing.append((entry_key, future))
+            futures.append(future)
+        metrics.READ_CACHE_REQUESTS.inc(len(keys) - len(missing), result='hit')
+        metrics.READ_CACHE_REQUESTS.inc(len(missing), result='miss')
+
+        if len(missing) > 0:
+            # a separate task, so that cancelling this caller doesn't fail the others waiting for the same keys
+            fetch_keys = [entry_key[1] for entry_key, _ in missing]
+            loop.create_task(self._fill(missing, fetch(fetch_keys)))
+        return [await asyncio.shield(future) for future in futures]
+
+    async def get(self, block_number, key, fetch):
+        # fetch: async function without arguments
+        async def _fetch(keys):
+            return [await fetch()]
+        return (await self.get_many(block_number, [key], _fetch))[0]
+
+    def _cacheable(self, block_number) -> bool:
+        return (
+            isinstance(block_number, int)
+            and self._block_number is not None
+            and block_number >= self._block_number
+        )
+
+    async def _fill(self, missing: list, coro):
+        try:
+            values = await coro
+            if len(values) != len(missing):
+                raise ValueError(f'{len(missing)} values expected, got {len(values)}')
+        except Exception as e:
+            self._logger.debug(f'read failed {e=}')
+            for entry_key, future in missing:
+                if self._entries.get(entry_key) is future:
+                    del self._entries[entry_key]
+                if not future.done():
+                    future.set_exception(e)
+                    # consumed here in case every waiter was cancelled
+                    future.exception()
+            return
+
+        for (_, future), value in zip(missing, values):
+            if not future.done():
+                future.set_result(value)
+
+
+def contract_call_key(func) -> tuple:
+    # (address, function name, args) of a web3 ContractFunction
+    return (func.address, func.fn_name, _freeze(func.args))
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
@@ -0,0 +1,277 @@
+from collections import defaultdict
+from logging import getLogger
+
+from web3 import Web3
+
+from src import metrics
+
+Q96: int = 0x1000000000000000000000000  # same as 1 << 96
+
+# subset of PerpdexMarket
+MARKET_ABI = [
+    {
+        'name': 'getShareMarkPriceX96',
+        'type': 'function',
+        'stateMutability': 'view',
+        'inputs': [],
+        'outputs': [{'name': '', 'type': 'uint256'}],
+    },
+]
+
+
+class RiskEngine:
+    # Approximates margin ratios locally so that only accounts near the maintenance margin
+    # are confirmed on-chain.
+    #
+    # Each account is read on-chain (total account value and position share per market) when
+    # the trader emits an event or the read becomes too old. In between, the account value is
+    # moved linearly by the share mark price change of each market, which is fetched once per block:
+    #   account value = account value at read + sum(share * (price - price at read))
+    #   notional = sum(|share| * price)
+    #
+    # Accounts are estimated again only when something changed: the trader emitted an event, the read became
+    # too old, or the share mark price of one of their markets moved by price_threshold since the market's
+    # reference price. Accounts near the maintenance margin are estimated again on any price change of their
+    # markets, and accounts found unhealthy on-chain are returned until they are healthy.
+    #
+    # Maker liquidity is not modeled. Accounts with liquidity are treated as near the maintenance margin,
+    # so that they are checked on-chain whenever the price of one of their markets changes.
+    def __init__(self, exchange_contract, multicall=None, safety_band: float = 0.2, max_age_blocks: int = 300,
+                 price_threshold: float = 0.001, logger=None) -> None:
+        self._exchange = exchange_contract
+        self._w3 = exchange_contract.web3
+        self._multicall = multicall
+        self._safety_band = safety_band
+        self._max_age_blocks = max_age_blocks
+        self._price_threshold = price_threshold
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+
+        self._mm_ratio = None  # 1e6 = 100%
+        # - key: market address
+        # - value: share mark price X96 at the latest block
+        self._prices = {}
+        # - key: market address
+        # - value: share mark price X96 when the market's traders were estimated for a price move
+        self._reference_prices = {}
+        self._markets = {}
+        # - key: trader address
+        # - value: dict(block_number, account_value, shares, liquidity, prices)
+        self._accounts = {}
+        # - key: block number of the read
+        # - value: traders read at the block
+        self._read_traders = defaultdict(set)
+        # traders estimated below mmRatio * (1 + safety_band) or unknown
+        self._near_traders = set()
+        # traders found unhealthy on-chain
+        self._unhealthy_traders = set()
+
+    def screen(self, market_to_traders: dict, updated_traders: set, block_number: int) -> set:
+        # returns traders whose maintenance margin should be checked on-chain
+        trader_to_markets = defaultdict(set)
+        for market, traders in market_to_traders.items():
+            for trader in traders:
+                trader_to_markets[trader].add(market)
+
+        # forget accounts without open positions
+        for trader in list(self._accounts.keys()):
+            if trader not in trader_to_markets:
+                self._forget(trader)
+        self._near_traders &= trader_to_markets.keys()
+        self._unhealthy_traders &= trader_to_markets.keys()
+
+        if self._mm_ratio is None:
+            self._mm_ratio = self._call_batch([self._exchange.functions.mmRatio()], block_number)[0]
+            if self._mm_ratio is None:
+                self._logger.warning('failed to fetch mmRatio, check all traders on-chain')
+                return set(trader_to_markets.keys())
+
+        previous_prices = self._prices
+        self._update_prices(market_to_traders.keys(), block_number)
+        moved_markets = self._update_reference_prices(market_to_traders.keys())
+        changed_markets = {
+            market for market in market_to_traders.keys()
+            if market not in self._prices or self._prices[market] != previous_prices.get(market)
+        }
+
+        expired_traders = self._pop_expired_traders(block_number)
+        stale_traders = [
+            trader for trader, markets in trader_to_markets.items()
+            if trader in updated_traders
+            or trader in expired_traders
+            or trader not in self._accounts
+            or not markets.issubset(self._accounts[trader]['shares'].keys())
+        ]
+        self._update_accounts(stale_traders, trader_to_markets, block_number)
+
+        dirty_traders = set(stale_traders) | self._unhealthy_traders
+        for market in moved_markets:
+            dirty_traders |= market_to_traders[market]
+        dirty_traders |= {
+            trader for trader in self._near_traders
+            if not trader_to_markets[trader].isdisjoint(changed_markets)
+        }
+
+        candidates = set()
+        for trader in dirty_traders:
+            ratio = self.margin_ratio(trader)
+            if ratio is None or ratio < self._mm_ratio / 1e6 * (1 + self._safety_band) or self._is_maker(trader):
+                candidates.add(trader)
+                self._near_traders.add(trader)
+            else:
+                self._near_traders.discard(trader)
+        metrics.RECHECKED_TRADERS.set(len(dirty_traders))
+
+        self._logger.debug(
+            f'{block_number=} {len(trader_to_markets)=} {len(moved_markets)=} {len(stale_traders)=} '
+            f'{len(dirty_traders)=} {len(candidates)=}')
+        return candidates
+
+    def set_unhealthy_traders(self, traders: set):
+        # result of the on-chain check of the screened traders. they are screened again until healthy
+        self._unhealthy_traders = set(traders)
+
+    def margin_ratio(self, trader, prices: dict = None) -> float:
+        # None if unknown. inf if no position. prices overrides the share mark prices of the latest block
+        values = self._estimate(trader, prices)
+        if values is None:
+            return None
+        account_value, notional = values
+        if notional == 0:
+            return float('inf')
+        return account_value / notional
+
+    def estimate_shortfall(self, trader):
+        # returns (maintenance margin shortfall, notional) in quote. None if unknown
+        values = self._estimate(trader)
+        if values is None or self._mm_ratio is None:
+            return None
+        account_value, notional = values
+        return notional * self._mm_ratio // 10 ** 6 - account_value, notional
+
+    def simulate(self, market_prices: dict) -> set:
+        # returns (trader, market) of accounts estimated below the maintenance margin after the share mark prices
+        # of market_prices
+        if self._mm_ratio is None or len(market_prices) == 0:
+            return set()
+        prices = dict(self._prices, **market_prices)
+
+        # screen updates the accounts in the executor thread meanwhile
+        positions = set()
+        for trader, account in list(self._accounts.items()):
+            if account['liquidity'] > 0:
+                # not estimated, the price effect is unknown
+                continue
+            markets = [market for market, share in account['shares'].items() if share != 0]
+            if all(market not in market_prices for market in markets):
+                continue
+            ratio = self.margin_ratio(trader, prices)
+            if ratio is None or ratio < self._mm_ratio / 1e6:
+                positions.update((trader, market) for market in markets)
+        return positions
+
+    def _is_maker(self, trader) -> bool:
+        account = self._accounts.get(trader)
+        return account is not None and account['liquidity'] > 0
+
+    def _estimate(self, trader, prices: dict = None):
+        account = self._accounts.get(trader)
+        if account is None:
+            return None
+        prices = self._prices if prices is None else prices
+
+        account_value = account['account_value']
+        notional = 0
+        for market, share in account['shares'].items():
+            price = prices.get(market)
+            if price is None or account['prices'].get(market) is None:
+                return None
+            account_value += share * (price - account['prices'][market]) // Q96
+            notional += abs(share) * price // Q96
+        return account_value, notional
+
+    def _update_prices(self, markets, block_number: int):
+        markets = list(markets)
+        for market in markets:
+            if market not in self._markets:
+                self._markets[market] = self._w3.eth.contract(address=Web3.toChecksumAddress(market), abi=MARKET_ABI)
+
+        rets = self._call_batch(
+            [self._markets[market].functions.getShareMarkPriceX96() for market in markets],
+            block_number,
+        )
+        self._prices = {market: price for market, price in zip(markets, rets) if price is not None}
+
+    def _update_reference_prices(self, markets) -> set:
+        # returns markets whose price moved by price_threshold (or is unknown) since the reference price
+        moved_markets = set()
+        for market in markets:
+            price = self._prices.get(market)
+            reference_price = self._reference_prices.get(market)
+            if (price is None or reference_price is None
+                    or abs(price - reference_price) >= reference_price * self._price_threshold):
+                moved_markets.add(market)
+                self._reference_prices[market] = price
+        return moved_markets
+
+    def _pop_expired_traders(self, block_number: int) -> set:
+        expired_traders = set()
+        for read_block_number in list(self._read_traders.keys()):
+            if block_number - read_block_number >= self._max_age_blocks:
+                expired_traders |= self._read_traders.pop(read_block_number)
+        return expired_traders
+
+    def _forget(self, trader):
+        account = self._accounts.pop(trader, None)
+        if account is not None:
+            self._read_traders[account['block_number']].discard(trader)
+
+    def _update_accounts(self, traders: list, trader_to_markets: dict, block_number: int):
+        funcs = []
+        for trader in traders:
+            funcs.append(self._exchange.functions.getTotalAccountValue(trader))
+            for market in sorted(trader_to_markets[trader]):
+                funcs.append(self._exchange.functions.getPositionShare(trader, market))
+                funcs.append(self._exchange.functions.getMakerInfo(trader, market))
+
+        rets = iter(self._call_batch(funcs, block_number))
+        for trader in traders:
+            markets = sorted(trader_to_markets[trader])
+            account_value = next(rets)
+            shares = {}
+            maker_infos = []
+            for market in markets:
+                shares[market] = next(rets)
+                maker_infos.append(next(rets))
+            self._forget(trader)
+            if account_value is None or any(value is None for value in list(shares.values()) + maker_infos):
+                continue
+
+            self._read_traders[block_number].add(trader)
+            self._accounts[trader] = dict(
+                block_number=block_number,
+                account_value=account_value,
+                shares=shares,
+                liquidity=sum(maker_info[0] for maker_info in maker_infos),
+                prices={market: self._prices.get(market) for market in markets},
+            )
+
+    def _call_batch(self, funcs: list, block_number: int) -> list:
+        # returns None for failed calls
+        if self._multicall is not None:
+            try:
+                return [
+                    ret for batch in self._multicall.split(funcs)
+                    for ret in self._multicall.try_aggregate(batch, block_identifier=block_number)
+                ]
+            except Exception as e:
+                self._logger.warning(f'multicall failed {e=}')
+                return [None] * len(funcs)
+
+        rets = []
+        for func in funcs:
+            try:
+                rets.append(func.call(block_identifier=block_number))
+            except Exception as e:
+                self._logger.debug(f'call failed {e=}, {func=}')
+                rets.append(None)
+        return rets
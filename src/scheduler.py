@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+import itertools
+from collections import deque
+from logging import getLogger
+
+
+class LiquidationScheduler:
+    # Runs liquidation jobs keyed by (trader, market) on a fixed number of workers.
+    # A key stays registered from submit until its job finishes, so duplicate work
+    # for a position which is queued or still running is merged into the existing job.
+    #
+    # Queued jobs are dispatched in descending priority order (e.g. (shortfall, notional)).
+    # - starvation: every fairness_interval-th dispatch takes the oldest queued job instead
+    # - block_budget: max number of jobs dispatched per block (None means unlimited)
+    def __init__(
+        self,
+        max_concurrency: int = 32,
+        max_queue_size: int = 10000,
+        fairness_interval: int = 10,
+        block_budget: int = None,
+        logger=None,
+    ) -> None:
+        self._max_concurrency = max_concurrency
+        self._max_queue_size = max_queue_size
+        self._fairness_interval = fairness_interval
+        self._block_budget = block_budget
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+
+        self._workers = []
+        self._wakeup: asyncio.Event = None
+        self._idle: asyncio.Event = None
+
+        # entries are removed lazily from the heap and the fifo
+        # - heap entry: [sort key, seq, key, func, args, valid]
+        # - fifo entry: (seq, key)
+        self._heap = []
+        self._fifo = deque()
+        self._queued = {}  # key -> entry
+        self._running = set()
+        self._seq = itertools.count()
+        self._dispatch_count = 0
+        self._block_dispatch_count = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queued)
+
+    @property
+    def in_flight_count(self) -> int:
+        return len(self._running)
+
+    def is_scheduled(self, key) -> bool:
+        return key in self._queued or key in self._running
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        if len(self._queued) == 0:
+            self._idle.set()
+        else:
+            self._wakeup.set()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._max_concurrency)]
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        self._heap.clear()
+        self._fifo.clear()
+        self._queued.clear()
+        self._running.clear()
+
+    def begin_block(self, block_number: int):
+        # resets the per block budget
+        self._block_dispatch_count = 0
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def submit(self, key, func, *args, priority=0) -> bool:
+        # returns False if the job is merged into the existing one or rejected
+        if key in self._running:
+            return False
+
+        sort_key = _negate(priority)
+        if key in self._queued:
+            entry = self._queued[key]
+            if sort_key < entry[0]:
+                # raise the priority of the queued job
+                entry[5] = False
+                self._push(sort_key, entry[1], key, func, args)
+            return False
+
+        if self.queue_depth >= self._max_queue_size:
+            self._logger.warning(f'Liquidation queue is full. {key=}, {self._max_queue_size=}')
+            return False
+
+        self._push(sort_key, next(self._seq), key, func, args)
+        return True
+
+    async def join(self):
+        await self._idle.wait()
+
+    def _push(self, sort_key, seq, key, func, args):
+        entry = [sort_key, seq, key, func, args, True]
+        if key not in self._queued and self._fairness_interval is not None:
+            # re-prioritized job keeps its place in the fifo
+            self._fifo.append((seq, key))
+        self._queued[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._wakeup is not None:
+            self._idle.clear()
+            self._wakeup.set()
+
+    def _can_dispatch(self) -> bool:
+        if len(self._queued) == 0:
+            return False
+        return self._block_budget is None or self._block_dispatch_count < self._block_budget
+
+    def _pop(self):
+        use_fifo = (self._fairness_interval is not None
+                    and self._dispatch_count % self._fairness_interval == self._fairness_interval - 1)
+        while True:
+            if use_fifo:
+                seq, key = self._fifo.popleft()
+                entry = self._queued.get(key)
+                if entry is not None and entry[1] == seq:
+                    break
+            else:
+                entry = heapq.heappop(self._heap)
+                if entry[5] and self._queued.get(entry[2]) is entry:
+                    break
+
+        entry[5] = False
+        del self._queued[entry[2]]
+        self._dispatch_count += 1
+        self._block_dispatch_count += 1
+        return entry
+
+    async def _worker(self):
+        while True:
+            while not self._can_dispatch():
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            _, _, key, func, args, _ = self._pop()
+            self._running.add(key)
+            try:
+                await func(*args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._logger.warning(f'liquidation job raises {e=}, {key=}')
+            finally:
+                self._running.discard(key)
+                if len(self._queued) == 0 and len(self._running) == 0:
+                    self._idle.set()
+
+
+def _negate(priority):
+    if isinstance(priority, tuple):
+        return tuple(-p for p in priority)
+    return -priority
@@ -0,0 +1,73 @@
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from logging import getLogger
+
+from src.nonce_manager import NonceManager
+
+
+class SenderPool:
+    # Liquidation transactions are sent from several accounts, each with its own nonce sequence and gas balance,
+    # so that independent liquidations don't wait for each other on one account.
+    # A job borrows the sender with the fewest jobs in use (then the fewest pending transactions).
+    def __init__(self, w3, accounts: list, executor, logger=None, **nonce_manager_kwargs) -> None:
+        self._w3 = w3
+        self._executor = executor
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+
+        if len(accounts) == 0:
+            raise ValueError('SenderPool needs at least one account')
+
+        self._senders = [
+            NonceManager(w3=w3, account=account, executor=executor, **nonce_manager_kwargs)
+            for account in accounts
+        ]
+        # - key: sender address
+        # - value: number of jobs using the sender
+        self._in_use = {sender.address: 0 for sender in self._senders}
+        self._round_robin = itertools.count()
+
+    @property
+    def senders(self) -> list:
+        return list(self._senders)
+
+    @property
+    def addresses(self) -> list:
+        return [sender.address for sender in self._senders]
+
+    def acquire(self) -> NonceManager:
+        # ties are broken round robin so that idle accounts are used evenly
+        offset = next(self._round_robin)
+        count = len(self._senders)
+        sender = min(
+            (self._senders[(offset + i) % count] for i in range(count)),
+            key=lambda sender: (self._in_use[sender.address], sender.pending_count),
+        )
+        self._in_use[sender.address] += 1
+        return sender
+
+    def release(self, sender: NonceManager):
+        self._in_use[sender.address] -= 1
+
+    @asynccontextmanager
+    async def sender(self):
+        sender = self.acquire()
+        try:
+            yield sender
+        finally:
+            self.release(sender)
+
+    async def stats(self) -> list:
+        # balance (wei), pending transactions and jobs in use per sender
+        balances = await asyncio.gather(*[
+            self._executor.run(self._w3.eth.get_balance, sender.address) for sender in self._senders
+        ], return_exceptions=True)
+        return [
+            dict(
+                address=sender.address,
+                balance=None if isinstance(balance, Exception) else balance,
+                pending_count=sender.pending_count,
+                in_use=self._in_use[sender.address],
+            )
+            for sender, balance in zip(self._senders, balances)
+        ]
@@ -0,0 +1,88 @@
+import asyncio
+import os
+from logging import getLogger
+
+from src import metrics
+from src.block_watcher import BlockWatcher
+from src.contracts.utils import get_w3
+from src.event_indexer import PerpdexEventIndexer
+from src.executor import AsyncExecutor
+from src.liquidator import get_multicall, get_perpdex_exchange_contract, get_subscription_uri
+from src.sharding import ShardCoordinator, TraderSetPublisher, get_shard_redis_client
+
+
+class ShardIndexer:
+    # Indexer process of the sharded mode: indexes the exchange events once and publishes the trader set
+    # for the workers. Other indexer processes wait as standby while the leader's lease is alive.
+    def __init__(self, logger=None) -> None:
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+
+        self._w3, _ = get_w3(
+            network_name=os.environ['WEB3_NETWORK_NAME'],
+            web3_provider_uri=os.environ['WEB3_PROVIDER_URI'],
+            websocket_pool_size=int(os.environ.get('WEB3_WEBSOCKET_POOL_SIZE', 8)),
+            http_timeout=float(os.environ.get('WEB3_HTTP_TIMEOUT', 10)),
+            batch_window=float(os.environ.get('WEB3_BATCH_WINDOW', 0.002)),
+            max_batch_size=int(os.environ.get('WEB3_MAX_BATCH_SIZE', 50)),
+            hedge_delay=float(os.environ.get('WEB3_HEDGE_DELAY', 0.3)),
+        )
+        self._w3.middleware_onion.add(metrics.rpc_metrics_middleware, name='metrics')
+
+        self._perpdex_exchange_event_indexer = PerpdexEventIndexer(
+            contract=get_perpdex_exchange_contract(self._w3),
+            multicall=get_multicall(self._w3),
+        )
+        redis_client = get_shard_redis_client()
+        self._publisher = TraderSetPublisher(redis_client)
+        self._coordinator = ShardCoordinator(redis_client, worker_id=os.environ.get('SHARD_WORKER_ID'))
+        self._lease_ttl = float(os.environ.get('SHARD_HEARTBEAT_TTL', 10))
+        self._is_leader = False
+
+        self._executor = AsyncExecutor(max_workers=8, thread_name_prefix=self.__class__.__name__)
+        self._block_watcher = BlockWatcher(
+            w3=self._w3,
+            executor=self._executor,
+            web3_provider_uri=get_subscription_uri(os.environ['WEB3_PROVIDER_URI']),
+            min_poll_interval=float(os.environ.get('LIQUIDATOR_MIN_POLL_INTERVAL', 0.2)),
+            max_poll_interval=float(os.environ.get('LIQUIDATOR_MAX_POLL_INTERVAL', 5.0)),
+        )
+
+        self._task: asyncio.Task = None
+
+    def health_check(self) -> bool:
+        return not self._task.done()
+
+    def start(self):
+        self._task = asyncio.create_task(self._main())
+
+    async def _main(self):
+        self._logger.info('Start shard indexer')
+        self._block_watcher.start()
+        lease_task = asyncio.create_task(self._renew_lease())
+        try:
+            while True:
+                block_number = await self._block_watcher.wait_for_new_block()
+                if not self._is_leader:
+                    continue
+
+                market_to_traders = await self._executor.run(
+                    self._perpdex_exchange_event_indexer.fetch_market_to_traders, block_number)
+                updated_traders = self._perpdex_exchange_event_indexer.pop_updated_traders()
+                last_block_number = self._perpdex_exchange_event_indexer.last_block_number
+                await self._executor.run(
+                    self._publisher.publish, last_block_number, market_to_traders, updated_traders)
+                metrics.INDEXER_LAG_BLOCKS.set(block_number - last_block_number)
+                self._logger.debug(f'{block_number=}, {len(updated_traders)=}')
+        finally:
+            lease_task.cancel()
+            self._block_watcher.stop()
+            self._executor.shutdown()
+
+    async def _renew_lease(self):
+        # the lease expires lease_ttl after this process stops renewing it
+        while True:
+            is_leader = await self._executor.run(self._coordinator.claim, 'indexer', self._lease_ttl)
+            if is_leader != self._is_leader:
+                self._logger.info('leader' if is_leader else 'standby')
+                self._is_leader = is_leader
+            await asyncio.sleep(self._lease_ttl / 3)
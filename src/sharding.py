@@ -0,0 +1,249 @@
+import bisect
+import hashlib
+import json
+import os
+import socket
+import time
+import uuid
+from collections import defaultdict
+from logging import getLogger
+
+from redis_namespace import StrictRedis
+
+# Sharded mode: one indexer process publishes the trader set through redis (TraderSetPublisher),
+# worker processes read it (SharedTraderSet) and each scans the traders it owns on a consistent hash ring
+# of the live workers (ShardCoordinator).
+
+
+class HashRing:
+    # consistent hashing with virtual nodes. a joining or leaving member moves about 1 / members of the keys
+    def __init__(self, members: list, replicas: int = 64) -> None:
+        self._members = sorted(set(members))
+        self._ring = sorted(
+            (_hash(f'{member}#{i}'), member)
+            for member in self._members
+            for i in range(replicas)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    @property
+    def members(self) -> list:
+        return list(self._members)
+
+    def owner(self, key: str) -> str:
+        if len(self._ring) == 0:
+            return None
+        i = bisect.bisect(self._points, _hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+class ShardCoordinator:
+    # Membership, trader ownership and claims of one worker.
+    # - members heartbeat into a sorted set scored by expiry time. a worker which stops heartbeating
+    #   drops out after heartbeat_ttl and the ring is rebuilt by the others
+    # - claims are keys set with NX PX, so that a position is liquidated by one worker at a time
+    #   even while workers disagree on the ring during a rebalance. the owner renews a claim while the
+    #   liquidation is in flight, and renews and releases it only if the value is still its worker id
+    def __init__(self, redis_client, worker_id: str = None, heartbeat_ttl: float = 10.0, claim_ttl: float = 60.0,
+                 replicas: int = 64, logger=None) -> None:
+        self._redis_client = redis_client
+        self._worker_id = create_worker_id() if worker_id is None else worker_id
+        self._heartbeat_ttl = heartbeat_ttl
+        self._claim_ttl = claim_ttl
+        self._replicas = replicas
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+
+        self._ring = HashRing([self._worker_id], replicas=replicas)
+        # - key: trader
+        # - value: owned or not. cleared when the ring changes
+        self._owns_cache = {}
+
+    @property
+    def worker_id(self) -> str:
+        return self._worker_id
+
+    @property
+    def members(self) -> list:
+        return self._ring.members
+
+    @property
+    def heartbeat_interval(self) -> float:
+        return self._heartbeat_ttl / 3
+
+    @property
+    def claim_renew_interval(self) -> float:
+        return self._claim_ttl / 3
+
+    def heartbeat(self) -> bool:
+        # returns True when the members changed
+        now = time.time()
+        pipeline = self._redis_client.pipeline(transaction=False)
+        pipeline.zadd(_MEMBERS_KEY, {self._worker_id: now + self._heartbeat_ttl})
+        pipeline.zremrangebyscore(_MEMBERS_KEY, '-inf', now)
+        pipeline.zrangebyscore(_MEMBERS_KEY, now, '+inf')
+        members = [_to_str(member) for member in pipeline.execute()[-1]]
+        if self._worker_id not in members:
+            members.append(self._worker_id)
+
+        if sorted(members) == self._ring.members:
+            return False
+        self._logger.info(f'rebalance {self._ring.members} -> {sorted(members)}')
+        self._ring = HashRing(members, replicas=self._replicas)
+        self._owns_cache = {}
+        return True
+
+    def leave(self):
+        self._redis_client.zrem(_MEMBERS_KEY, self._worker_id)
+
+    def owns(self, trader: str) -> bool:
+        owned = self._owns_cache.get(trader)
+        if owned is None:
+            owned = self._ring.owner(trader.lower()) == self._worker_id
+            self._owns_cache[trader] = owned
+        return owned
+
+    def claim(self, key: str, ttl: float = None) -> bool:
+        # True if the claim is taken or renewed by this worker. False on redis errors
+        ttl_ms = int(1000 * (self._claim_ttl if ttl is None else ttl))
+        claim_key = _CLAIM_KEY_PREFIX + key
+        try:
+            if self._redis_client.set(claim_key, self._worker_id, nx=True, px=ttl_ms):
+                return True
+            return self._redis_client.eval(_RENEW_SCRIPT, 1, claim_key, self._worker_id, ttl_ms) == 1
+        except Exception as e:
+            self._logger.warning(f'claim failed {key=} {e=}')
+        return False
+
+    def renew(self, key: str) -> bool:
+        # extends a claim of this worker. False if it expired and may be taken by another worker
+        ttl_ms = int(1000 * self._claim_ttl)
+        try:
+            return self._redis_client.eval(_RENEW_SCRIPT, 1, _CLAIM_KEY_PREFIX + key, self._worker_id, ttl_ms) == 1
+        except Exception as e:
+            self._logger.warning(f'renew failed {key=} {e=}')
+        return False
+
+    def release(self, key: str):
+        try:
+            self._redis_client.eval(_RELEASE_SCRIPT, 1, _CLAIM_KEY_PREFIX + key, self._worker_id)
+        except Exception as e:
+            self._logger.warning(f'release failed {key=} {e=}')
+
+
+class TraderSetPublisher:
+    # writes the indexed trader set of the indexer process.
+    # the snapshot is rewritten only when it changes, updated traders are appended per block to a capped list
+    def __init__(self, redis_client, max_updates: int = 1000) -> None:
+        self._redis_client = redis_client
+        self._max_updates = max_updates
+        self._snapshot = None
+
+    def publish(self, block_number: int, market_to_traders: dict, updated_traders: set):
+        snapshot = json.dumps(
+            {market: sorted(traders) for market, traders in sorted(market_to_traders.items())},
+            separators=(',', ':'),
+        )
+        pipeline = self._redis_client.pipeline(transaction=True)
+        if snapshot != self._snapshot:
+            pipeline.set(_SNAPSHOT_KEY, snapshot)
+            pipeline.set(_SNAPSHOT_BLOCK_NUMBER_KEY, block_number)
+        if len(updated_traders) > 0:
+            pipeline.rpush(_UPDATES_KEY, json.dumps(
+                dict(block_number=block_number, traders=sorted(updated_traders)), separators=(',', ':')))
+            pipeline.ltrim(_UPDATES_KEY, -self._max_updates, -1)
+        pipeline.set(_BLOCK_NUMBER_KEY, block_number)
+        pipeline.execute()
+        self._snapshot = snapshot
+
+
+class SharedTraderSet:
+    # reads what TraderSetPublisher writes. same interface as PerpdexEventIndexer for the liquidator
+    def __init__(self, redis_client, logger=None) -> None:
+        self._redis_client = redis_client
+        self._logger = getLogger(self.__class__.__name__) if logger is None else logger
+        self.market_to_traders = defaultdict(set)
+        self._updated_traders = set()
+        self._snapshot_block_number = None
+        self._updates_block_number = None
+        self._last_block_number = -1
+
+    @property
+    def last_block_number(self) -> int:
+        # the last block indexed by the indexer process
+        return self._last_block_number
+
+    def fetch_market_to_traders(self, block_number: int = None):
+        snapshot_block_number, last_block_number = self._redis_client.mget(
+            [_SNAPSHOT_BLOCK_NUMBER_KEY, _BLOCK_NUMBER_KEY])
+        if last_block_number is None:
+            self._logger.warning('trader set is not published yet. is the indexer process running?')
+            return self.market_to_traders
+        self._last_block_number = int(last_block_number)
+
+        snapshot_block_number = None if snapshot_block_number is None else int(snapshot_block_number)
+        if snapshot_block_number is not None and snapshot_block_number != self._snapshot_block_number:
+            snapshot = json.loads(self._redis_client.get(_SNAPSHOT_KEY))
+            self.market_to_traders = defaultdict(set, {
+                market: set(traders) for market, traders in snapshot.items()
+            })
+            self._snapshot_block_number = snapshot_block_number
+
+        updates = [json.loads(update) for update in self._redis_client.lrange(_UPDATES_KEY, 0, -1)]
+        if self._updates_block_number is None:
+            # first read. the liquidator checks every trader once anyway
+            pass
+        elif len(updates) > 0 and updates[0]['block_number'] > self._updates_block_number + 1:
+            # updates were trimmed before this worker read them
+            self._logger.info('missed trader updates, treat every trader as updated')
+            self._updated_traders |= set().union(*self.market_to_traders.values())
+        for update in updates:
+            if self._updates_block_number is None or update['block_number'] > self._updates_block_number:
+                self._updated_traders.update(update['traders'])
+        self._updates_block_number = max(
+            [update['block_number'] for update in updates] + [self._updates_block_number or -1])
+        return self.market_to_traders
+
+    def pop_updated_traders(self) -> set:
+        updated_traders = self._updated_traders
+        self._updated_traders = set()
+        return updated_traders
+
+
+def create_worker_id() -> str:
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def get_shard_redis_client():
+    return StrictRedis.from_url(
+        os.environ['REDIS_URL'],
+        namespace='{}:Shard:'.format(os.environ['WEB3_NETWORK_NAME']),
+    )
+
+
+_MEMBERS_KEY = 'members'
+_CLAIM_KEY_PREFIX = 'claim:'
+# compare-and-set of the claims: KEYS[1] claim key, ARGV[1] worker id
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_SNAPSHOT_KEY = 'trader_set:snapshot'
+_SNAPSHOT_BLOCK_NUMBER_KEY = 'trader_set:snapshot_block_number'
+_UPDATES_KEY = 'trader_set:updates'
+_BLOCK_NUMBER_KEY = 'trader_set:block_number'
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+def _to_str(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
@@ -1,4 +1,9 @@
+import json
 import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 from eth_account import Account
 
 
@@ -6,3 +11,66 @@ def mock_eth_account(mocker):
     acct = Account.create('KEYSMASH FJAFJKLDSKF7JKFDJ 1530')
     mocker.patch.dict(os.environ, {'USER_PRIVATE_KEY': '0' * 32})
     mocker.patch.object(Account, 'from_key', return_value=acct)
+
+
+class StubNode:
+    # minimal JSON-RPC server. eth_call returns its params[0]['data'], most methods return the method name
+    # - delay: seconds before responding
+    # - status: http status code (e.g. 500, 429)
+    # - error: JSON-RPC error returned for every request
+    def __init__(self, batch_supported=True, delay=0, status=200, error=None) -> None:
+        self.payloads = []
+        self.batch_supported = batch_supported
+        self.delay = delay
+        self.status = status
+        self.error = error
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                node.payloads.append(payload)
+                time.sleep(node.delay)
+                if isinstance(payload, list):
+                    if node.batch_supported:
+                        response = [node.respond(request) for request in reversed(payload)]
+                    else:
+                        response = {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': 'batch'}}
+                else:
+                    response = node.respond(payload)
+                body = json.dumps(response).encode()
+                self.send_response(node.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.uri = f'http://127.0.0.1:{self._server.server_address[1]}'
+        threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+
+    def wait_for_payloads(self, count: int, timeout: float = 1):
+        deadline = time.monotonic() + timeout
+        while len(self.payloads) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def methods(self) -> list:
+        return [payload['method'] for payload in self.payloads if isinstance(payload, dict)]
+
+    def respond(self, request):
+        if self.error is not None:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'error': self.error}
+        if request['method'] == 'eth_call':
+            result = request['params'][0]['data']
+        elif request['method'] == 'eth_chainId':
+            result = '0x7a69'
+        else:
+            result = request['method']
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,38 @@
+import json
+
+from benchmarks.load_hardhat import plan_collaterals
+from benchmarks.run import run_benchmarks
+
+
+def test_run_benchmarks(tmp_path):
+    output = tmp_path / 'results.json'
+
+    run_benchmarks(traders=20, markets=2, blocks=3000, latency=0, max_get_logs_results=10, scan_cycles=2,
+                   output=str(output))
+
+    report = json.loads(output.read_text())
+    results = report['results']
+    assert results['get_events']['event_count'] == 40
+    assert results['backfill']['cold']['position_count'] == 40
+    # the cached chunks are not fetched again
+    assert results['backfill']['warm']['rpc_request_count'].get('eth_getLogs', 0) < \
+        results['backfill']['cold']['rpc_request_count']['eth_getLogs']
+    assert results['scan_cycle']['first']['checked_trader_count'] == 20
+    assert len(results['scan_cycle_risk_engine']['cycles']) == 2
+
+
+def test_plan_collaterals():
+    size, price, im_ratio, mm_ratio = 0.01, 100, 0.1, 0.05
+    plan = plan_collaterals(size, price, im_ratio, mm_ratio)
+
+    # both can open the position
+    assert plan['underwater'] >= im_ratio * size * price
+    assert plan['healthy'] >= im_ratio * size * price
+    assert plan['moved_price'] < price
+
+    def account_value(collateral):
+        return collateral + size * (plan['moved_price'] - price)
+
+    mm = mm_ratio * size * plan['moved_price']
+    assert account_value(plan['underwater']) < mm
+    assert account_value(plan['healthy']) > 2 * mm
@@ -0,0 +1,48 @@
+import pytest
+from src.block_watcher import BlockWatcher
+from src.executor import AsyncExecutor
+
+
+class TestBlockWatcher:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.w3 = mocker.MagicMock()
+        self.block_numbers = mocker.PropertyMock()
+        type(self.w3.eth).block_number = self.block_numbers
+
+        self.executor = AsyncExecutor(max_workers=1)
+        self.watcher = BlockWatcher(
+            w3=self.w3,
+            executor=self.executor,
+            min_poll_interval=0.01,
+            max_poll_interval=0.05,
+        )
+        yield
+        self.watcher.stop()
+        self.executor.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_skip_unchanged_block(self):
+        self.block_numbers.side_effect = [10, 10, 10, 11, 13]
+        self.watcher.start()
+
+        assert await self.watcher.wait_for_new_block() == 10
+        assert await self.watcher.wait_for_new_block() == 11
+        assert await self.watcher.wait_for_new_block() == 13
+        assert self.block_numbers.call_count == 5
+
+    @pytest.mark.asyncio
+    async def test_block_interval(self):
+        self.block_numbers.side_effect = [10, 11, 12]
+        self.watcher.start()
+
+        for _ in range(3):
+            await self.watcher.wait_for_new_block()
+        assert self.watcher.block_interval is not None
+        assert 0.01 <= self.watcher._next_poll_interval() <= 0.05
+
+    @pytest.mark.asyncio
+    async def test_no_subscription_for_http(self):
+        watcher = BlockWatcher(w3=self.w3, executor=self.executor, web3_provider_uri='http://localhost:8545')
+        watcher.start()
+        assert watcher._subscription_task is None
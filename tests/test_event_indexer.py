@@ -1,9 +1,17 @@
+import json
 import os
 from logging import config
 
 import pytest
 import yaml
-from src.event_indexer import PerpdexEventIndexer
+from hexbytes import HexBytes
+from src import metrics
+from src.event_indexer import (PerpdexEventIndexer, _decode_events, _encode_events, _is_result_size_error, get_events,
+                               get_topic_to_event_abi)
+from web3 import Web3
+from web3._utils.events import event_abi_to_log_topic
+
+from benchmarks.fake_redis import FakeRedis
 from src.liquidator import get_perpdex_exchange_contract, get_w3
 
 with open("main_logger_config.yml", encoding='UTF-8') as f:
@@ -31,7 +39,7 @@ class TestPerpdexEventIndexer:
 
         n = 10
         for _ in range(n):
-            self._indexer._cached_fetch_events(from_block, to_block)
+            self._indexer._fetch_chunks([(from_block, to_block)])
         assert mocked.call_count == n
 
     def test_cache_hit(self, mocker):
@@ -42,7 +50,7 @@ class TestPerpdexEventIndexer:
 
         n = 10
         for _ in range(n):
-            self._indexer._cached_fetch_events(from_block, to_block)
+            self._indexer._fetch_chunks([(from_block, to_block)])
         assert mocked.call_count == 1
 
     def test_process_event(self, mocker):
@@ -58,3 +66,482 @@ class TestPerpdexEventIndexer:
 
     def test_smoke(self):
         self._indexer.fetch_market_to_traders()
+
+
+EVENT_ABI = [
+    {
+        'type': 'event',
+        'name': 'PositionChanged',
+        'anonymous': False,
+        'inputs': [
+            {'name': 'trader', 'type': 'address', 'indexed': True},
+            {'name': 'market', 'type': 'address', 'indexed': True},
+            {'name': 'base', 'type': 'int256', 'indexed': False},
+        ],
+    },
+    {
+        'type': 'event',
+        'name': 'Deposited',
+        'anonymous': False,
+        'inputs': [
+            {'name': 'trader', 'type': 'address', 'indexed': True},
+            {'name': 'amount', 'type': 'uint256', 'indexed': False},
+        ],
+    },
+]
+
+
+def _create_log(w3, abi, topics, data_types, data_values, block_number, log_index):
+    return {
+        'address': '0x' + '12' * 20,
+        'topics': [event_abi_to_log_topic(abi)] + [HexBytes(t.rjust(32, b'\0')) for t in topics],
+        'data': w3.toHex(w3.codec.encode_abi(data_types, data_values)),
+        'blockNumber': block_number,
+        'blockHash': HexBytes(b'\1' * 32),
+        'transactionHash': HexBytes(b'\2' * 32),
+        'transactionIndex': 0,
+        'logIndex': log_index,
+    }
+
+
+def test_get_events_decode_by_topic(mocker):
+    w3 = Web3()
+    contract = w3.eth.contract(address=Web3.toChecksumAddress('0x' + '12' * 20), abi=EVENT_ABI)
+    trader = b'\x34' * 20
+    market = b'\x56' * 20
+
+    topic_to_event_abi = get_topic_to_event_abi(contract, ['PositionChanged', 'NotFound'])
+    assert list(topic_to_event_abi.keys()) == [event_abi_to_log_topic(EVENT_ABI[0])]
+
+    logs = [
+        _create_log(w3, EVENT_ABI[0], [trader, market], ['int256'], [-1], 2, 0),
+        _create_log(w3, EVENT_ABI[1], [trader], ['uint256'], [1], 1, 0),
+        _create_log(w3, EVENT_ABI[0], [trader, market], ['int256'], [3], 1, 1),
+    ]
+    get_logs = mocker.patch.object(w3.eth, 'get_logs', return_value=logs)
+
+    events = get_events(contract, 0, 10, topic_to_event_abi=topic_to_event_abi)
+
+    # only topics consumed are requested
+    assert get_logs.call_args[0][0]['topics'] == [[w3.toHex(event_abi_to_log_topic(EVENT_ABI[0]))]]
+    # logs of the other events are ignored
+    assert [e['event'] for e in events] == ['PositionChanged', 'PositionChanged']
+    assert [e['args']['base'] for e in events] == [3, -1]
+    assert events[0]['args']['trader'] == Web3.toChecksumAddress(trader)
+
+
+@pytest.mark.parametrize('message, expected', [
+    ({'code': -32005, 'message': 'query returned more than 10000 results'}, True),
+    ({'code': -32602, 'message': 'Log response size exceeded. You can make eth_getLogs requests with up to a 2K '
+                                 'block range and no limit on the response size'}, True),
+    ({'code': -32000, 'message': 'block range is too wide'}, True),
+    ({'code': -32005, 'message': 'daily request count exceeded, request rate limited'}, False),
+    ({'code': 429, 'message': 'Too Many Requests: limit exceeded'}, False),
+    ({'code': -32000, 'message': 'header not found'}, False),
+])
+def test_is_result_size_error(message, expected):
+    assert _is_result_size_error(ValueError(message)) is expected
+
+
+class TestEventIndexerBackfill:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch.dict(os.environ, {'WEB3_NETWORK_NAME': 'localhost'})
+        contract = Web3().eth.contract(address=Web3.toChecksumAddress('0x' + '12' * 20), abi=EVENT_ABI)
+        self._redis_client = FakeRedis()
+        mocker.patch.object(PerpdexEventIndexer, '_get_block_hash', return_value='0x01')
+        self._indexer = PerpdexEventIndexer(
+            contract=contract,
+            redis_client=self._redis_client,
+            start_block_number=1,
+            get_logs_limit=10,
+            backfill_workers=4,
+            checkpoint_interval=-1,
+            confirmations=0,
+        )
+        self._indexer._retry_interval = 0
+        self._processed = []
+        mocker.patch.object(self._indexer, '_process_event', side_effect=self._processed.append)
+
+    def _events(self, from_block, to_block):
+        return [
+            {'event': 'PositionChanged', 'blockNumber': b, 'logIndex': 0, 'args': {}}
+            for b in range(from_block, to_block + 1)
+        ]
+
+    def test_backfill_in_order_with_retry(self, mocker):
+        failed = set()
+
+        def _get_events(contract, from_block, to_block, **kwargs):
+            # first attempt of the second chunk fails
+            if from_block == 11 and from_block not in failed:
+                failed.add(from_block)
+                raise ValueError('temporary error')
+            return self._events(from_block, to_block)
+
+        mocked = mocker.patch('src.event_indexer.get_events', side_effect=_get_events)
+
+        self._indexer._fetch_events(block_number=46)
+
+        assert [e['blockNumber'] for e in self._processed] == list(range(1, 47))
+        assert self._indexer._last_block_number == 46
+        assert mocked.call_count == 6
+        # full chunks are cached
+        assert len(self._redis_client.store) == 4
+
+    def test_stop_at_failed_chunk(self, mocker):
+        def _get_events(contract, from_block, to_block, **kwargs):
+            if from_block == 11:
+                raise ValueError('permanent error')
+            return self._events(from_block, to_block)
+
+        mocker.patch('src.event_indexer.get_events', side_effect=_get_events)
+
+        self._indexer._fetch_events(block_number=46)
+
+        assert [e['blockNumber'] for e in self._processed] == list(range(1, 11))
+        assert self._indexer._last_block_number == 10
+
+    def test_shrink_range_on_result_size_error(self, mocker):
+        def _get_events(contract, from_block, to_block, **kwargs):
+            if to_block - from_block + 1 > 3:
+                raise ValueError({'code': -32005, 'message': 'query returned more than 10000 results'})
+            return self._events(from_block, to_block)
+
+        mocker.patch('src.event_indexer.get_events', side_effect=_get_events)
+
+        self._indexer._fetch_events(block_number=11)
+
+        assert [e['blockNumber'] for e in self._processed] == list(range(1, 12))
+        assert self._indexer._get_logs_range < 10
+
+    def test_default_max_get_logs_range(self):
+        assert self._indexer._get_logs_range == 10
+        assert self._indexer._max_get_logs_range == 100
+
+    def test_grow_range_over_sparse_blocks(self, mocker):
+        self._indexer._get_logs_range = 1
+        self._indexer._max_get_logs_range = 8
+        mocked = mocker.patch('src.event_indexer.get_events', return_value=[])
+
+        self._indexer._fetch_events(block_number=31)
+
+        assert self._indexer._last_block_number == 31
+        assert self._indexer._get_logs_range > 1
+        assert mocked.call_count < 30
+
+
+class TestEventIndexerCheckpoint:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch.dict(os.environ, {'WEB3_NETWORK_NAME': 'localhost'})
+        self._contract = Web3().eth.contract(address=Web3.toChecksumAddress('0x' + '12' * 20), abi=EVENT_ABI)
+        self._redis_client = FakeRedis()
+        mocker.patch.object(PerpdexEventIndexer, '_get_block_hash', return_value='0x01')
+        mocker.patch('src.event_indexer.get_events', side_effect=lambda contract, from_block, to_block, **kwargs: [{
+            'event': 'PositionChanged',
+            'blockNumber': to_block,
+            'logIndex': 0,
+            'args': {'market': 'm', 'trader': str(to_block)},
+        }])
+
+    def _create_indexer(self, **kwargs):
+        return PerpdexEventIndexer(
+            contract=self._contract,
+            redis_client=self._redis_client,
+            start_block_number=1,
+            get_logs_limit=10,
+            checkpoint_interval=0,
+            confirmations=0,
+            **kwargs,
+        )
+
+    def test_resume_from_checkpoint(self, mocker):
+        indexer = self._create_indexer()
+        indexer._fetch_events(block_number=26)
+        assert indexer._last_block_number == 26
+
+        restarted = self._create_indexer()
+        assert restarted._last_block_number == 26
+        assert restarted.market_to_traders['m'] == {'10', '20', '26'}
+
+        # only blocks after the checkpoint are fetched
+        fetch_chunks = mocker.spy(restarted, '_fetch_chunks')
+        restarted._fetch_events(block_number=31)
+        assert fetch_chunks.call_args[0][0] == [(21, 30), (31, 31)]
+        assert restarted.market_to_traders['m'] == {'10', '20', '26', '30', '31'}
+
+    def test_ignore_checkpoint_of_another_start_block(self):
+        indexer = self._create_indexer()
+        indexer._fetch_events(block_number=26)
+
+        other = PerpdexEventIndexer(
+            contract=self._contract,
+            redis_client=self._redis_client,
+            start_block_number=5,
+            get_logs_limit=10,
+        )
+        assert other._last_block_number == 4
+
+    def test_checkpoint_file(self, tmp_path):
+        path = str(tmp_path / 'checkpoint.json')
+        indexer = self._create_indexer(checkpoint_path=path)
+        indexer._fetch_events(block_number=16)
+
+        restarted = self._create_indexer(checkpoint_path=path)
+        assert restarted._last_block_number == 16
+        assert len(self._redis_client.store) == 1  # only the full chunk cache
+
+
+class TestEventIndexerCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch.dict(os.environ, {'WEB3_NETWORK_NAME': 'localhost'})
+        self._redis_client = FakeRedis()
+        self._indexer = PerpdexEventIndexer(
+            contract=Web3().eth.contract(address=Web3.toChecksumAddress('0x' + '12' * 20), abi=EVENT_ABI),
+            redis_client=self._redis_client,
+            start_block_number=1,
+            get_logs_limit=10,
+            checkpoint_interval=-1,
+        )
+
+    @pytest.mark.parametrize('compression', [True, False])
+    def test_encode_decode(self, compression):
+        events = [{
+            'event': 'PositionChanged',
+            'blockNumber': 1,
+            'logIndex': 2,
+            'args': {'trader': '0x' + '34' * 20, 'base': -10 ** 30},
+        }]
+        assert _decode_events(_encode_events(events, compression)) == events
+
+    def test_decode_unknown_codec(self):
+        with pytest.raises(ValueError):
+            _decode_events(b'\x80' + b'pickled')
+
+    def test_compact_event(self):
+        event = {
+            'event': 'PositionChanged',
+            'blockNumber': 1,
+            'logIndex': 2,
+            'transactionHash': b'\1' * 32,
+            'args': {'trader': 't', 'market': 'm', 'base': 3},
+        }
+        assert self._indexer._compact_event(event) == {
+            'event': 'PositionChanged',
+            'blockNumber': 1,
+            'logIndex': 2,
+            'args': {'trader': 't', 'market': 'm'},
+        }
+
+    def test_bulk_load(self, mocker):
+        mocked = mocker.patch('src.event_indexer.get_events', side_effect=lambda contract, from_block, to_block, **kwargs: [
+            {'event': 'PositionChanged', 'blockNumber': to_block, 'logIndex': 0, 'args': {'trader': 't', 'market': 'm'}}
+        ])
+        chunks = [(1, 10), (11, 20), (21, 25)]
+        self._indexer._fetch_chunks(chunks)
+        assert mocked.call_count == 3
+
+        mget = mocker.spy(self._redis_client, 'mget')
+        chunk_to_events = self._indexer._fetch_chunks(chunks)
+        # partial chunk is not cached
+        assert mocked.call_count == 4
+        assert mget.call_count == 1
+        assert chunk_to_events[(11, 20)][0]['args'] == {'trader': 't', 'market': 'm'}
+
+    def test_broken_cache_is_miss(self, mocker):
+        self._redis_client.set(self._indexer._cache_key(1, 10), b'broken')
+        mocked = mocker.patch('src.event_indexer.get_events', return_value=[])
+
+        assert self._indexer._fetch_chunks([(1, 10)]) == {(1, 10): []}
+        assert mocked.call_count == 1
+
+
+class TestPerpdexEventIndexerPositionLifecycle:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch.dict(os.environ, {'WEB3_NETWORK_NAME': 'localhost'})
+        self._indexer = PerpdexEventIndexer(
+            contract=mocker.MagicMock(),
+            redis_client=FakeRedis(),
+            start_block_number=1,
+            checkpoint_interval=-1,
+        )
+        # - key: (trader, market)
+        # - value: (position share, liquidity)
+        self._positions = {}
+        functions = self._indexer._contract.functions
+        functions.getPositionShare.side_effect = lambda trader, market: mocker.MagicMock(
+            call=mocker.MagicMock(return_value=self._positions[(trader, market)][0]))
+        functions.getMakerInfo.side_effect = lambda trader, market: mocker.MagicMock(
+            call=mocker.MagicMock(return_value=(self._positions[(trader, market)][1], 0, 0)))
+
+    def _process(self, event_name, trader, market):
+        self._indexer._process_event({'event': event_name, 'args': {'trader': trader, 'market': market}})
+
+    def test_state_not_shared_between_instances(self, mocker):
+        self._process('AddLiquidity', 'alice', 'btc')
+        other = PerpdexEventIndexer(
+            contract=mocker.MagicMock(),
+            redis_client=FakeRedis(),
+            start_block_number=1,
+            checkpoint_interval=-1,
+        )
+        assert 'btc' not in other.market_to_traders
+
+    def test_remove_closed_positions(self):
+        self._process('PositionChanged', 'alice', 'btc')
+        self._process('PositionChanged', 'bob', 'btc')
+        self._process('AddLiquidity', 'carol', 'btc')
+        self._process('PositionLiquidated', 'bob', 'btc')
+        self._process('RemoveLiquidity', 'carol', 'btc')
+
+        self._positions = {
+            ('alice', 'btc'): (10, 0),  # open taker position
+            ('bob', 'btc'): (0, 0),  # liquidated
+            ('carol', 'btc'): (0, 5),  # partially removed liquidity
+        }
+        self._indexer._on_events_processed()
+
+        assert self._indexer.market_to_traders['btc'] == {'alice', 'carol'}
+        assert self._indexer._closing_candidates == set()
+
+        self._process('PositionChanged', 'alice', 'btc')
+        self._process('RemoveLiquidity', 'carol', 'btc')
+        self._positions[('alice', 'btc')] = (0, 0)
+        self._positions[('carol', 'btc')] = (0, 0)
+        self._indexer._on_events_processed()
+
+        assert 'btc' not in self._indexer.market_to_traders
+
+    def test_remove_closed_positions_at_indexed_block(self, mocker):
+        self._indexer._multicall = mocker.MagicMock()
+        self._indexer._multicall.split.side_effect = lambda funcs: [funcs]
+        self._indexer._multicall.try_aggregate.return_value = [0, (0, 0, 0)]
+        self._positions[('alice', 'btc')] = (10, 0)
+        self._indexer._last_block_number = 15
+        self._process('PositionChanged', 'alice', 'btc')
+        self._indexer._on_events_processed()
+
+        assert self._indexer._multicall.try_aggregate.call_args[1] == {'block_identifier': 15}
+        assert 'btc' not in self._indexer.market_to_traders
+
+    def test_pop_updated_traders(self):
+        self._process('PositionChanged', 'alice', 'btc')
+        self._indexer._process_event({'event': 'Deposited', 'args': {'trader': 'bob'}})
+
+        assert self._indexer.pop_updated_traders() == {'alice', 'bob'}
+        assert self._indexer.pop_updated_traders() == set()
+        assert 'bob' not in self._indexer.market_to_traders.get('btc', set())
+
+    def test_keep_candidates_on_error(self):
+        self._process('PositionChanged', 'alice', 'btc')
+        # position is not found in the mocked contract
+        self._indexer._on_events_processed()
+
+        assert self._indexer.market_to_traders['btc'] == {'alice'}
+        assert self._indexer._closing_candidates == {('alice', 'btc')}
+
+
+class TestEventIndexerReorg:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch.dict(os.environ, {'WEB3_NETWORK_NAME': 'localhost'})
+        self._redis_client = FakeRedis()
+        # - key: block number
+        # - value: fork name, part of the hash and of the trader of the block
+        self._forks = {}
+        mocker.patch.object(
+            PerpdexEventIndexer, '_get_block_hash', side_effect=lambda block_number: self._fork(block_number))
+        self._get_events = mocker.patch(
+            'src.event_indexer.get_events', side_effect=lambda contract, from_block, to_block, **kwargs: [{
+                'event': 'PositionChanged',
+                'blockNumber': b,
+                'logIndex': 0,
+                'args': {'market': 'm', 'trader': self._fork(b) + str(b)},
+            } for b in range(from_block, to_block + 1)])
+
+    def _fork(self, block_number):
+        return self._forks.get(block_number, 'a')
+
+    def _create_indexer(self, confirmations):
+        return PerpdexEventIndexer(
+            contract=Web3().eth.contract(address=Web3.toChecksumAddress('0x' + '12' * 20), abi=EVENT_ABI),
+            redis_client=self._redis_client,
+            start_block_number=1,
+            get_logs_limit=5,
+            checkpoint_interval=0,
+            confirmations=confirmations,
+        )
+
+    def test_index_tip(self):
+        indexer = self._create_indexer(confirmations=3)
+        indexer.fetch_market_to_traders(20)
+
+        assert indexer.last_block_number == 20
+        assert indexer._confirmed_block_number == 17
+        assert indexer.market_to_traders['m'] == {'a' + str(b) for b in range(1, 21)}
+        # only confirmed blocks are checkpointed and cached
+        assert json.loads(self._redis_client.get(indexer._checkpoint_key()))['last_block_number'] == 17
+        assert indexer._cache_key(16, 20) not in self._redis_client.store
+
+        # tip blocks are promoted without fetching them again
+        calls = self._get_events.call_count
+        indexer.fetch_market_to_traders(21)
+        assert self._get_events.call_args[1]['from_block'] == 21
+        assert self._get_events.call_count == calls + 1
+        assert indexer._confirmed_block_number == 18
+        assert indexer.market_to_traders['m'] == {'a' + str(b) for b in range(1, 22)}
+
+    def test_tip_events_processed_once(self, mocker):
+        indexer = self._create_indexer(confirmations=3)
+        indexer.fetch_market_to_traders(20)
+        indexer.pop_updated_traders()
+        process_event = mocker.spy(indexer, '_process_event')
+        on_events_processed = mocker.spy(indexer, '_on_events_processed')
+
+        for block_number in range(21, 26):
+            indexer.fetch_market_to_traders(block_number)
+            assert indexer.pop_updated_traders() == {'a' + str(block_number)}
+        assert process_event.call_count == 5 + 3
+        assert on_events_processed.call_count == 5
+        assert indexer.market_to_traders['m'] == {'a' + str(b) for b in range(1, 26)}
+
+        # the base state moves up once per confirmations blocks
+        assert json.loads(self._redis_client.get(indexer._checkpoint_key()))['last_block_number'] == 20
+        self._forks.update({24: 'b', 25: 'b'})
+        indexer.fetch_market_to_traders(26)
+        assert indexer.market_to_traders['m'] == {'a' + str(b) for b in range(1, 24)} | {'b24', 'b25', 'a26'}
+
+    def test_rollback_tip(self):
+        indexer = self._create_indexer(confirmations=3)
+        indexer.fetch_market_to_traders(20)
+        indexer.pop_updated_traders()
+
+        self._forks.update({19: 'b', 20: 'b'})
+        before = metrics.INDEXER_REORGS.get(depth='tip') or 0
+        indexer.fetch_market_to_traders(21)
+
+        assert metrics.INDEXER_REORGS.get(depth='tip') == before + 1
+        assert indexer.market_to_traders['m'] == {'a' + str(b) for b in range(1, 19)} | {'b19', 'b20', 'a21'}
+        # accounts of the rolled back blocks are checked again
+        assert {'a19', 'a20'} <= indexer.pop_updated_traders()
+
+    def test_reindex_after_deep_reorg(self):
+        indexer = self._create_indexer(confirmations=1)
+        indexer.fetch_market_to_traders(12)
+        indexer.fetch_market_to_traders(20)
+        assert indexer._cache_key(11, 15) in self._redis_client.store
+
+        # blocks after 11 are replaced
+        self._forks.update({b: 'b' for b in range(12, 22)})
+        before = metrics.INDEXER_REORGS.get(depth='deep') or 0
+        indexer.fetch_market_to_traders(21)
+
+        assert metrics.INDEXER_REORGS.get(depth='deep') == before + 1
+        indexer.fetch_market_to_traders(21)
+        assert indexer.last_block_number == 21
+        # the cached chunk of the replaced blocks is fetched again
+        expected = {'a' + str(b) for b in range(1, 12)} | {'b' + str(b) for b in range(12, 22)}
+        assert indexer.market_to_traders['m'] == expected
@@ -0,0 +1,46 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from src.executor import AsyncExecutor
+
+
+class TestAsyncExecutor:
+    @pytest.mark.asyncio
+    async def test_run_concurrently(self):
+        executor = AsyncExecutor(max_workers=10)
+        barrier = threading.Barrier(10, timeout=5)
+
+        def _blocking(i):
+            # all workers must be running at the same time to pass the barrier
+            barrier.wait()
+            return i
+
+        ret = await asyncio.gather(*[executor.run(_blocking, i) for i in range(10)])
+        assert ret == list(range(10))
+        executor.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_event_loop_not_blocked(self):
+        executor = AsyncExecutor(max_workers=1)
+
+        task = asyncio.create_task(executor.run(time.sleep, 0.5))
+        start = time.monotonic()
+        await asyncio.sleep(0.01)
+        assert time.monotonic() - start < 0.4
+
+        await task
+        executor.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_call(self, mocker):
+        executor = AsyncExecutor(max_workers=1)
+        func = mocker.MagicMock()
+        func.call.return_value = 123
+
+        ret = await executor.call(func, block_identifier=1)
+
+        assert ret == 123
+        func.call.assert_called_once_with(block_identifier=1)
+        executor.shutdown()
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from web3 import Web3
+
+from src.contracts.utils import BatchingHTTPProvider, PooledHTTPProvider
+
+from tests.helper import StubNode
+
+
+class TestHTTPProvider:
+    @pytest.fixture(autouse=True)
+    def setUp(self):
+        self.node = StubNode()
+        yield
+        self.node.close()
+
+    def _call(self, provider, data):
+        return provider.make_request('eth_call', [{'to': '0x' + '12' * 20, 'data': data}, 'latest'])
+
+    def test_pooled(self):
+        provider = PooledHTTPProvider(self.node.uri, pool_size=4)
+
+        assert self._call(provider, '0x01')['result'] == '0x01'
+        assert provider.make_request('eth_blockNumber', [])['result'] == 'eth_blockNumber'
+        assert len(self.node.payloads) == 2
+
+    def test_batching(self):
+        # the batch is sent by the window or when it is full, whichever comes first
+        provider = BatchingHTTPProvider(self.node.uri, batch_window=1.0, max_batch_size=8)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            rets = list(executor.map(lambda i: self._call(provider, hex(i)), range(8)))
+
+        # responses are matched by id even if the node reorders them
+        assert [ret['result'] for ret in rets] == [hex(i) for i in range(8)]
+        assert len(self.node.payloads) == 1
+        assert len(self.node.payloads[0]) == 8
+
+    def test_batching_max_batch_size(self):
+        provider = BatchingHTTPProvider(self.node.uri, batch_window=1.0, max_batch_size=4)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            rets = list(executor.map(lambda i: self._call(provider, hex(i)), range(8)))
+
+        assert [ret['result'] for ret in rets] == [hex(i) for i in range(8)]
+        assert sorted(len(payload) for payload in self.node.payloads) == [4, 4]
+
+    def test_not_batched_methods(self):
+        provider = BatchingHTTPProvider(self.node.uri, batch_window=0.05)
+
+        assert provider.make_request('eth_sendRawTransaction', ['0x'])['result'] == 'eth_sendRawTransaction'
+        assert isinstance(self.node.payloads[0], dict)
+
+    def test_batch_not_supported(self):
+        self.node.batch_supported = False
+        provider = BatchingHTTPProvider(self.node.uri, batch_window=0.05)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            rets = list(executor.map(lambda i: self._call(provider, hex(i)), range(4)))
+
+        assert [ret['result'] for ret in rets] == [hex(i) for i in range(4)]
+        # later requests are not batched
+        self._call(provider, '0x01')
+        assert isinstance(self.node.payloads[-1], dict)
+
+    def test_web3(self):
+        w3 = Web3(BatchingHTTPProvider(self.node.uri, batch_window=0.01))
+
+        assert w3.eth.call({'to': '0x' + '12' * 20, 'data': '0x1234'}) == bytes.fromhex('1234')
@@ -1,5 +1,9 @@
+import asyncio
+import os
+
 import pytest
-from src.liquidator import Liquidator
+from src import metrics
+from src.liquidator import Liquidator, get_user_private_keys
 
 from tests.helper import mock_eth_account
 
@@ -14,9 +18,17 @@ class TestLiquidatorWithoutDependencies:
         self.trader = 'trader address'
         self.market = 'base token address'
     
+    def _position(self, has_enough_mm=False, liquidity=0, base_share=100, max_trade=80):
+        return dict(
+            has_enough_mm=has_enough_mm,
+            liquidity=liquidity,
+            base_share=base_share,
+            max_trade={True: max_trade, False: max_trade},
+        )
+
     @pytest.mark.asyncio
     async def test_liquidate_skip(self, mocker):
-        mocker.patch.object(self.liq, '_check_trader_has_enough_mm', return_value=True)
+        mocker.patch.object(self.liq, '_fetch_position', return_value=self._position(has_enough_mm=True))
         mocker.patch.object(self.liq, '_liquidate_maker_position')
         mocker.patch.object(self.liq, '_liquidate_taker_position')
 
@@ -24,57 +36,336 @@ class TestLiquidatorWithoutDependencies:
 
         self.liq._liquidate_maker_position.assert_not_called()
         self.liq._liquidate_taker_position.assert_not_called()
+        assert metrics.LIQUIDATIONS.get(outcome='enough_mm') >= 1
 
     @pytest.mark.asyncio
     async def test_liquidate_executed(self, mocker):
-        mocker.patch.object(self.liq, '_check_trader_has_enough_mm', return_value=False)
-        mocker.patch.object(self.liq, '_liquidate_maker_position')
+        mocker.patch.object(self.liq, '_fetch_position', return_value=self._position(liquidity=10))
+        mocker.patch.object(self.liq, '_liquidate_maker_position', return_value=True)
         mocker.patch.object(self.liq, '_liquidate_taker_position')
 
         await self.liq._liquidate(self.trader, self.market)
 
         self.liq._liquidate_maker_position.assert_called()
         self.liq._liquidate_taker_position.assert_called()
-    
-    def test_liquidate_maker_position_ok(self, mocker):
+        # taker position is read again after removing liquidity
+        assert self.liq._fetch_position.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_liquidate_taker_only(self, mocker):
+        mocker.patch.object(self.liq, '_fetch_position', return_value=self._position())
+        mocker.patch.object(self.liq, '_liquidate_maker_position')
+        mocker.patch.object(self.liq, '_liquidate_taker_position')
+
+        await self.liq._liquidate(self.trader, self.market)
+
+        self.liq._liquidate_maker_position.assert_not_called()
+        self.liq._liquidate_taker_position.assert_called()
+        assert self.liq._fetch_position.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_liquidate_claimed_by_another_worker(self, mocker):
+        self.liq._shard = mocker.MagicMock()
+        self.liq._shard.claim.return_value = False
+        mocker.patch.object(self.liq, '_liquidate_position')
+
+        await self.liq._liquidate(self.trader, self.market)
+
+        self.liq._liquidate_position.assert_not_called()
+        self.liq._shard.release.assert_not_called()
+        assert metrics.LIQUIDATIONS.get(outcome='claimed') >= 1
+
+        self.liq._shard.claim.return_value = True
+        await self.liq._liquidate(self.trader, self.market)
+
+        self.liq._liquidate_position.assert_called_once_with(self.trader, self.market)
+        self.liq._shard.release.assert_called_once_with(f'position:{self.trader}:{self.market}')
+
+    @pytest.mark.asyncio
+    async def test_renew_claim_during_liquidation(self, mocker):
+        self.liq._shard = mocker.MagicMock()
+        self.liq._shard.claim.return_value = True
+        self.liq._shard.renew.return_value = True
+        self.liq._shard.claim_renew_interval = 0.01
+
+        async def _liquidate_position(trader, market):
+            await asyncio.sleep(0.05)
+            return 'liquidated'
+
+        mocker.patch.object(self.liq, '_liquidate_position', side_effect=_liquidate_position)
+        await self.liq._liquidate(self.trader, self.market)
+
+        assert self.liq._shard.renew.call_count >= 2
+        renew_count = self.liq._shard.renew.call_count
+        await asyncio.sleep(0.03)
+        # stopped with the liquidation
+        assert self.liq._shard.renew.call_count == renew_count
+        self.liq._shard.release.assert_called_once_with(f'position:{self.trader}:{self.market}')
+
+    @pytest.mark.asyncio
+    async def test_fetch_position_with_multicall(self, mocker):
+        multicall = mocker.MagicMock()
+        multicall.try_aggregate.return_value = [False, (10, 0, 0), -100, 70, 80]
+        self.liq._multicall = multicall
         contract = self.liq._perpdex_exchange.functions
+        for name in ['hasEnoughMaintenanceMargin', 'getMakerInfo', 'getOpenPositionShare', 'maxTrade']:
+            mocker.patch.object(contract, name)
+
+        ret = await self.liq._fetch_position(self.trader, self.market)
+
+        assert ret == dict(has_enough_mm=False, liquidity=10, base_share=-100, max_trade={True: 70, False: 80})
+        assert multicall.try_aggregate.call_count == 1
+        assert len(multicall.try_aggregate.call_args[0][0]) == 5
+
+    @pytest.mark.asyncio
+    async def test_fetch_position_reverted(self, mocker):
+        multicall = mocker.MagicMock()
+        multicall.try_aggregate.return_value = [False, (10, 0, 0), -100, None, 80]
+        self.liq._multicall = multicall
+        contract = self.liq._perpdex_exchange.functions
+        for name in ['hasEnoughMaintenanceMargin', 'getMakerInfo', 'getOpenPositionShare', 'maxTrade']:
+            mocker.patch.object(contract, name)
+
+        assert await self.liq._fetch_position(self.trader, self.market) is None
+
+    @pytest.mark.asyncio
+    async def test_screen_traders_without_multicall(self, mocker):
+        self.liq._multicall = None
+        mocker.patch.object(self.liq, '_check_trader_has_enough_mm', side_effect=lambda trader, block_number: trader == 'ok')
+
+        ret = await self.liq._screen_traders(['ok', 'ng'])
+
+        assert ret == {'ng'}
+
+    @pytest.mark.asyncio
+    async def test_screen_traders_with_multicall(self, mocker):
+        multicall = mocker.MagicMock()
+        multicall.split.side_effect = lambda funcs: [funcs[:2], funcs[2:]]
+        multicall.try_aggregate.side_effect = [[True, False], [None]]
+        self.liq._multicall = multicall
+
+        ret = await self.liq._screen_traders(['0x' + '01' * 20, '0x' + '02' * 20, '0x' + '03' * 20])
+
+        assert ret == {'0x' + '02' * 20, '0x' + '03' * 20}
+        assert multicall.try_aggregate.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_screen_traders_chunk_failed(self, mocker):
+        multicall = mocker.MagicMock()
+        multicall.split.side_effect = lambda traders: [traders[:2], traders[2:]]
+        multicall.try_aggregate.side_effect = [[True, False], ValueError('rpc error')]
+        self.liq._multicall = multicall
+        traders = ['0x' + '01' * 20, '0x' + '02' * 20, '0x' + '03' * 20]
+
+        ret = await self.liq._screen_traders(traders)
 
-        # mock getMakerInfo to return liquidity 10
-        func1 = mocker.MagicMock()
-        func1.call.return_value = (10, 0, 0)
-        mocker.patch.object(contract, 'getMakerInfo', return_value=func1)
+        # the failed chunk doesn't fail the others, its traders are checked again
+        assert ret == {'0x' + '02' * 20}
+        assert self.liq._unscreened_traders == {'0x' + '03' * 20}
+
+    @pytest.mark.asyncio
+    async def test_main_survives_failed_block(self, mocker):
+        block_numbers = iter([10, 11])
+
+        async def _wait_for_new_block():
+            try:
+                return next(block_numbers)
+            except StopIteration:
+                await asyncio.Event().wait()
+
+        mocker.patch.object(self.liq._block_watcher, 'start')
+        mocker.patch.object(self.liq._block_watcher, 'wait_for_new_block', side_effect=_wait_for_new_block)
+        mocker.patch.object(self.liq, '_process_block', side_effect=[ValueError('rpc error'), None])
+
+        self.liq.start()
+        await asyncio.sleep(0.01)
+
+        assert self.liq.health_check()
+        assert [call[0][0] for call in self.liq._process_block.call_args_list] == [10, 11]
+        self.liq._task.cancel()
+
+    @pytest.mark.asyncio
+    async def test_fetch_position_reuses_block_reads(self, mocker):
+        trader = '0x' + '01' * 20
+        market = '0x' + '02' * 20
+        multicall = mocker.MagicMock()
+        multicall.split.side_effect = lambda funcs: [funcs]
+        multicall.try_aggregate.side_effect = [[False], [(0, 0, 0), 100, 70, 80]]
+        self.liq._multicall = multicall
+        self.liq._read_cache.advance(10)
+
+        assert await self.liq._screen_traders([trader], 10) == {trader}
+        position = await self.liq._fetch_position(trader, market)
+        # retry in the same block
+        assert await self.liq._fetch_position(trader, market) == position
+
+        assert position == dict(has_enough_mm=False, liquidity=0, base_share=100, max_trade={True: 70, False: 80})
+        # hasEnoughMaintenanceMargin of the screening is not read again
+        assert multicall.try_aggregate.call_count == 2
+        assert len(multicall.try_aggregate.call_args[0][0]) == 4
+        assert multicall.try_aggregate.call_args[1] == dict(block_identifier=10)
+
+    @pytest.mark.asyncio
+    async def test_liquidate_maker_position_ok(self, mocker):
+        contract = self.liq._perpdex_exchange.functions
 
         # mock removeLiquidity
-        func2 = mocker.MagicMock()
-        func2.estimateGas.return_value = 100
-        mocker.patch.object(contract, 'removeLiquidity', return_value=func2)
+        func = mocker.MagicMock()
+        func.estimateGas.return_value = 100
+        mocker.patch.object(contract, 'removeLiquidity', return_value=func)
 
         # mock transact to return True
         mocker.patch.object(self.liq, '_try_transact', return_value=True)
 
-        ret = self.liq._liquidate_maker_position(self.trader, self.market)
+        ret = await self.liq._liquidate_maker_position(self.trader, self.market, self._position(liquidity=10))
         assert ret is True
+        # estimated gas is reused with the buffer
+        func.estimateGas.assert_called_once()
+        assert self.liq._try_transact.call_args[0][1] == {'gas': 120}
 
-    def test_liquidate_taker_position_ok(self, mocker):
+    @pytest.mark.asyncio
+    async def test_liquidate_taker_position_ok(self, mocker):
         contract = self.liq._perpdex_exchange.functions
 
-        # mock getOpenPositionShare
-        func1 = mocker.MagicMock()
-        func1.call.return_value = 100
-        mocker.patch.object(contract, 'getOpenPositionShare', return_value=func1)
-
-        # mock maxTrade
-        func2 = mocker.MagicMock()
-        func2.call.return_value = 80
-        mocker.patch.object(contract, 'maxTrade', return_value=func2)
-
         # mock trade
-        func3 = mocker.MagicMock()
-        func3.estimateGas.return_value = 100
-        mocker.patch.object(contract, 'trade', return_value=func3)
+        func = mocker.MagicMock()
+        func.estimateGas.return_value = 100
+        mocker.patch.object(contract, 'trade', return_value=func)
 
         # mock transact to return True
         mocker.patch.object(self.liq, '_try_transact', return_value=True)
 
-        ret = self.liq._liquidate_taker_position(self.trader, self.market)
+        ret = await self.liq._liquidate_taker_position(self.trader, self.market, self._position())
         assert ret is True
+        assert contract.trade.call_args[0][0]['amount'] == 64
+        assert self.liq._try_transact.call_args[0][1] == {'gas': 120}
+
+    @pytest.mark.asyncio
+    async def test_liquidate_with_executor_contract(self, mocker):
+        executor_contract = mocker.MagicMock()
+        executor_contract.events.LiquidationFailed.return_value.processReceipt.return_value = [
+            {'args': {'trader': 'trader2', 'market': self.market}},
+        ]
+        # still above the maintenance margin when the transaction is mined
+        executor_contract.events.LiquidationSkipped.return_value.processReceipt.return_value = [
+            {'args': {'trader': 'trader3', 'market': self.market}},
+        ]
+        self.liq._liquidation_executor = executor_contract
+        mocker.patch.object(self.liq, '_try_estimate_gas', return_value=100)
+        mocker.patch.object(self.liq, '_send_transaction', return_value={'status': 1})
+
+        rets = await asyncio.gather(*[self.liq._liquidate_in_batch(f'trader{i}', self.market) for i in range(1, 4)])
+
+        assert rets == ['liquidated', 'failed', 'skipped']
+        executor_contract.functions.liquidate.assert_called_once_with(
+            [('trader1', self.market), ('trader2', self.market), ('trader3', self.market)])
+        assert self.liq._send_transaction.call_args[0][1] == {'gas': 120}
+
+    @pytest.mark.asyncio
+    async def test_liquidate_with_executor_contract_batch_size(self, mocker):
+        self.liq._liquidation_executor = mocker.MagicMock()
+        self.liq._liquidation_batch_size = 2
+        mocker.patch.object(self.liq, '_try_estimate_gas', return_value=100)
+        mocker.patch.object(self.liq, '_send_transaction', return_value={'status': 0})
+
+        rets = await asyncio.gather(*[self.liq._liquidate_in_batch(f'trader{i}', self.market) for i in range(3)])
+
+        assert rets == ['failed'] * 3
+        assert self.liq._send_transaction.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_liquidate_with_executor_contract_estimation_failed(self, mocker):
+        self.liq._liquidation_executor = mocker.MagicMock()
+        mocker.patch.object(self.liq, '_try_estimate_gas', return_value=None)
+        mocker.patch.object(self.liq, '_send_transaction')
+        mocker.patch.object(self.liq, '_liquidate_position', return_value='enough_mm')
+
+        assert await self.liq._liquidate_in_batch(self.trader, self.market) == 'enough_mm'
+        self.liq._send_transaction.assert_not_called()
+        self.liq._liquidate_position.assert_called_once_with(self.trader, self.market)
+
+    @pytest.mark.asyncio
+    async def test_prepared_liquidation(self, mocker):
+        self.liq._liquidation_executor = mocker.MagicMock()
+        self.liq._risk_engine = mocker.MagicMock()
+        self.liq._risk_engine.simulate.return_value = {('trader1', self.market), ('trader2', self.market)}
+        self.liq._risk_engine.estimate_shortfall.return_value = (10, 100)
+        self.liq._price_impact = mocker.MagicMock()
+        self.liq._price_impact.simulate.return_value = {self.market: 100}
+        sender = mocker.MagicMock()
+        sender.sign = mocker.AsyncMock(return_value=(7, {'nonce': 7}, b'raw'))
+        sender.send_signed = mocker.AsyncMock(return_value=b'hash')
+        sender.wait_for_receipt = mocker.AsyncMock(return_value={'status': 1})
+        mocker.patch.object(self.liq._sender_pool, 'acquire', return_value=sender)
+        mocker.patch.object(self.liq._sender_pool, 'release')
+        mocker.patch.object(self.liq, '_executor_outcomes', return_value={('trader2', self.market): 'failed'})
+        mocker.patch.object(self.liq, '_screen_traders', return_value={'trader1', 'trader2'})
+        mocker.patch.object(self.liq, '_liquidate')
+        self.liq._read_cache.advance(10)
+
+        await self.liq._prepare_liquidation({'hash': '0x01', 'to': self.market})
+        sender.sign.assert_called_once()
+        self.liq._liquidation_executor.functions.liquidate.assert_called_once()
+        assert len(self.liq._liquidation_executor.functions.liquidate.call_args[0][0]) == 2
+
+        # pending transaction is not mined yet
+        self.liq._w3.eth.get_transaction_receipt = mocker.Mock(side_effect=ValueError('not found'))
+        await self.liq._send_prepared_liquidations(11)
+        sender.send_signed.assert_not_called()
+
+        self.liq._w3.eth.get_transaction_receipt = mocker.Mock(return_value={'status': 1})
+        self.liq._scheduler.start()
+        await self.liq._send_prepared_liquidations(12)
+        sender.send_signed.assert_called_once_with(7, b'raw')
+        assert self.liq._prepared_liquidations == {}
+
+        # the scan of the block doesn't liquidate the positions again
+        assert not self.liq._scheduler.submit(
+            ('trader1', self.market), self.liq._liquidate, 'trader1', self.market, priority=(10, 100))
+        await self.liq._scheduler.join()
+        self.liq._scheduler.stop()
+        self.liq._liquidate.assert_not_called()
+        self.liq._sender_pool.release.assert_called_once_with(sender)
+
+    @pytest.mark.asyncio
+    async def test_prepared_liquidation_unknown_price(self, mocker):
+        self.liq._liquidation_executor = mocker.MagicMock()
+        self.liq._risk_engine = mocker.MagicMock()
+        self.liq._price_impact = mocker.MagicMock()
+        self.liq._price_impact.simulate.return_value = {self.market: None}
+        mocker.patch.object(self.liq._sender_pool, 'acquire')
+
+        await self.liq._prepare_liquidation({'hash': '0x01', 'to': self.market})
+
+        self.liq._risk_engine.simulate.assert_not_called()
+        self.liq._sender_pool.acquire.assert_not_called()
+        assert self.liq._prepared_liquidations == {}
+
+    @pytest.mark.asyncio
+    async def test_prepared_liquidation_expired(self, mocker):
+        sender = mocker.MagicMock()
+        mocker.patch.object(self.liq._sender_pool, 'release')
+        self.liq._prepared_liquidations['0x01'] = dict(
+            block_number=10, positions=[('trader1', self.market)], sender=sender, nonce=7, tx={}, raw_transaction=b'')
+        self.liq._w3.eth.get_transaction_receipt = mocker.Mock(side_effect=ValueError('not found'))
+
+        await self.liq._send_prepared_liquidations(12)
+        assert '0x01' in self.liq._prepared_liquidations
+        await self.liq._send_prepared_liquidations(13)
+
+        assert self.liq._prepared_liquidations == {}
+        sender.discard.assert_called_once_with(7)
+        self.liq._sender_pool.release.assert_called_once_with(sender)
+
+    def test_liquidation_priority(self, mocker):
+        self.liq._risk_engine = None
+        assert self.liq._liquidation_priority(self.trader)[0] > 0
+
+        self.liq._risk_engine = mocker.MagicMock()
+        self.liq._risk_engine.estimate_shortfall.return_value = (10, 100)
+        assert self.liq._liquidation_priority(self.trader) == (10, 100)
+
+
+def test_get_user_private_keys(mocker):
+    mocker.patch.dict(os.environ, {'USER_PRIVATE_KEY': 'key0', 'USER_PRIVATE_KEYS': 'key1, key0,,key2'})
+    assert get_user_private_keys() == ['key0', 'key1', 'key2']
@@ -0,0 +1,74 @@
+import urllib.request
+
+import pytest
+from src import metrics
+from src.metrics import Counter, Gauge, Histogram, Registry, rpc_metrics_middleware, start_http_server
+
+
+class TestMetrics:
+    def setup_method(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = Counter('requests_total', 'requests', labelnames=('method',), registry=self.registry)
+        counter.inc(method='eth_call')
+        counter.inc(2, method='eth_call')
+        counter.inc(method='eth_getLogs')
+
+        assert counter.get(method='eth_call') == 3
+        assert self.registry.render() == (
+            '# HELP requests_total requests\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{method="eth_call"} 3\n'
+            'requests_total{method="eth_getLogs"} 1\n'
+        )
+
+    def test_labels_mismatch(self):
+        counter = Counter('requests_total', 'requests', labelnames=('method',), registry=self.registry)
+        with pytest.raises(ValueError):
+            counter.inc(status='ok')
+
+    def test_gauge(self):
+        gauge = Gauge('lag', 'lag "blocks"', registry=self.registry)
+        gauge.set(10)
+        gauge.dec(3)
+
+        assert self.registry.render().splitlines()[-1] == 'lag 7'
+
+    def test_histogram(self):
+        histogram = Histogram('latency', 'latency', buckets=(0.1, 1), registry=self.registry)
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        assert self.registry.render().splitlines()[2:] == [
+            'latency_bucket{le="0.1"} 1',
+            'latency_bucket{le="1"} 2',
+            'latency_bucket{le="+Inf"} 3',
+            'latency_sum 5.55',
+            'latency_count 3',
+        ]
+
+    def test_escape_label(self):
+        counter = Counter('c', 'c', labelnames=('name',), registry=self.registry)
+        counter.inc(name='a"b\\c')
+        assert 'c{name="a\\"b\\\\c"} 1' in self.registry.render()
+
+    def test_http_server(self):
+        Counter('up', 'up', registry=self.registry).inc()
+        server = start_http_server(0, addr='127.0.0.1', registry=self.registry)
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+                body = response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert body == self.registry.render()
+
+    def test_rpc_metrics_middleware(self):
+        before = metrics.RPC_REQUESTS.get(method='eth_test', status='ok') or 0
+
+        middleware = rpc_metrics_middleware(lambda method, params: {'result': 1}, None)
+        middleware('eth_test', [])
+
+        assert metrics.RPC_REQUESTS.get(method='eth_test', status='ok') == before + 1
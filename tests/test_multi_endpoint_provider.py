@@ -0,0 +1,130 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from src.contracts.utils import (BatchingHTTPProvider, MultiEndpointProvider, PooledHTTPProvider,
+                                 WebsocketProviderPool, _create_provider, get_w3)
+
+from tests.helper import StubNode
+
+
+class TestMultiEndpointProvider:
+    @pytest.fixture(autouse=True)
+    def setUp(self):
+        self.nodes = [StubNode(), StubNode()]
+        self.provider = MultiEndpointProvider(
+            [PooledHTTPProvider(node.uri, timeout=2) for node in self.nodes],
+            hedge_delay=0.05,
+        )
+        yield
+        for node in self.nodes:
+            node.close()
+
+    def _call(self, data='0x01'):
+        return self.provider.make_request('eth_call', [{'to': '0x' + '12' * 20, 'data': data}, 'latest'])
+
+    def test_route_to_fastest(self):
+        self.nodes[0].delay = 0.05
+        for _ in range(2):
+            self.provider.make_request('eth_blockNumber', [])
+            self.provider._stats.reverse()
+            self.provider._providers.reverse()
+            self.nodes.reverse()
+        # both are measured, the fast one is preferred
+        assert self.provider._ranked()[0] == 1
+
+        for _ in range(5):
+            self.provider.make_request('eth_blockNumber', [])
+        assert len(self.nodes[1].methods()) == 6
+
+    def test_failover_on_http_error(self):
+        self.nodes[0].status = 500
+        self.provider._stats[1].latency = 1.0  # make node 0 the first choice
+
+        assert self.provider.make_request('eth_blockNumber', [])['result'] == 'eth_blockNumber'
+        assert len(self.nodes[0].payloads) == 1
+        stats = self.provider.endpoint_stats()
+        assert stats[0]['error_count'] == 1
+        assert stats[0]['error_rate'] > 0
+        # the failed endpoint is ranked last
+        assert self.provider._ranked() == [1, 0]
+
+    def test_failover_on_rate_limit(self):
+        self.nodes[0].error = {'code': 429, 'message': 'Too Many Requests'}
+        self.provider._stats[1].latency = 1.0
+
+        assert self.provider.make_request('eth_getLogs', [{}])['result'] == 'eth_getLogs'
+
+    def test_request_error_is_not_retried(self):
+        for node in self.nodes:
+            node.error = {'code': 3, 'message': 'execution reverted'}
+
+        assert self._call()['error']['message'] == 'execution reverted'
+        assert sum(len(node.payloads) for node in self.nodes) == 1
+
+    def test_hedged_read(self):
+        self.nodes[0].delay = 0.5
+        self.provider._stats[1].latency = 1.0
+
+        started_at = time.monotonic()
+        assert self._call('0x1234')['result'] == '0x1234'
+        assert time.monotonic() - started_at < 0.4
+        self.nodes[0].wait_for_payloads(1)
+        assert self.nodes[0].methods() == ['eth_call']
+        assert self.nodes[1].methods() == ['eth_call']
+
+    def test_not_hedged_when_fast(self):
+        self.provider._stats[1].latency = 1.0
+
+        self._call()
+        assert len(self.nodes[1].payloads) == 0
+
+    def test_broadcast_transaction(self):
+        self.nodes[1].error = {'code': -32000, 'message': 'already known'}
+
+        ret = self.provider.make_request('eth_sendRawTransaction', ['0x00'])
+
+        assert ret['result'] == 'eth_sendRawTransaction'
+        for node in self.nodes:
+            node.wait_for_payloads(1)
+            assert node.methods() == ['eth_sendRawTransaction']
+
+    def test_broadcast_returns_first_success(self):
+        self.nodes[0].delay = 0.5
+
+        started_at = time.monotonic()
+        ret = self.provider.make_request('eth_sendRawTransaction', ['0x00'])
+
+        assert ret['result'] == 'eth_sendRawTransaction'
+        assert time.monotonic() - started_at < 0.4
+        self.nodes[0].wait_for_payloads(1)
+
+    def test_broadcast_all_failed(self):
+        self.nodes[0].status = 500
+        self.nodes[1].error = {'code': -32000, 'message': 'nonce too low'}
+
+        ret = self.provider.make_request('eth_sendRawTransaction', ['0x00'])
+        assert ret['error']['message'] == 'nonce too low'
+
+    def test_concurrent(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            rets = list(executor.map(lambda i: self._call(hex(i)), range(16)))
+        assert [ret['result'] for ret in rets] == [hex(i) for i in range(16)]
+
+    def test_get_w3(self):
+        w3, _ = get_w3('localhost', ','.join(node.uri for node in self.nodes))
+
+        assert isinstance(w3.provider, MultiEndpointProvider)
+        assert w3.eth.call({'to': '0x' + '12' * 20, 'data': '0x1234'}) == bytes.fromhex('1234')
+
+
+@pytest.mark.parametrize('uri, batch_window, provider_class', [
+    ('wss://example.com', 0.002, WebsocketProviderPool),
+    ('ws://127.0.0.1:8545', 0.002, WebsocketProviderPool),
+    ('http://127.0.0.1:8545', 0.002, BatchingHTTPProvider),
+    ('https://example.com', 0, PooledHTTPProvider),
+])
+def test_create_provider(uri, batch_window, provider_class):
+    provider = _create_provider(uri, websocket_pool_size=1, http_pool_size=1, http_timeout=1,
+                                batch_window=batch_window, max_batch_size=10)
+    assert isinstance(provider, provider_class)
@@ -0,0 +1,59 @@
+from web3 import Web3
+
+from src.contracts.multicall import Multicall
+
+ADDRESS = Web3.toChecksumAddress('0x' + '12' * 20)
+TRADER = Web3.toChecksumAddress('0x' + '34' * 20)
+
+ABI = [
+    {
+        'name': 'hasEnoughMaintenanceMargin',
+        'type': 'function',
+        'stateMutability': 'view',
+        'inputs': [{'name': 'trader', 'type': 'address'}],
+        'outputs': [{'name': '', 'type': 'bool'}],
+    },
+    {
+        'name': 'getMakerInfo',
+        'type': 'function',
+        'stateMutability': 'view',
+        'inputs': [{'name': 'trader', 'type': 'address'}, {'name': 'market', 'type': 'address'}],
+        'outputs': [{'name': '', 'type': 'uint256'}, {'name': '', 'type': 'uint256'}, {'name': '', 'type': 'uint256'}],
+    },
+]
+
+
+class TestMulticall:
+    def setup_method(self):
+        self.w3 = Web3()
+        self.contract = self.w3.eth.contract(address=ADDRESS, abi=ABI)
+        self.multicall = Multicall(self.w3, address=ADDRESS, batch_size=2)
+
+    def test_split(self):
+        assert self.multicall.split([1, 2, 3, 4, 5]) == [[1, 2], [3, 4], [5]]
+
+    def test_try_aggregate(self, mocker):
+        funcs = [
+            self.contract.functions.hasEnoughMaintenanceMargin(TRADER),
+            self.contract.functions.getMakerInfo(TRADER, ADDRESS),
+            self.contract.functions.hasEnoughMaintenanceMargin(TRADER),
+        ]
+        returned = [
+            (True, self.w3.codec.encode_abi(['bool'], [True])),
+            (True, self.w3.codec.encode_abi(['uint256'] * 3, [10, 20, 30])),
+            (False, b''),
+        ]
+        aggregate = mocker.MagicMock()
+        aggregate.call.return_value = returned
+        mocked = mocker.patch.object(self.multicall._contract.functions, 'tryAggregate', return_value=aggregate)
+
+        ret = self.multicall.try_aggregate(funcs, block_identifier=123)
+
+        assert ret == [True, [10, 20, 30], None]
+        assert mocked.call_args[0][1][0] == (ADDRESS, funcs[0]._encode_transaction_data())
+        aggregate.call.assert_called_once_with(block_identifier=123)
+
+    def test_try_aggregate_empty(self, mocker):
+        mocked = mocker.patch.object(self.multicall._contract.functions, 'tryAggregate')
+        assert self.multicall.try_aggregate([]) == []
+        mocked.assert_not_called()
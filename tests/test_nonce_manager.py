@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+import web3
+from eth_account import Account
+from src.executor import AsyncExecutor
+from src.nonce_manager import NonceManager
+
+
+class TestNonceManager:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.w3 = mocker.MagicMock()
+        self.w3.eth.chain_id = 31337
+        self.w3.eth.gas_price = 1
+        self.chain_nonce = 5
+        self.w3.eth.get_transaction_count.side_effect = lambda address, block: self.chain_nonce
+
+        # - key: tx hash
+        # - value: receipt
+        self.receipts = {}
+        self.sent = []
+
+        def _send_raw_transaction(raw):
+            tx_hash = bytes([len(self.sent)]) * 32
+            self.sent.append(raw)
+            return tx_hash
+
+        def _get_transaction_receipt(tx_hash):
+            if tx_hash not in self.receipts:
+                raise web3.exceptions.TransactionNotFound('not found')
+            return self.receipts[tx_hash]
+
+        self.w3.eth.send_raw_transaction.side_effect = _send_raw_transaction
+        self.w3.eth.get_transaction_receipt.side_effect = _get_transaction_receipt
+
+        self.executor = AsyncExecutor(max_workers=4)
+        self.manager = NonceManager(
+            w3=self.w3,
+            account=Account.create(),
+            executor=self.executor,
+            receipt_timeout=0.05,
+            poll_interval=0.01,
+            max_replacements=2,
+        )
+        self.tx = {'to': '0x' + '12' * 20, 'value': 0, 'gas': 100000, 'gasPrice': 100, 'data': '0x'}
+        yield
+        self.executor.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_pipelined_nonces(self):
+        rets = await asyncio.gather(*[self.manager.submit(self.tx) for _ in range(3)])
+
+        assert sorted(nonce for nonce, _, _ in rets) == [5, 6, 7]
+        assert self.manager.pending_count == 3
+        # chain nonce is fetched once
+        assert self.w3.eth.get_transaction_count.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_wait_for_receipt(self):
+        nonce, tx_hash, tx = await self.manager.submit(self.tx)
+        self.receipts[tx_hash] = {'status': 1}
+
+        receipt = await self.manager.wait_for_receipt(nonce, tx)
+
+        assert receipt == {'status': 1}
+        assert self.manager.pending_count == 0
+
+    @pytest.mark.asyncio
+    async def test_replace_not_mined_transaction(self):
+        nonce, tx_hash, tx = await self.manager.submit(self.tx)
+
+        async def _mine_replacement():
+            while len(self.sent) < 2:
+                await asyncio.sleep(0.01)
+            self.receipts[bytes([1]) * 32] = {'status': 1}
+
+        task = asyncio.create_task(_mine_replacement())
+        receipt = await self.manager.wait_for_receipt(nonce, tx)
+        await task
+
+        assert receipt == {'status': 1}
+        replaced = Account.recover_transaction(self.sent[1])
+        assert replaced == self.manager.address
+        assert self.manager._bump_gas_price(tx)['gasPrice'] == 112
+
+    @pytest.mark.asyncio
+    async def test_nonce_used_by_another_transaction(self):
+        nonce, tx_hash, tx = await self.manager.submit(self.tx)
+        self.chain_nonce = 6
+
+        assert await self.manager.wait_for_receipt(nonce, tx) is None
+        assert len(self.sent) == 1
+
+    @pytest.mark.asyncio
+    async def test_reuse_nonce_of_failed_send(self):
+        await self.manager.submit(self.tx)
+        self.w3.eth.send_raw_transaction.side_effect = ValueError('insufficient funds')
+        with pytest.raises(ValueError):
+            await self.manager.submit(self.tx)
+
+        self.w3.eth.send_raw_transaction.side_effect = lambda raw: b'\1' * 32
+        nonce, _, _ = await self.manager.submit(self.tx)
+        assert nonce == 6
+
+    @pytest.mark.asyncio
+    async def test_fill_gap(self):
+        await self.manager.submit(self.tx)  # 5
+        await self.manager.submit(self.tx)  # 6
+        self.manager._release(5)
+        await asyncio.sleep(0.05)
+
+        filler = Account.recover_transaction(self.sent[-1])
+        assert filler == self.manager.address
+        assert len(self.sent) == 3
+
+    @pytest.mark.asyncio
+    async def test_presigned(self):
+        nonce, tx, raw_transaction = await self.manager.sign(self.tx)
+        assert nonce == 5
+        assert len(self.sent) == 0
+        # later transactions take the next nonce
+        assert (await self.manager.submit(self.tx))[0] == 6
+
+        tx_hash = await self.manager.send_signed(nonce, raw_transaction)
+        assert self.sent[-1] == raw_transaction
+        self.receipts[tx_hash] = {'status': 1}
+        assert await self.manager.wait_for_receipt(nonce, tx) == {'status': 1}
+
+    @pytest.mark.asyncio
+    async def test_discard_presigned(self):
+        nonce, _, _ = await self.manager.sign(self.tx)
+        self.manager.discard(nonce)
+
+        assert (await self.manager.submit(self.tx))[0] == nonce
+
+    @pytest.mark.asyncio
+    async def test_discard_lower_presigned(self):
+        nonce5, _, _ = await self.manager.sign(self.tx)
+        nonce6, _, raw_transaction = await self.manager.sign(self.tx)
+        self.manager.discard(nonce5)
+        await asyncio.sleep(0.05)
+
+        # the gap below the held nonce is filled, not reused by a later transaction
+        assert len(self.sent) == 1
+        assert Account.recover_transaction(self.sent[-1]) == self.manager.address
+        assert self.manager._released == []
+        await self.manager.send_signed(nonce6, raw_transaction)
+        assert (await self.manager.submit(self.tx))[0] == 7
+
+    @pytest.mark.asyncio
+    async def test_sync_to_lower_chain_nonce(self):
+        await self.manager.sync()
+        self.manager._next_nonce = 8
+        self.manager._released = [6]
+
+        # our transactions were dropped from the mempool
+        await self.manager.sync()
+        assert (await self.manager.submit(self.tx))[0] == 5
+        assert self.manager._released == []
+
+        # not while a transaction is in flight
+        self.chain_nonce = 4
+        await self.manager.sync()
+        assert (await self.manager.submit(self.tx))[0] == 6
+
+    @pytest.mark.asyncio
+    async def test_resync_after_dropped_transaction(self):
+        nonce, _, tx = await self.manager.submit(self.tx)
+        # never mined, then dropped from the mempool
+        assert await self.manager.wait_for_receipt(nonce, tx) is None
+
+        nonce, tx_hash, tx = await self.manager.submit(self.tx)
+        assert nonce == 5
+        assert self.w3.eth.get_transaction_count.call_count > 4
+        self.receipts[tx_hash] = {'status': 1}
+        assert await self.manager.wait_for_receipt(nonce, tx) == {'status': 1}
+
+    @pytest.mark.asyncio
+    async def test_fill_nonce_of_dropped_transaction_below_pending(self):
+        nonce5, _, tx5 = await self.manager.submit(self.tx)
+        await self.manager.submit(self.tx)  # 6
+        assert await self.manager.wait_for_receipt(nonce5, tx5) is None
+        await asyncio.sleep(0.05)
+
+        filler = self.sent[-1]
+        assert Account.recover_transaction(filler) == self.manager.address
+        assert self.manager._next_nonce == 7
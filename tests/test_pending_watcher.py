@@ -0,0 +1,104 @@
+import pytest
+from src.executor import AsyncExecutor
+from src.pending_watcher import Q96, PendingTransactionWatcher, PriceImpactSimulator
+from web3 import Web3
+
+EXCHANGE = Web3.toChecksumAddress('0x' + '12' * 20)
+MARKET = Web3.toChecksumAddress('0x' + '34' * 20)
+PRICE_FEED = Web3.toChecksumAddress('0x' + '56' * 20)
+
+POOL_INFO = {
+    'name': 'poolInfo',
+    'type': 'tuple',
+    'components': [
+        {'name': 'base', 'type': 'uint256'},
+        {'name': 'quote', 'type': 'uint256'},
+    ],
+}
+MARKET_ABI = [
+    {'name': 'setPoolInfo', 'type': 'function', 'stateMutability': 'nonpayable', 'inputs': [POOL_INFO], 'outputs': []},
+    {'name': 'setFundingMaxPremiumRatio', 'type': 'function', 'stateMutability': 'nonpayable',
+     'inputs': [{'name': 'value', 'type': 'uint24'}], 'outputs': []},
+    {'name': 'priceFeedBase', 'type': 'function', 'stateMutability': 'view', 'inputs': [],
+     'outputs': [{'name': '', 'type': 'address'}]},
+]
+EXCHANGE_ABI = [
+    {'name': 'trade', 'type': 'function', 'stateMutability': 'nonpayable', 'inputs': [{
+        'name': 'params',
+        'type': 'tuple',
+        'components': [
+            {'name': 'trader', 'type': 'address'},
+            {'name': 'market', 'type': 'address'},
+            {'name': 'amount', 'type': 'uint256'},
+        ],
+    }], 'outputs': []},
+    {'name': 'deposit', 'type': 'function', 'stateMutability': 'payable',
+     'inputs': [{'name': 'amount', 'type': 'uint256'}], 'outputs': []},
+]
+
+
+class TestPriceImpactSimulator:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        w3 = Web3()
+        self.exchange = w3.eth.contract(address=EXCHANGE, abi=EXCHANGE_ABI)
+        self.market = w3.eth.contract(address=MARKET, abi=MARKET_ABI)
+        mocker.patch.object(self.market.functions, 'priceFeedBase', return_value=mocker.Mock(
+            call=mocker.Mock(return_value=PRICE_FEED)))
+        self.simulator = PriceImpactSimulator(self.exchange, [self.market])
+        self.simulator.load()
+
+    def _tx(self, contract, fn_name, *args):
+        return {'hash': '0x01', 'to': contract.address, 'input': contract.encodeABI(fn_name, args)}
+
+    def test_addresses(self):
+        assert sorted(self.simulator.addresses) == sorted([EXCHANGE, MARKET, PRICE_FEED.lower()])
+
+    def test_set_pool_info(self):
+        tx = self._tx(self.market, 'setPoolInfo', dict(base=10 * 10 ** 18, quote=1000 * 10 ** 18))
+        assert self.simulator.simulate(tx) == {MARKET: 100 * Q96}
+
+    def test_unknown_price(self):
+        assert self.simulator.simulate(self._tx(self.market, 'setFundingMaxPremiumRatio', 1)) == {MARKET: None}
+        assert self.simulator.simulate({'hash': '0x01', 'to': PRICE_FEED, 'input': '0x12345678'}) == {MARKET: None}
+
+        trade = self._tx(self.exchange, 'trade', dict(trader=PRICE_FEED, market=MARKET, amount=1))
+        assert self.simulator.simulate(trade) == {MARKET: None}
+        assert self.simulator.simulate(self._tx(self.exchange, 'deposit', 1)) == {}
+
+
+class TestPendingTransactionWatcher:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.w3 = mocker.MagicMock()
+        self.executor = AsyncExecutor(max_workers=2)
+        self.watcher = PendingTransactionWatcher(
+            w3=self.w3,
+            executor=self.executor,
+            web3_provider_uri='http://localhost:8545',
+            addresses=[MARKET],
+        )
+        yield
+        self.executor.shutdown()
+
+    @pytest.mark.asyncio
+    async def test_filter(self):
+        self.watcher.start()
+        self.watcher.watch([PRICE_FEED])
+        txs = {
+            '0x01': {'hash': '0x01', 'to': EXCHANGE, 'blockNumber': None},
+            '0x02': {'hash': '0x02', 'to': MARKET.lower(), 'blockNumber': None},
+            '0x03': {'hash': '0x03', 'to': PRICE_FEED, 'blockNumber': 10},
+            '0x04': {'hash': '0x04', 'to': None, 'blockNumber': None},
+            '0x05': {'hash': '0x05', 'to': PRICE_FEED, 'blockNumber': None},
+        }
+        self.w3.eth.get_transaction.side_effect = lambda tx_hash: txs[tx_hash]
+
+        for tx_hash in ['0x01', '0x02', '0x03', '0x04', '0x05']:
+            self.watcher._fetch_count += 1
+            await self.watcher._fetch_transaction(tx_hash)
+
+        assert (await self.watcher.wait_for_transaction())['hash'] == '0x02'
+        assert (await self.watcher.wait_for_transaction())['hash'] == '0x05'
+        assert self.watcher._queue.empty()
+        assert self.watcher._fetch_count == 0
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from src.read_cache import BlockReadCache, contract_call_key
+
+
+class TestBlockReadCache:
+    @pytest.mark.asyncio
+    async def test_single_flight(self):
+        cache = BlockReadCache()
+        cache.advance(10)
+        event = asyncio.Event()
+        calls = []
+
+        async def _fetch(keys):
+            calls.append(keys)
+            await event.wait()
+            return [key * 2 for key in keys]
+
+        tasks = [
+            asyncio.create_task(cache.get_many(10, [1, 2], _fetch)),
+            asyncio.create_task(cache.get_many(10, [2, 3], _fetch)),
+        ]
+        await asyncio.sleep(0)
+        event.set()
+
+        assert await asyncio.gather(*tasks) == [[2, 4], [4, 6]]
+        # key 2 is fetched once
+        assert calls == [[1, 2], [3]]
+
+        assert await cache.get_many(10, [1, 2, 3], _fetch) == [2, 4, 6]
+        assert len(calls) == 2
+
+    @pytest.mark.asyncio
+    async def test_evict_on_advance(self):
+        cache = BlockReadCache()
+        cache.advance(10)
+        calls = []
+
+        async def _fetch():
+            calls.append(None)
+            return len(calls)
+
+        assert await cache.get(10, 'a', _fetch) == 1
+        assert await cache.get(11, 'a', _fetch) == 2
+        assert len(cache) == 2
+
+        cache.advance(11)
+        assert len(cache) == 1
+        assert await cache.get(11, 'a', _fetch) == 2
+        # older block and latest are not cached
+        assert await cache.get(10, 'a', _fetch) == 3
+        assert await cache.get('latest', 'a', _fetch) == 4
+        assert len(cache) == 1
+
+        # the head doesn't go back
+        cache.advance(9)
+        assert cache.block_number == 11
+
+    @pytest.mark.asyncio
+    async def test_failure_not_cached(self):
+        cache = BlockReadCache()
+        cache.advance(10)
+        event = asyncio.Event()
+        calls = []
+
+        async def _fetch():
+            calls.append(None)
+            await event.wait()
+            if len(calls) == 1:
+                raise ValueError('rpc error')
+            return 'ok'
+
+        tasks = [asyncio.create_task(cache.get(10, 'a', _fetch)) for _ in range(2)]
+        await asyncio.sleep(0)
+        event.set()
+
+        rets = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(ret, ValueError) for ret in rets)
+        assert len(calls) == 1
+
+        assert await cache.get(10, 'a', _fetch) == 'ok'
+        assert len(calls) == 2
+
+    @pytest.mark.asyncio
+    async def test_cancelled_caller(self):
+        cache = BlockReadCache()
+        cache.advance(10)
+        event = asyncio.Event()
+
+        async def _fetch():
+            await event.wait()
+            return 'ok'
+
+        first = asyncio.create_task(cache.get(10, 'a', _fetch))
+        second = asyncio.create_task(cache.get(10, 'a', _fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        event.set()
+
+        # the fetch started by the cancelled caller still serves the other one
+        assert await second == 'ok'
+
+    def test_contract_call_key(self, mocker):
+        func = mocker.Mock(address='exchange', fn_name='maxTrade', args=({'trader': 'a', 'market': 'm'},))
+        same = mocker.Mock(address='exchange', fn_name='maxTrade', args=({'market': 'm', 'trader': 'a'},))
+
+        assert contract_call_key(func) == contract_call_key(same)
+        assert hash(contract_call_key(func)) is not None
@@ -0,0 +1,149 @@
+import pytest
+from src import metrics
+from src.risk_engine import Q96, RiskEngine
+
+MARKET = '0x' + '56' * 20
+DECIMALS = 10 ** 18
+
+
+class TestRiskEngine:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.exchange = mocker.MagicMock()
+        self.price = 100 * Q96
+        # - key: trader
+        # - value: (total account value, position share)
+        self.accounts = {}
+        # - key: trader
+        # - value: maker liquidity
+        self.liquidity = {}
+
+        def _func(value):
+            return mocker.MagicMock(call=mocker.MagicMock(side_effect=lambda **kwargs: value()))
+
+        functions = self.exchange.functions
+        functions.mmRatio.side_effect = lambda: _func(lambda: 50000)  # 5%
+        functions.getTotalAccountValue.side_effect = lambda trader: _func(lambda: self.accounts[trader][0])
+        functions.getPositionShare.side_effect = lambda trader, market: _func(lambda: self.accounts[trader][1])
+        functions.getMakerInfo.side_effect = lambda trader, market: _func(
+            lambda: (self.liquidity.get(trader, 0), 0, 0))
+
+        self.engine = RiskEngine(self.exchange, safety_band=0.2)
+        self.market = mocker.MagicMock()
+        self.market.functions.getShareMarkPriceX96.side_effect = lambda: _func(lambda: self.price)
+        self.engine._markets[MARKET] = self.market
+
+    def test_screen(self):
+        self.accounts = {
+            'healthy': (100 * DECIMALS, 1 * DECIMALS),  # 100%
+            'near': (55 * DECIMALS, 10 * DECIMALS),  # 5.5%
+            'underwater': (40 * DECIMALS, 10 * DECIMALS),  # 4%
+            'no position': (10 * DECIMALS, 0),
+        }
+        ret = self.engine.screen({MARKET: set(self.accounts.keys())}, set(), block_number=1)
+
+        assert ret == {'near', 'underwater'}
+        assert self.engine.margin_ratio('no position') == float('inf')
+        shortfall, notional = self.engine.estimate_shortfall('underwater')
+        assert notional == 1000 * DECIMALS
+        assert shortfall == 10 * DECIMALS
+
+    def test_price_move_without_account_read(self):
+        self.accounts = {'long': (100 * DECIMALS, 10 * DECIMALS)}  # 10%
+        assert self.engine.screen({MARKET: {'long'}}, set(), block_number=1) == set()
+
+        # account value 100 - 10 * 6 = 40, notional 940
+        self.price = 94 * Q96
+        self.accounts = {}  # not read again
+        assert self.engine.screen({MARKET: {'long'}}, set(), block_number=2) == {'long'}
+        assert self.engine.margin_ratio('long') == pytest.approx(40 / 940)
+
+    def test_updated_trader_is_read_again(self):
+        self.accounts = {'trader': (100 * DECIMALS, 10 * DECIMALS)}
+        self.engine.screen({MARKET: {'trader'}}, set(), block_number=1)
+
+        self.accounts = {'trader': (10 * DECIMALS, 10 * DECIMALS)}
+        assert self.engine.screen({MARKET: {'trader'}}, set(), block_number=2) == set()
+        assert self.engine.screen({MARKET: {'trader'}}, {'trader'}, block_number=3) == {'trader'}
+
+    def test_unknown_account_is_candidate(self):
+        # account read fails
+        assert self.engine.screen({MARKET: {'unknown'}}, set(), block_number=1) == {'unknown'}
+
+    def test_recheck_only_on_change(self):
+        self.accounts = {
+            'far': (100 * DECIMALS, 1 * DECIMALS),  # 100%
+            'near': (55 * DECIMALS, 10 * DECIMALS),  # 5.5%
+        }
+        market_to_traders = {MARKET: {'far', 'near'}}
+        assert self.engine.screen(market_to_traders, set(), block_number=1) == {'near'}
+
+        # nothing changed
+        assert self.engine.screen(market_to_traders, set(), block_number=2) == set()
+        assert metrics.RECHECKED_TRADERS.get() == 0
+
+        # a small move rechecks only the account near the margin
+        self.price = 100 * Q96 + Q96 // 100
+        assert self.engine.screen(market_to_traders, set(), block_number=3) == {'near'}
+        assert metrics.RECHECKED_TRADERS.get() == 1
+
+        # the move since the reference price reaches the threshold
+        self.price = 100 * Q96 + Q96 // 5
+        assert self.engine.screen(market_to_traders, set(), block_number=4) == {'near'}
+        assert metrics.RECHECKED_TRADERS.get() == 2
+
+    def test_unhealthy_trader_is_rechecked(self):
+        self.accounts = {'near': (55 * DECIMALS, 10 * DECIMALS)}
+        assert self.engine.screen({MARKET: {'near'}}, set(), block_number=1) == {'near'}
+        self.engine.set_unhealthy_traders({'near'})
+
+        assert self.engine.screen({MARKET: {'near'}}, set(), block_number=2) == {'near'}
+        self.engine.set_unhealthy_traders(set())
+        assert self.engine.screen({MARKET: {'near'}}, set(), block_number=3) == set()
+
+    def test_expired_account_is_read_again(self):
+        self.engine = RiskEngine(self.exchange, safety_band=0.2, max_age_blocks=10)
+        self.engine._markets[MARKET] = self.market
+        self.accounts = {'trader': (100 * DECIMALS, 10 * DECIMALS)}
+        self.engine.screen({MARKET: {'trader'}}, set(), block_number=1)
+
+        self.accounts = {'trader': (10 * DECIMALS, 10 * DECIMALS)}
+        assert self.engine.screen({MARKET: {'trader'}}, set(), block_number=10) == set()
+        assert self.engine.screen({MARKET: {'trader'}}, set(), block_number=11) == {'trader'}
+
+    def test_simulate(self):
+        self.accounts = {
+            'long': (100 * DECIMALS, 10 * DECIMALS),  # 10%
+            'near': (55 * DECIMALS, 10 * DECIMALS),  # 5.5%
+        }
+        self.engine.screen({MARKET: {'long', 'near'}}, set(), block_number=1)
+
+        # long: account value 100 - 10 * 6 = 40, notional 940
+        assert self.engine.simulate({MARKET: 94 * Q96}) == {('long', MARKET), ('near', MARKET)}
+        assert self.engine.simulate({MARKET: 100 * Q96}) == set()
+        assert self.engine.simulate({'0x' + '78' * 20: 1}) == set()
+        # the latest prices are not changed
+        assert self.engine.margin_ratio('long') == pytest.approx(0.1)
+
+    def test_simulate_while_screening(self, mocker):
+        self.accounts = {trader: (55 * DECIMALS, 10 * DECIMALS) for trader in ['a', 'b', 'c']}
+        self.engine.screen({MARKET: {'a', 'b', 'c'}}, set(), block_number=1)
+
+        # an account is forgotten by screen in the middle of the iteration
+        margin_ratio = self.engine.margin_ratio
+        mocker.patch.object(self.engine, 'margin_ratio', side_effect=lambda trader, prices: (
+            self.engine._forget('c'), margin_ratio(trader, prices))[1])
+
+        assert ('a', MARKET) in self.engine.simulate({MARKET: 94 * Q96})
+
+    def test_maker_is_checked_on_chain(self):
+        # no taker position, the maker liquidity may be underwater
+        self.accounts = {'maker': (10 * DECIMALS, 0), 'taker': (100 * DECIMALS, 1 * DECIMALS)}
+        self.liquidity = {'maker': 5 * DECIMALS}
+        market_to_traders = {MARKET: {'maker', 'taker'}}
+        assert self.engine.screen(market_to_traders, set(), block_number=1) == {'maker'}
+
+        # checked again on a price change, but not signed for a pending price move
+        self.price = 100 * Q96 + Q96 // 100
+        assert self.engine.screen(market_to_traders, set(), block_number=2) == {'maker'}
+        assert self.engine.simulate({MARKET: 50 * Q96}) == set()
@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+from src.scheduler import LiquidationScheduler
+
+
+class TestLiquidationScheduler:
+    @pytest.mark.asyncio
+    async def test_merge_duplicate(self):
+        scheduler = LiquidationScheduler(max_concurrency=2)
+        scheduler.start()
+        event = asyncio.Event()
+        calls = []
+
+        async def _job(key):
+            calls.append(key)
+            await event.wait()
+
+        assert scheduler.submit('a', _job, 'a') is True
+        assert scheduler.submit('a', _job, 'a') is False
+        await asyncio.sleep(0)
+        # running job is also merged
+        assert scheduler.submit('a', _job, 'a') is False
+        assert scheduler.in_flight_count == 1
+
+        event.set()
+        await scheduler.join()
+        assert calls == ['a']
+        assert scheduler.is_scheduled('a') is False
+        scheduler.stop()
+
+    @pytest.mark.asyncio
+    async def test_bounded_concurrency(self):
+        scheduler = LiquidationScheduler(max_concurrency=2)
+        scheduler.start()
+        event = asyncio.Event()
+
+        async def _job():
+            await event.wait()
+
+        for key in range(5):
+            scheduler.submit(key, _job)
+        await asyncio.sleep(0)
+
+        assert scheduler.in_flight_count == 2
+        assert scheduler.queue_depth == 3
+
+        event.set()
+        await scheduler.join()
+        assert scheduler.in_flight_count == 0
+        assert scheduler.queue_depth == 0
+        scheduler.stop()
+
+    @pytest.mark.asyncio
+    async def test_queue_full(self):
+        scheduler = LiquidationScheduler(max_concurrency=1, max_queue_size=1)
+        scheduler.start()
+        event = asyncio.Event()
+
+        async def _job():
+            await event.wait()
+
+        assert scheduler.submit(1, _job) is True
+        await asyncio.sleep(0)
+        assert scheduler.submit(2, _job) is True
+        assert scheduler.submit(3, _job) is False
+
+        event.set()
+        await scheduler.join()
+        scheduler.stop()
+
+    @pytest.mark.asyncio
+    async def test_job_error(self):
+        scheduler = LiquidationScheduler(max_concurrency=1)
+        scheduler.start()
+
+        async def _job():
+            raise ValueError('error')
+
+        scheduler.submit(1, _job)
+        await scheduler.join()
+
+        assert scheduler.is_scheduled(1) is False
+        assert scheduler.submit(1, _job) is True
+        await scheduler.join()
+        scheduler.stop()
+
+    async def _run_one_by_one(self, scheduler, keys, priorities):
+        order = []
+
+        async def _job(key):
+            order.append(key)
+
+        for key, priority in zip(keys, priorities):
+            scheduler.submit(key, _job, key, priority=priority)
+        scheduler.start()
+        await scheduler.join()
+        scheduler.stop()
+        return order
+
+    @pytest.mark.asyncio
+    async def test_priority_order(self):
+        scheduler = LiquidationScheduler(max_concurrency=1, fairness_interval=None)
+        order = await self._run_one_by_one(
+            scheduler,
+            ['small', 'whale', 'medium', 'whale 2'],
+            [(1, 10), (100, 1000), (10, 10), (100, 2000)],
+        )
+        assert order == ['whale 2', 'whale', 'medium', 'small']
+
+    @pytest.mark.asyncio
+    async def test_fairness(self):
+        scheduler = LiquidationScheduler(max_concurrency=1, fairness_interval=3)
+        order = await self._run_one_by_one(scheduler, ['old', 'a', 'b', 'c', 'd'], [0, 4, 3, 2, 1])
+        # every 3rd dispatch takes the oldest job
+        assert order == ['a', 'b', 'old', 'c', 'd']
+
+    @pytest.mark.asyncio
+    async def test_raise_priority_of_queued_job(self):
+        scheduler = LiquidationScheduler(max_concurrency=1, fairness_interval=None)
+        order = []
+
+        async def _job(key):
+            order.append(key)
+
+        scheduler.submit('a', _job, 'a', priority=2)
+        scheduler.submit('b', _job, 'b', priority=1)
+        assert scheduler.submit('b', _job, 'b', priority=3) is False
+        assert scheduler.queue_depth == 2
+
+        scheduler.start()
+        await scheduler.join()
+        assert order == ['b', 'a']
+        scheduler.stop()
+
+    @pytest.mark.asyncio
+    async def test_block_budget(self):
+        scheduler = LiquidationScheduler(max_concurrency=4, block_budget=2)
+        scheduler.start()
+        done = []
+
+        async def _job(key):
+            done.append(key)
+
+        for key in range(5):
+            scheduler.submit(key, _job, key)
+        await asyncio.sleep(0.01)
+        assert len(done) == 2
+        assert scheduler.queue_depth == 3
+
+        scheduler.begin_block(2)
+        await asyncio.sleep(0.01)
+        assert len(done) == 4
+
+        scheduler.begin_block(3)
+        await scheduler.join()
+        assert len(done) == 5
+        scheduler.stop()
@@ -0,0 +1,52 @@
+import pytest
+from eth_account import Account
+from src.executor import AsyncExecutor
+from src.sender_pool import SenderPool
+
+
+class TestSenderPool:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.w3 = mocker.MagicMock()
+        self.w3.eth.get_balance.side_effect = lambda address: 10 ** 18
+        self.executor = AsyncExecutor(max_workers=2)
+        self.pool = SenderPool(
+            w3=self.w3,
+            accounts=[Account.create() for _ in range(3)],
+            executor=self.executor,
+        )
+        yield
+        self.executor.shutdown()
+
+    def test_acquire_free_senders_first(self):
+        senders = [self.pool.acquire() for _ in range(3)]
+        assert len({sender.address for sender in senders}) == 3
+
+        # all in use, shared by the least loaded one
+        self.pool.release(senders[1])
+        assert self.pool.acquire() is senders[1]
+
+    def test_acquire_least_pending(self, mocker):
+        senders = self.pool.senders
+        senders[0]._pending = {1: [], 2: []}
+        senders[1]._pending = {}
+        senders[2]._pending = {3: []}
+
+        for _ in range(3):
+            sender = self.pool.acquire()
+            assert sender is senders[1]
+            self.pool.release(sender)
+
+    @pytest.mark.asyncio
+    async def test_sender_context(self):
+        async with self.pool.sender() as sender:
+            stats = {s['address']: s for s in await self.pool.stats()}
+            assert stats[sender.address]['in_use'] == 1
+            assert stats[sender.address]['balance'] == 10 ** 18
+
+        stats = await self.pool.stats()
+        assert [s['in_use'] for s in stats] == [0, 0, 0]
+
+    def test_no_account(self):
+        with pytest.raises(ValueError):
+            SenderPool(w3=self.w3, accounts=[], executor=self.executor)
@@ -0,0 +1,148 @@
+import time
+
+from benchmarks.fake_redis import FakeRedis
+from src.sharding import HashRing, SharedTraderSet, ShardCoordinator, TraderSetPublisher
+
+TRADERS = ['0x{:040x}'.format(i) for i in range(1000)]
+
+
+class TestHashRing:
+    def test_balanced_and_stable(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = {trader: ring.owner(trader) for trader in TRADERS}
+        counts = {member: list(owners.values()).count(member) for member in ['a', 'b', 'c']}
+        assert min(counts.values()) > 200
+
+        # only the keys of the leaving member move
+        ring = HashRing(['a', 'b'])
+        moved = [trader for trader in TRADERS if ring.owner(trader) != owners[trader]]
+        assert all(owners[trader] == 'c' for trader in moved)
+
+    def test_empty(self):
+        assert HashRing([]).owner('0x01') is None
+
+
+class TestShardCoordinator:
+    def _coordinators(self, redis_client, worker_ids, heartbeat_ttl=10):
+        return [ShardCoordinator(redis_client, worker_id=worker_id, heartbeat_ttl=heartbeat_ttl)
+                for worker_id in worker_ids]
+
+    def test_each_trader_has_one_owner(self):
+        redis_client = FakeRedis()
+        coordinators = self._coordinators(redis_client, ['w1', 'w2', 'w3'])
+        for _ in range(2):
+            for coordinator in coordinators:
+                coordinator.heartbeat()
+
+        assert all(coordinator.members == ['w1', 'w2', 'w3'] for coordinator in coordinators)
+        for trader in TRADERS:
+            assert sum(coordinator.owns(trader) for coordinator in coordinators) == 1
+
+    def test_rebalance_when_worker_dies(self, mocker):
+        redis_client = FakeRedis()
+        w1, w2 = self._coordinators(redis_client, ['w1', 'w2'])
+        w1.heartbeat()
+        w2.heartbeat()
+        assert w1.heartbeat() is True
+        assert not all(w1.owns(trader) for trader in TRADERS)
+
+        # w2 stops heartbeating
+        now = time.time()
+        mocker.patch('src.sharding.time.time', return_value=now + 11)
+        assert w1.heartbeat() is True
+        assert w1.members == ['w1']
+        assert all(w1.owns(trader) for trader in TRADERS)
+        assert w1.heartbeat() is False
+
+    def test_leave(self):
+        redis_client = FakeRedis()
+        w1, w2 = self._coordinators(redis_client, ['w1', 'w2'])
+        w1.heartbeat()
+        w2.heartbeat()
+        w2.leave()
+
+        w1.heartbeat()
+        assert w1.members == ['w1']
+
+    def test_claim(self, mocker):
+        redis_client = FakeRedis()
+        w1, w2 = self._coordinators(redis_client, ['w1', 'w2'])
+
+        assert w1.claim('position:t:m') is True
+        assert w2.claim('position:t:m') is False
+        # renewed by the owner
+        assert w1.claim('position:t:m') is True
+
+        # release by another worker is ignored
+        w2.release('position:t:m')
+        assert w2.claim('position:t:m') is False
+        w1.release('position:t:m')
+        assert w2.claim('position:t:m') is True
+
+        # expired claim of a dead worker
+        now = time.time()
+        mocker.patch('time.time', return_value=now + 61)
+        assert w1.claim('position:t:m') is True
+
+    def test_renew(self, mocker):
+        redis_client = FakeRedis()
+        w1, w2 = self._coordinators(redis_client, ['w1', 'w2'])
+        assert w1.claim('position:t:m') is True
+
+        # renewed before the ttl
+        now = time.time()
+        mocker.patch('time.time', return_value=now + 50)
+        assert w1.renew('position:t:m') is True
+        mocker.patch('time.time', return_value=now + 100)
+        assert w2.claim('position:t:m') is False
+
+        # an expired claim taken by another worker is neither renewed nor released
+        mocker.patch('time.time', return_value=now + 200)
+        assert w2.claim('position:t:m') is True
+        assert w1.renew('position:t:m') is False
+        w1.release('position:t:m')
+        assert w1.claim('position:t:m') is False
+
+    def test_claim_redis_error(self, mocker):
+        redis_client = mocker.MagicMock()
+        redis_client.set.side_effect = ConnectionError()
+        assert ShardCoordinator(redis_client, worker_id='w1').claim('position:t:m') is False
+
+
+class TestSharedTraderSet:
+    def test_publish_and_read(self):
+        redis_client = FakeRedis()
+        publisher = TraderSetPublisher(redis_client)
+        reader = SharedTraderSet(redis_client)
+
+        assert reader.fetch_market_to_traders() == {}
+
+        publisher.publish(10, {'m': {'a', 'b'}}, {'a', 'b'})
+        assert reader.fetch_market_to_traders() == {'m': {'a', 'b'}}
+        assert reader.last_block_number == 10
+        assert reader.pop_updated_traders() == {'a', 'b'}
+
+        publisher.publish(11, {'m': {'a', 'b'}}, set())
+        publisher.publish(12, {'m': {'a', 'b', 'c'}}, {'c'})
+        assert reader.fetch_market_to_traders() == {'m': {'a', 'b', 'c'}}
+        assert reader.last_block_number == 12
+        assert reader.pop_updated_traders() == {'c'}
+
+        # nothing new
+        reader.fetch_market_to_traders()
+        assert reader.pop_updated_traders() == set()
+
+    def test_missed_updates(self):
+        redis_client = FakeRedis()
+        publisher = TraderSetPublisher(redis_client, max_updates=2)
+        reader = SharedTraderSet(redis_client)
+
+        publisher.publish(10, {'m': {'a', 'b', 'c'}}, {'a'})
+        reader.fetch_market_to_traders()
+        reader.pop_updated_traders()
+
+        for block_number, trader in [(11, 'a'), (12, 'b'), (13, 'b')]:
+            publisher.publish(block_number, {'m': {'a', 'b', 'c'}}, {trader})
+        reader.fetch_market_to_traders()
+        # the update of block 11 was trimmed
+        assert reader.pop_updated_traders() == {'a', 'b', 'c'}